@@ -1,7 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import cPickle as pickle
+import errno
+import fcntl
+import hashlib
+import math
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
 from functools import update_wrapper
+from timeit import default_timer
 
 
 def disable(fun):
@@ -51,17 +64,536 @@ def memo(fun):
     return wrapper
 
 
+CacheInfo = namedtuple('CacheInfo', 'hits misses evictions expired maxsize currsize')
+PREV, NEXT, KEY, RESULT, EXPIRES = 0, 1, 2, 3, 4  # fields of a link of the lru list
+KWARGS_MARK = object()  # separates args from kwargs in a cache key
+MISSING = object()
+
+
+def make_key(args, kwargs):
+    '''f(1, b=2) and f(1, 2) are different keys, the order of kwargs does not matter.'''
+    if not kwargs:
+        return args
+    return args + (KWARGS_MARK,) + tuple(sorted(kwargs.items()))
+
+
+class LruCache(object):
+    '''
+    At most maxsize (None - no limit) results by key, the least recently
+    used one is evicted first, an expired one is removed when read.
+    Not thread-safe, the callers guard it by their locks.
+    '''
+
+    def __init__(self, maxsize=None, timer=time.time):
+        self.maxsize = maxsize
+        self.timer = timer
+        self.links = {}  # key -> link [prev, next, key, result, expires]
+        self.root = []  # circular doubly linked list, root[NEXT] is the oldest link
+        self.clear()
+
+    def __len__(self):
+        return len(self.links)
+
+    def clear(self):
+        root = self.root
+        self.links.clear()
+        root[:] = [root, root, None, None, None]
+        self.evictions = self.expired = 0
+
+    def get(self, key):  # -> result or MISSING
+        link = self.links.get(key)
+        if link is None:
+            return MISSING
+        link_prev, link_next = link[PREV], link[NEXT]
+        link_prev[NEXT], link_next[PREV] = link_next, link_prev
+        if link[EXPIRES] is None or link[EXPIRES] > self.timer():
+            root = self.root
+            last = root[PREV]  # move to the most recently used end
+            last[NEXT] = root[PREV] = link
+            link[PREV], link[NEXT] = last, root
+            return link[RESULT]
+        del self.links[key]
+        self.expired += 1
+        return MISSING
+
+    def set(self, key, result, ttl=None):
+        if key in self.links:  # computed by another thread meanwhile
+            return
+        root = self.root
+        last = root[PREV]
+        link = [last, root, key, result, self.timer() + ttl if ttl is not None else None]
+        last[NEXT] = root[PREV] = self.links[key] = link
+        if self.maxsize is not None and len(self.links) > self.maxsize:
+            oldest = root[NEXT]
+            root[NEXT], oldest[NEXT][PREV] = oldest[NEXT], root
+            del self.links[oldest[KEY]]
+            self.evictions += 1
+
+
+def lru_memo(maxsize=128, ttl=None, timer=time.time):
+    '''
+    Memoize a function keeping at most maxsize results (None - no limit),
+    the least recently used one is evicted first. A result older than
+    ttl seconds is computed again. Keys include kwargs, the cache is
+    guarded by a lock, the function itself is called without it.
+
+    @lru_memo(maxsize=1000, ttl=60)
+    def fib(n):
+        ....
+
+    >>> fib(30)
+    1346269
+    >>> fib.cache_info()
+    CacheInfo(hits=28, misses=31, evictions=0, expired=0, maxsize=1000, currsize=31)
+    '''
+    if maxsize is not None and maxsize <= 0:
+        raise ValueError('maxsize must be positive or None')
+
+    @decorator
+    def deco(fun):
+        cache = LruCache(maxsize, timer)
+        get, stats = cache.get, {'hits': 0, 'misses': 0}
+        lock = threading.Lock()
+
+        def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs)
+            with lock:
+                res = get(key)
+                if res is not MISSING:
+                    stats['hits'] += 1
+                    return res
+                stats['misses'] += 1
+            res = fun(*args, **kwargs)
+            with lock:
+                cache.set(key, res, ttl)
+            return res
+
+        def cache_info():
+            with lock:
+                return CacheInfo(evictions=cache.evictions, expired=cache.expired, maxsize=maxsize,
+                                 currsize=len(cache), **stats)
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+                stats.update(hits=0, misses=0)
+
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return deco
+
+
+class InFlight(object):
+    '''A call being computed by one thread, the others with the same key wait for its result.'''
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+    def wait(self):
+        self.event.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class DiskStore(object):
+    '''
+    Results shared by processes: one pickle per key in path, written to
+    a temporary file and renamed. lock(digest) is an flock, so that only
+    one process computes a value and the others wait and read it. The
+    lock file is removed when released, every purge_every writes the
+    expired values are removed too (purge).
+    '''
+    tmp_age = 3600  # a temporary file older than this is left by a killed writer
+
+    def __init__(self, path, purge_every=1000):
+        self.path = path
+        self.purge_every = purge_every
+        self.writes = 0
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def load(self, digest):  # -> (expires, value) or None
+        try:
+            with open(os.path.join(self.path, digest), 'rb') as value_file:
+                return pickle.load(value_file)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def get(self, digest):
+        entry = self.load(digest)
+        if entry is None or entry[0] is not None and entry[0] <= time.time():
+            return MISSING
+        return entry[1]
+
+    def set(self, digest, value, ttl=None):
+        path = os.path.join(self.path, digest)
+        with open('{0}.{1}.tmp'.format(path, os.getpid()), 'wb') as value_file:
+            pickle.dump((time.time() + ttl if ttl is not None else None, value), value_file, 2)
+        os.rename('{0}.{1}.tmp'.format(path, os.getpid()), path)
+        self.writes += 1
+        if self.purge_every and not self.writes % self.purge_every:
+            self.purge()
+
+    def acquire(self, digest, blocking=True):  # -> the locked file, None if it is locked and not blocking
+        path = os.path.join(self.path, digest + '.lock')
+        while True:
+            lock_file = open(path, 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                lock_file.close()
+                if not blocking and e.errno in (errno.EAGAIN, errno.EACCES):
+                    return None
+                raise
+            try:
+                if os.fstat(lock_file.fileno()).st_ino == os.stat(path).st_ino:
+                    return lock_file
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    lock_file.close()
+                    raise
+            lock_file.close()  # removed by the previous owner while this one waited, lock a new one
+
+    def release(self, digest, lock_file):
+        try:
+            os.remove(os.path.join(self.path, digest + '.lock'))
+        finally:
+            lock_file.close()
+
+    @contextmanager
+    def lock(self, digest):
+        lock_file = self.acquire(digest)
+        try:
+            yield
+        finally:
+            self.release(digest, lock_file)
+
+    def purge(self):
+        '''Remove the expired values, stale temporary and lock files, the keys locked now are skipped.'''
+        now = time.time()
+        for name in os.listdir(self.path):
+            if name.endswith('.tmp'):
+                try:
+                    if os.path.getmtime(os.path.join(self.path, name)) < now - self.tmp_age:
+                        os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+                continue
+            digest = name[:-len('.lock')] if name.endswith('.lock') else name
+            if digest == name and self.get(digest) is not MISSING:
+                continue
+            lock_file = self.acquire(digest, blocking=False)  # the lock of a killed owner is free
+            if lock_file is None:
+                continue
+            try:
+                entry = self.load(digest)  # could be written again before the lock was taken
+                if entry is not None and entry[0] is not None and entry[0] <= now:
+                    os.remove(os.path.join(self.path, digest))
+            finally:
+                self.release(digest, lock_file)
+
+
+def shared_memo(store=None, ttl=None, maxsize=128):
+    '''
+    Memoize a function so that concurrent calls with the same arguments
+    are computed once: the first thread computes, the others wait for
+    its result (or its exception). At most maxsize results are kept in
+    memory, as in lru_memo. With store=DiskStore(path) the results are
+    also shared by processes, e.g. pre-forked workers, arguments and
+    results must be picklable then.
+
+    @shared_memo(DiskStore('/tmp/scores'), ttl=3600)
+    def score(phone, email):
+        ....
+    '''
+    if maxsize is not None and maxsize <= 0:
+        raise ValueError('maxsize must be positive or None')
+
+    @decorator
+    def deco(fun):
+        name = '{0}.{1}'.format(fun.__module__, fun.__name__)
+        cache = LruCache(maxsize)
+        calls = {}  # key -> InFlight
+        stats = {'hits': 0, 'misses': 0, 'waits': 0, 'shared_hits': 0}
+        lock = threading.Lock()
+
+        def compute(args, kwargs):
+            if store is None:
+                return fun(*args, **kwargs)
+            digest = hashlib.md5(pickle.dumps((name, args, sorted(kwargs.items())), 2)).hexdigest()
+            res = store.get(digest)
+            if res is MISSING:
+                with store.lock(digest):
+                    res = store.get(digest)  # computed by another process while this one waited
+                    if res is MISSING:
+                        res = fun(*args, **kwargs)
+                        store.set(digest, res, ttl)
+                        return res
+            with lock:
+                stats['shared_hits'] += 1
+            return res
+
+        def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs)
+            with lock:
+                res = cache.get(key)
+                if res is not MISSING:
+                    stats['hits'] += 1
+                    return res
+                call = calls.get(key)
+                leader = call is None
+                if leader:
+                    stats['misses'] += 1
+                    call = calls[key] = InFlight()
+                else:
+                    stats['waits'] += 1
+            if not leader:
+                return call.wait()
+            try:
+                call.result = compute(args, kwargs)
+            except Exception:
+                call.exc_info = sys.exc_info()
+                raise
+            else:
+                with lock:
+                    cache.set(key, call.result, ttl)
+                return call.result
+            finally:
+                with lock:
+                    del calls[key]
+                call.event.set()
+
+        def cache_info():
+            with lock:
+                return dict(stats, evictions=cache.evictions, expired=cache.expired, maxsize=maxsize,
+                            currsize=len(cache))
+
+        wrapper.stats = stats
+        wrapper.cache_info = cache_info
+        return wrapper
+    return deco
+
+
 @decorator
 def n_ary(fun):
     '''
     Given binary function f(x, y), return an n_ary function such
     that f(x, y, z) = f(x, f(y,z)), etc. Also allow f(x) = x.
     '''
-    def wrapper(x, *args):
-        return x if not args else fun(x, wrapper(*args))
+    def wrapper(x, *args):  # a loop from the right end, no frame per argument
+        if not args:
+            return x
+        res = args[-1]
+        for i in xrange(len(args) - 2, -1, -1):
+            res = fun(args[i], res)
+        return fun(x, res)
+    return wrapper
+
+
+REDUCERS = {}  # id -> function of tree_n_ary, pool processes are forked after it is registered
+
+
+def tree_reduce(fun, items):  # ((a, b), (c, d)), ... - the order is kept, only associativity is needed
+    items = list(items)
+    while len(items) > 1:
+        items = [fun(items[i], items[i + 1]) if i + 1 < len(items) else items[i] for i in xrange(0, len(items), 2)]
+    return items[0]
+
+
+def reduce_chunk(args):  # runs in a pool process
+    reducer_id, items = args
+    return tree_reduce(REDUCERS[reducer_id], items)
+
+
+def tree_n_ary(processes=None, chunk_size=10000):
+    '''
+    Given an associative binary function f(x, y), return an n_ary function
+    reducing its arguments as a balanced tree: f(f(x, y), f(z, t)), etc.
+    The depth is log2 of the number of arguments. With processes and more
+    than chunk_size arguments the chunks are reduced in a process pool,
+    created for the call, and then the results of the chunks.
+    '''
+    @decorator
+    def deco(fun):
+        reducer_id = len(REDUCERS)
+        REDUCERS[reducer_id] = fun
+
+        def wrapper(x, *args):
+            if processes and len(args) >= chunk_size:
+                items = (x,) + args
+                pool = multiprocessing.Pool(processes)
+                try:
+                    parts = pool.map(reduce_chunk, [(reducer_id, items[i:i + chunk_size])
+                                                    for i in xrange(0, len(items), chunk_size)])
+                finally:
+                    pool.close()
+                    pool.join()
+                return tree_reduce(fun, parts)
+            return tree_reduce(fun, (x,) + args)
+        return wrapper
+    return deco
+
+
+PROFILING = os.environ.get('DECO_PROFILE', '1') != '0'  # DECO_PROFILE=0 -> profile and timed return fun as is
+HISTOGRAM_SIZE = 32  # bucket i - calls that took [2**(i-1), 2**i) microseconds, the last one - longer
+TOTAL, SELF_TIME, DEPTH, HISTOGRAM = 0, 1, 2, 3  # fields of a slot of Profile, the histogram buckets follow DEPTH
+# math.frexp exponent of the time in microseconds -> index of its bucket in a slot
+BUCKET_INDEX = dict((exp, HISTOGRAM + max(0, min(exp, HISTOGRAM_SIZE - 1))) for exp in xrange(-1100, 1100))
+PROFILES = {}  # name -> Profile of every function decorated with profile or timed
+
+
+class ThreadState(threading.local):
+    def __init__(self):
+        self.stack = []  # time of profiled callees of every active call of this thread
+
+
+class ThreadSlot(threading.local):
+    '''The slot of the current thread, allocated and added to slots on its first call.'''
+
+    def __init__(self, slots):
+        self.slot = [0.0, 0.0, 0] + [0] * HISTOGRAM_SIZE
+        slots.append(self.slot)
+
+
+_local = ThreadState()
+
+
+class Profile(object):
+    '''
+    Counters of one profiled function: every thread updates its own slot
+    without a lock, the counters are the sums of the slots. The slot of
+    a finished thread is kept, its calls stay counted.
+    '''
+    __slots__ = ('name', 'timed', 'slots', 'local')
+
+    def __init__(self, name, self_time=True):
+        self.name = name
+        self.timed = not self_time  # self_time is None for timed
+        self.slots = []
+        self.local = ThreadSlot(self.slots)
+
+    @property
+    def total(self):
+        return sum(slot[TOTAL] for slot in list(self.slots))
+
+    @property
+    def self_time(self):  # without the time of profiled callees
+        return None if self.timed else sum(slot[SELF_TIME] for slot in list(self.slots))
+
+    @property
+    def histogram(self):
+        histogram = [0] * HISTOGRAM_SIZE
+        for slot in list(self.slots):
+            for i, count in enumerate(slot[HISTOGRAM:]):
+                histogram[i] += count
+        return histogram
+
+    @property
+    def calls(self):
+        return sum(self.histogram)
+
+    def percentile(self, q):  # -> upper bound of the bucket, seconds
+        histogram = self.histogram
+        rank = q / 100.0 * sum(histogram)
+        seen = 0
+        for i, count in enumerate(histogram):
+            seen += count
+            if count and seen >= rank:
+                return 2.0 ** i / 1e6
+        return 0.0
+
+    def reset(self):  # in place, the depth of active calls is kept
+        for slot in list(self.slots):
+            slot[TOTAL] = slot[SELF_TIME] = 0.0
+            slot[HISTOGRAM:] = [0] * HISTOGRAM_SIZE
+
+
+def register(fun, self_time=True):  # every decorated function gets its own Profile, module.name[#2...]
+    name = base = '{0}.{1}'.format(fun.__module__, fun.__name__)
+    num = 1
+    while name in PROFILES:
+        num += 1
+        name = '{0}#{1}'.format(base, num)
+    stat = PROFILES[name] = Profile(name, self_time)
+    return stat
+
+
+@decorator
+def timed(fun):
+    '''
+    Count calls, total time and the latency histogram of the function
+    decorated. As cheap as it gets: the time of recursive calls is
+    counted more than once and a call that raised is not counted.
+    '''
+    if not PROFILING:
+        return fun
+    local = register(fun, self_time=False).local
+    frexp, bucket_index, timer = math.frexp, BUCKET_INDEX, default_timer
+
+    def wrapper(*args, **kwargs):
+        start = timer()
+        res = fun(*args, **kwargs)
+        elapsed = timer() - start
+        slot = local.slot
+        slot[TOTAL] += elapsed
+        slot[bucket_index[frexp(elapsed * 1e6)[1]]] += 1
+        return res
     return wrapper
 
 
+@decorator
+def profile(fun):
+    '''
+    timed + self time: the time spent in other profiled functions
+    called from the function decorated is not counted as its own.
+    Recursive calls are counted in total once, as in cProfile, calls
+    that raised are counted too. Calls made by different threads at
+    the same time are all counted in total.
+    '''
+    if not PROFILING:
+        return fun
+    local = register(fun).local
+    frexp, bucket_index, state, timer = math.frexp, BUCKET_INDEX, _local, default_timer
+
+    def wrapper(*args, **kwargs):
+        stack, slot = state.stack, local.slot
+        stack.append(0.0)
+        slot[DEPTH] += 1
+        start = timer()
+        try:
+            return fun(*args, **kwargs)
+        finally:
+            elapsed = timer() - start
+            slot[DEPTH] -= 1
+            slot[SELF_TIME] += elapsed - stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            if not slot[DEPTH]:
+                slot[TOTAL] += elapsed
+            slot[bucket_index[frexp(elapsed * 1e6)[1]]] += 1
+    return wrapper
+
+
+def profile_report(sort='total', out=sys.stdout):
+    '''Print the functions of PROFILES sorted by total, self_time or calls, the largest first.'''
+    out.write('{0:<40} {1:>10} {2:>12} {3:>12} {4:>10} {5:>10} {6:>10}\n'.format(
+        'function', 'calls', 'total, s', 'self, s', 'avg, us', 'p50, us', 'p99, us'))
+    for stat in sorted(PROFILES.values(), key=lambda stat: getattr(stat, sort) or 0, reverse=True):
+        calls = stat.calls
+        out.write('{0:<40} {1:>10} {2:>12.6f} {3:>12} {4:>10.3f} {5:>10.0f} {6:>10.0f}\n'.format(
+            stat.name, calls, stat.total, '{:.6f}'.format(stat.self_time) if stat.self_time is not None else '-',
+            stat.total / calls * 1e6 if calls else 0, stat.percentile(50) * 1e6, stat.percentile(99) * 1e6))
+
+
+def profile_reset():
+    for stat in PROFILES.values():
+        stat.reset()
+
+
 def trace(indent):
     '''Trace calls made to function decorated.
 
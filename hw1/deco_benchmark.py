@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmarks for deco.py.
+# python deco_benchmark.py memo -> memo vs lru_memo on fib: cold cache, hits, many distinct args
+# python deco_benchmark.py profile -> overhead per call of countcalls, timed and profile
+# python deco_benchmark.py n_ary --args 1000000 -> recursive vs iterative n_ary vs tree_n_ary with and without a pool
+
+import argparse
+import multiprocessing
+import sys
+import time
+
+from deco import memo, lru_memo, countcalls, timed, profile, profile_report, decorator, n_ary, tree_n_ary
+
+
+def timed_(fun, *args, **kwargs):
+    start = time.time()
+    res = fun(*args, **kwargs)
+    return res, time.time() - start
+
+
+def make_fibs(maxsize):  # -> name -> fresh fib on its own cache
+    @memo
+    def fib_memo(n):
+        return 1 if n <= 1 else fib_memo(n - 1) + fib_memo(n - 2)
+
+    @lru_memo(maxsize=maxsize)
+    def fib_lru(n):
+        return 1 if n <= 1 else fib_lru(n - 1) + fib_lru(n - 2)
+
+    @lru_memo(maxsize=maxsize, ttl=3600)
+    def fib_lru_ttl(n):
+        return 1 if n <= 1 else fib_lru_ttl(n - 1) + fib_lru_ttl(n - 2)
+
+    return [('memo', fib_memo), ('lru_memo', fib_lru), ('lru_memo ttl', fib_lru_ttl)]
+
+
+def bench_memo(args):
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), args.n * 4))
+    for name, fib in make_fibs(args.maxsize):
+        _, cold = timed_(fib, args.n)
+
+        def hits():
+            for _ in xrange(args.calls):
+                fib(args.n)
+        _, hot = timed_(hits)
+
+        def distinct():  # every call is a new key, memo keeps them all
+            for i in xrange(args.distinct):
+                fib(args.n + i)
+        _, spread = timed_(distinct)
+        size = fib.cache_info().currsize if hasattr(fib, 'cache_info') else None
+        print('{0:<13}: cold fib({1}) {2:.1f} us, hit {3:.3f} us/call, {4} fresh keys {5:.3f}s, {6} entries'.format(
+            name, args.n, cold * 1e6, hot / args.calls * 1e6, args.distinct, spread,
+            size if size is not None else 'unbounded'))
+
+
+def bench_profile(args):
+    def add(a, b):
+        return a + b
+
+    def loop(fun):
+        for i in xrange(args.calls):
+            fun(i, 1)
+
+    _, base = timed_(loop, add)
+    print('{0:<10}: {1:.3f} us/call'.format('bare', base / args.calls * 1e6))
+    for name, deco in (('countcalls', countcalls), ('timed', timed), ('profile', profile)):
+        _, seconds = timed_(loop, deco(add))
+        print('{0:<10}: {1:.3f} us/call, overhead {2:.3f} us'.format(
+            name, seconds / args.calls * 1e6, (seconds - base) / args.calls * 1e6))
+    profile_report()
+
+
+@decorator
+def recursive_n_ary(fun):  # n_ary as it was before the loop
+    def wrapper(x, *args):
+        return x if not args else fun(x, wrapper(*args))
+    return wrapper
+
+
+def add(a, b):
+    return a + b
+
+
+def bench_n_ary(args):
+    items = range(args.args)
+    for name, deco in (('recursive n_ary', recursive_n_ary), ('n_ary', n_ary), ('tree_n_ary', tree_n_ary()),
+                       ('tree_n_ary pool', tree_n_ary(processes=args.processes, chunk_size=args.chunk_size))):
+        if deco is recursive_n_ary and args.args * 2 >= sys.getrecursionlimit():
+            # two levels of the C stack per argument, every level also copies the rest of args
+            print('{0:<16}: skipped, {1} arguments are over the recursion limit {2}'.format(
+                name, args.args, sys.getrecursionlimit()))
+            continue
+        res, seconds = timed_(deco(add), *items)
+        assert res == sum(items)
+        print('{0:<16}: {1:.3f}s'.format(name, seconds))
+
+
+def create_parser():
+    parser_ = argparse.ArgumentParser()
+    commands = parser_.add_subparsers()
+    memo_ = commands.add_parser('memo', help='memo vs lru_memo on fib')
+    memo_.add_argument('-n', type=int, default=200)
+    memo_.add_argument('--calls', type=int, default=1000000)
+    memo_.add_argument('--distinct', type=int, default=2000)
+    memo_.add_argument('--maxsize', type=int, default=256)
+    memo_.set_defaults(run=bench_memo)
+    profile_ = commands.add_parser('profile', help='overhead of countcalls, timed and profile')
+    profile_.add_argument('--calls', type=int, default=1000000)
+    profile_.set_defaults(run=bench_profile)
+    n_ary_ = commands.add_parser('n_ary', help='recursive vs iterative n_ary vs tree_n_ary')
+    n_ary_.add_argument('--args', type=int, default=1000000)
+    n_ary_.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    n_ary_.add_argument('--chunk-size', type=int, default=100000)
+    n_ary_.set_defaults(run=bench_n_ary)
+    return parser_
+
+
+if __name__ == '__main__':
+    namespace = create_parser().parse_args()
+    namespace.run(namespace)
@@ -0,0 +1,389 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmarks for log_analyzer.
+# python benchmark.py topk --urls 10000000 -> heap top-K vs full sort in count_stat
+# python benchmark.py codecs --lines 1000000 -> decompression throughput of every codec
+# python benchmark.py mmap --lines 1000000 -> line reader + parser vs aggregate_mmap: speed, RSS, allocations/line
+# python benchmark.py generate ./log --lines 1000000 --gz -> realistic synthetic nginx-access-ui.log-YYYYMMDD
+# python benchmark.py e2e --lines 1000000 --label v1 -> parse_log + count_stat + render_report, appended to results
+# python benchmark.py compare -> runs from the results file side by side
+
+import argparse
+import copy
+import ctypes
+import gzip
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from distutils.spawn import find_executable
+
+from datetime import datetime, timedelta
+
+from log_analyzer import aggregate, aggregate_mmap, count_stat, open_log, DECOMPRESSORS, external_command, \
+    parse_log, render_report, Metrics
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+LINE = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET {url} HTTP/1.1" 200 927 "-" '
+        '"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" '
+        '"dc7161be3" {time:.3f}\n')
+
+
+def synthetic_lines(num_lines, num_urls=None, seed=0):  # ui_short lines for /api/v2/banner/<id>, ids < num_urls
+    rnd = random.Random(seed)
+    num_urls = num_lines if num_urls is None else num_urls
+    for i in xrange(num_lines):
+        yield LINE.format(url='/api/v2/banner/{}'.format(i % num_urls), time=rnd.expovariate(5))
+
+
+# {id} -> url id, log-uniform over the cardinality so that a few urls get most of the requests as in real logs
+URL_TEMPLATES = (
+    '/api/v2/banner/{id}',
+    '/api/v2/group/{id}/statistic/sites/?date_type=day&date_from=2017-06-28&date_to=2017-06-28',
+    '/api/1/photogenic_banners/list/?server_name=WIN7RB{id}',
+    '/api/v2/slot/{id}/groups',
+    '/export/appinstall_raw/2017-06-29/?id={id}',
+)
+AGENTS = (
+    'Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5',
+    'Python-urllib/2.7',
+    'Slotovod',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/59.0.3071.115 Safari/537.36',
+    'python-requests/2.13.0',
+)
+STATUSES = (200,) * 90 + (302,) * 4 + (404,) * 4 + (500, 504)
+FULL_LINE = ('{ip} {user}  - [{time_local}] "{method} {url} HTTP/1.1" {status} {bytes} "-" "{agent}" "-" '
+             '"{request_id}" "{rb_user}" {time:.3f}\n')
+# name -> (random.Random, mean) -> $request_time
+LATENCIES = {
+    'exp': lambda rnd, mean: rnd.expovariate(1.0 / mean),
+    'lognormal': lambda rnd, mean: rnd.lognormvariate(math.log(mean) - 0.5, 1.0),  # sigma = 1, same mean
+    'pareto': lambda rnd, mean: mean * 0.6 * rnd.paretovariate(2.5),  # heavy tail, alpha = 2.5, same mean
+}
+
+
+def realistic_lines(num_lines, num_urls=10000, latency='lognormal', mean=0.2, malformed=0.0, seed=0,
+                    day=datetime(2017, 6, 30)):
+    # ui_short lines of one day, malformed -> share of truncated lines the parser must reject
+    rnd = random.Random(seed)
+    request_time = LATENCIES[latency]
+    step = 86400.0 / max(num_lines, 1)
+    time_local = None
+    for i in xrange(num_lines):
+        moment = day + timedelta(seconds=int(i * step))
+        if time_local is None or moment != time_local[0]:
+            time_local = moment, moment.strftime('%d/%b/%Y:%H:%M:%S +0300')
+        url_id = int(num_urls ** rnd.random()) - 1
+        line = FULL_LINE.format(
+            ip='1.{}.{}.{}'.format(rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)),
+            user='-' if rnd.random() < 0.7 else '3b81f63526fa8', time_local=time_local[1],
+            method='GET' if rnd.random() < 0.9 else 'POST',
+            url=URL_TEMPLATES[url_id % len(URL_TEMPLATES)].format(id=url_id), status=rnd.choice(STATUSES),
+            bytes=rnd.randint(0, 30000), agent=rnd.choice(AGENTS),
+            request_id='1498697422-{}-4708-{}'.format(rnd.randint(0, 1 << 31), 9752759 + i),
+            rb_user='-' if rnd.random() < 0.5 else '{:x}'.format(rnd.getrandbits(40)), time=request_time(rnd, mean))
+        if malformed and rnd.random() < malformed:
+            line = line[:rnd.randint(1, len(line) - 8)] + '\n'
+        yield line
+
+
+def generate_log(log_dir, args):  # -> path of nginx-access-ui.log-20170630[.gz] written to log_dir
+    path = os.path.join(log_dir, 'nginx-access-ui.log-20170630' + ('.gz' if args.gz else ''))
+    log_file = gzip.open(path, 'wb') if args.gz else open(path, 'wb')
+    with log_file:
+        log_file.writelines(realistic_lines(args.lines, args.urls, args.latency, args.mean, args.malformed,
+                                            args.seed))
+    return path
+
+
+def timed(fun, *args, **kwargs):
+    start = time.time()
+    res = fun(*args, **kwargs)
+    return res, time.time() - start
+
+
+def bench_topk(args):
+    (data, good_strings, _, all_time), seconds = timed(aggregate, synthetic_lines(args.urls), exact=args.exact)
+    print('aggregate: {0} urls in {1:.3f}s'.format(len(data), seconds))
+    results = {}
+    for select in ('sort', 'heap'):
+        fresh = copy.deepcopy(data)  # describe sorts the time lists in place, the next select must not get them sorted
+        results[select], seconds = timed(count_stat, fresh, good_strings, all_time, report_size=args.report_size,
+                                         select=select)
+        print('count_stat select={0}: {1:.3f}s'.format(select, seconds))
+    assert [row['time_sum'] for row in results['sort']] == [row['time_sum'] for row in results['heap']]
+
+
+COMPRESS_COMMANDS = {
+    'gz': ['gzip', '-c'],
+    'bz2': ['bzip2', '-c'],
+    'xz': ['xz', '-c'],
+    'zst': ['zstd', '-qc'],
+}
+
+
+def read_all(lines):  # -> lines, bytes
+    num_lines = num_bytes = 0
+    for line in lines:
+        num_lines += 1
+        num_bytes += len(line)
+    return num_lines, num_bytes
+
+
+def bench_codecs(args):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        plain = os.path.join(tmp_dir, 'nginx-access-ui.log')
+        with open(plain, 'wb') as log_file:
+            log_file.writelines(synthetic_lines(args.lines))
+        readers = [('plain', 'open_log', lambda: open_log(plain))]
+        for ex in sorted(COMPRESS_COMMANDS):
+            command = COMPRESS_COMMANDS[ex]
+            if not find_executable(command[0]):
+                print('{0}: {1} is not found, skipped'.format(ex, command[0]))
+                continue
+            path = '{0}.{1}'.format(plain, ex)
+            with open(path, 'wb') as compressed:
+                subprocess.check_call(command + [plain], stdout=compressed)
+            if ex == 'gz':
+                readers.append((ex, 'gzip.open', lambda path=path: gzip.open(path, 'rb')))
+            if DECOMPRESSORS[ex] is not None:
+                readers.append((ex, 'open_log', lambda path=path, ex=ex: open_log(path, ex)))
+            if external_command(ex) is not None:
+                readers.append((ex, ' '.join(external_command(ex)),
+                                lambda path=path, ex=ex: open_log(path, ex, external=True)))
+        for ex, name, reader in readers:
+            log_file = reader()
+            try:
+                (num_lines, num_bytes), seconds = timed(read_all, log_file)
+            finally:
+                log_file.close()
+            print('{0:>5} {1:<12}: {2:.1f} MB/s, {3:.0f} lines/sec'.format(
+                ex, name, num_bytes / seconds / 2 ** 20, num_lines / seconds))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def measure(fun, queue):  # runs in a child process so that ru_maxrss belongs to fun only
+    if tracemalloc is not None:
+        tracemalloc.start()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    (_, _, num_lines, _), seconds = timed(fun)
+    traced = tracemalloc.get_traced_memory()[1] if tracemalloc is not None else None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    queue.put((num_lines, seconds, rss, traced))
+
+
+# LD_PRELOAD library counting the calls of PyObject_Malloc, the allocator of str, unicode, buffer, match and most
+# other objects; ints, floats and tuples come from free lists and are not counted, for every parser alike
+ALLOC_COUNTER = r'''
+#define _GNU_SOURCE
+#include <dlfcn.h>
+#include <stddef.h>
+
+static void *(*next_malloc)(size_t);
+static unsigned long long allocs;
+
+void *PyObject_Malloc(size_t size) {
+    if (next_malloc == NULL)
+        next_malloc = (void *(*)(size_t))dlsym(RTLD_NEXT, "PyObject_Malloc");
+    allocs++;
+    return next_malloc(size);
+}
+
+unsigned long long alloc_count(void) {
+    return allocs;
+}
+'''
+
+
+def build_alloc_counter(tmp_dir):  # -> path of the library, None if there is no C compiler
+    compiler = find_executable('cc') or find_executable('gcc')
+    if compiler is None:
+        return None
+    source, library = os.path.join(tmp_dir, 'alloc_counter.c'), os.path.join(tmp_dir, 'alloc_counter.so')
+    with open(source, 'w') as source_file:
+        source_file.write(ALLOC_COUNTER)
+    subprocess.check_call([compiler, '-shared', '-fPIC', '-O2', '-o', library, source, '-ldl'])
+    return library
+
+
+def count_allocs(counter, plain, parser, use_mmap):  # -> allocations per line, counted in a python with counter
+    command = [sys.executable, os.path.abspath(__file__), 'allocs', counter, plain, '--parser', parser]
+    if use_mmap:
+        command.append('--mmap')
+    return float(subprocess.check_output(command, env=dict(os.environ, LD_PRELOAD=counter)))
+
+
+def bench_allocs(args):  # runs under LD_PRELOAD=args.counter, see count_allocs
+    alloc_count = ctypes.CDLL(args.counter).alloc_count
+    alloc_count.restype = ctypes.c_ulonglong
+
+    def run():
+        if args.mmap:
+            return aggregate_mmap(args.log)
+        with open_log(args.log) as log_file:
+            return aggregate(log_file, parser=args.parser)
+    run()  # imports, compiled regexes and the like are not counted
+    before = alloc_count()
+    _, _, all_strings, _ = run()
+    print(float(alloc_count() - before) / all_strings)
+
+
+def bench_mmap(args):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        plain = os.path.join(tmp_dir, 'nginx-access-ui.log')
+        with open(plain, 'wb') as log_file:
+            log_file.writelines(synthetic_lines(args.lines, args.urls))
+
+        def lines_and_parser():
+            with open_log(plain) as log_file:
+                return aggregate(log_file, parser=args.parser)
+
+        counter = build_alloc_counter(tmp_dir)
+        if counter is None:
+            print('cc is not found, allocations are not counted')
+        for name, fun in (('open_log + {}'.format(args.parser), lines_and_parser),
+                          ('aggregate_mmap', lambda: aggregate_mmap(plain))):
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=measure, args=(fun, queue))
+            process.start()
+            num_lines, seconds, rss, traced = queue.get()
+            process.join()
+            allocs = count_allocs(counter, plain, args.parser, name == 'aggregate_mmap') if counter else None
+            print('{0:<16}: {1:.0f} lines/sec, peak RSS +{2} KB{3}{4}'.format(
+                name, num_lines / seconds, rss,
+                ', {:.2f} allocations/line'.format(allocs) if allocs is not None else '',
+                ', traced peak {:.1f} bytes/line'.format(float(traced) / num_lines) if traced is not None else ''))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_generate(args):
+    if not os.path.exists(args.log_dir):
+        os.makedirs(args.log_dir)
+    path, seconds = timed(generate_log, args.log_dir, args)
+    print('{0}: {1} lines, {2:.1f} MB in {3:.1f}s'.format(path, args.lines, os.path.getsize(path) / 2.0 ** 20,
+                                                          seconds))
+
+
+def bench_e2e(args):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = generate_log(tmp_dir, args)
+        metrics = Metrics()
+        with metrics.stage('parse_log') as counters:
+            data, good_strings, all_time, _, all_strings = parse_log(
+                path, 'gz' if args.gz else None, workers=args.workers, parser=args.parser, use_mmap=args.mmap)
+            counters['lines'] = all_strings
+            counters['bytes'] = os.path.getsize(path)
+        with metrics.stage('count_stat') as counters:
+            table = count_stat(data, good_strings, all_time, report_size=args.report_size)
+            counters['urls'] = len(data)
+        with metrics.stage('render_report') as counters:
+            render_report(table, os.path.join(tmp_dir, 'report.html'))
+            counters['lines'] = len(table)
+    finally:
+        shutil.rmtree(tmp_dir)
+    total = sum(stage['wall_time'] for stage in metrics.stages.values())
+    result = dict(label=args.label, date=datetime.now().strftime('%Y-%m-%d %H:%M:%S'), total_time=round(total, 6),
+                  lines_per_sec=round(args.lines / total, 1), stages=metrics.stages,
+                  params=dict((name, getattr(args, name)) for name in ('lines', 'urls', 'latency', 'mean', 'malformed',
+                                                                       'seed', 'gz', 'workers', 'parser', 'mmap',
+                                                                       'report_size')))
+    for name, stage in metrics.stages.items():
+        print('{0:<14}: {1:.3f}s wall, {2:.3f}s cpu, peak RSS {3} KB'.format(
+            name, stage['wall_time'], stage['cpu_time'], stage['peak_rss_kb']))
+    print('total: {0:.3f}s, {1:.0f} lines/sec'.format(total, result['lines_per_sec']))
+    with open(args.results, 'a') as results_file:
+        results_file.write(json.dumps(result, sort_keys=True) + '\n')
+
+
+def bench_compare(args):  # runs with the same params as the first one, relative to it
+    with open(args.results) as results_file:
+        runs = [json.loads(line) for line in results_file if line.strip()]
+    groups = []
+    for run in runs:
+        for group in groups:
+            if group[0]['params'] == run['params']:
+                group.append(run)
+                break
+        else:
+            groups.append([run])
+    for group in groups:
+        print(', '.join('{0}={1}'.format(name, value) for name, value in sorted(group[0]['params'].items())))
+        base = group[0]['total_time']
+        for run in group:
+            print('  {0:<20} {1} {2:>9.3f}s {3:>12.0f} lines/sec {4:>+8.1f}%'.format(
+                run['label'], run['date'], run['total_time'], run['lines_per_sec'],
+                (run['total_time'] / base - 1) * 100 if base else 0))
+
+
+def add_log_arguments(parser_):
+    parser_.add_argument('--lines', type=int, default=1000000)
+    parser_.add_argument('--urls', type=int, default=10000, help='url cardinality')
+    parser_.add_argument('--latency', choices=sorted(LATENCIES), default='lognormal')
+    parser_.add_argument('--mean', type=float, default=0.2, help='mean $request_time, seconds')
+    parser_.add_argument('--malformed', type=float, default=0.0, help='share of broken lines, 0..1')
+    parser_.add_argument('--seed', type=int, default=0)
+    parser_.add_argument('--gz', action='store_true', help='write nginx-access-ui.log-YYYYMMDD.gz')
+
+
+def create_parser():
+    parser_ = argparse.ArgumentParser()
+    commands = parser_.add_subparsers()
+    topk = commands.add_parser('topk', help='count_stat: heap top-K vs full sort')
+    topk.add_argument('--urls', type=int, default=10000000)
+    topk.add_argument('--report-size', type=int, default=1000)
+    topk.add_argument('--exact', action='store_true', help='keep the lists of times instead of UrlStat')
+    topk.set_defaults(run=bench_topk)
+    codecs = commands.add_parser('codecs', help='decompression throughput of every codec')
+    codecs.add_argument('--lines', type=int, default=1000000)
+    codecs.set_defaults(run=bench_codecs)
+    mmap_ = commands.add_parser('mmap', help='line reader + parser vs aggregate_mmap')
+    mmap_.add_argument('--lines', type=int, default=1000000)
+    mmap_.add_argument('--urls', type=int, default=10000)
+    mmap_.add_argument('--parser', default='regex')
+    mmap_.set_defaults(run=bench_mmap)
+    allocs = commands.add_parser('allocs', help='allocations per line, run by mmap under LD_PRELOAD=counter')
+    allocs.add_argument('counter')
+    allocs.add_argument('log')
+    allocs.add_argument('--parser', default='regex')
+    allocs.add_argument('--mmap', action='store_true')
+    allocs.set_defaults(run=bench_allocs)
+    generate = commands.add_parser('generate', help='write a synthetic ui_short log to log_dir')
+    generate.add_argument('log_dir')
+    add_log_arguments(generate)
+    generate.set_defaults(run=bench_generate)
+    e2e = commands.add_parser('e2e', help='parse_log + count_stat + render_report on a synthetic log')
+    add_log_arguments(e2e)
+    e2e.add_argument('--workers', type=int, default=1)
+    e2e.add_argument('--parser', default='regex')
+    e2e.add_argument('--mmap', action='store_true')
+    e2e.add_argument('--report-size', type=int, default=1000)
+    e2e.add_argument('--label', default='', help='name of the run in compare, e.g. a git tag')
+    e2e.add_argument('--results', default='benchmark_results.jsonl')
+    e2e.set_defaults(run=bench_e2e)
+    compare = commands.add_parser('compare', help='e2e runs with the same params side by side')
+    compare.add_argument('--results', default='benchmark_results.jsonl')
+    compare.set_defaults(run=bench_compare)
+    return parser_
+
+
+if __name__ == '__main__':
+    namespace = create_parser().parse_args()
+    namespace.run(namespace)
@@ -13,6 +13,21 @@ def create_config(path):
     config.set('Config_log_analyzer', 'LOGGING_TO_FILE', './log_analyzer.log')
     config.set('Config_log_analyzer', 'LOGGING_LEVEL', 'DEBUG')
     config.set('Config_log_analyzer', 'LEVEL_PARSE', '50')
+    config.set('Config_log_analyzer', 'WORKERS', '1')
+    config.set('Config_log_analyzer', 'EXACT_STAT', '0')
+    config.set('Config_log_analyzer', 'REPORT_PERCENTILES', '0')
+    config.set('Config_log_analyzer', 'PARSER', 'regex')
+    config.set('Config_log_analyzer', 'NORMALIZE_URLS', '0')
+    config.set('Config_log_analyzer', 'NORMALIZE_CACHE', '10000')
+    config.set('Config_log_analyzer', 'PROCESS_ALL', '0')
+    config.set('Config_log_analyzer', 'CHECKPOINT_LINES', '0')
+    config.set('Config_log_analyzer', 'SAVE_AGGREGATES', '1')
+    config.set('Config_log_analyzer', 'DECOMPRESS_EXTERNAL', '0')
+    config.set('Config_log_analyzer', 'USE_MMAP', '0')
+    config.set('Config_log_analyzer', 'FOLLOW_INTERVAL', '60')
+    config.set('Config_log_analyzer', 'FOLLOW_FORMAT', 'html')
+    config.set('Config_log_analyzer', 'SAVE_METRICS', '1')
+    config.set('Config_log_analyzer', 'PROFILE', '0')
 
     with open(path, 'w') as config_file:
         config.write(config_file)
@@ -9,23 +9,71 @@
 # sys.argv -> ['file_name.py', 'dir_log_nginx', 'config']
 
 import re
-import gzip
+import array
+import bz2
+import calendar
+import hashlib
+import heapq
 import json
 import argparse
 import configparser
+import cProfile
 import logging
+import math
+import mmap
+import multiprocessing
 import os
+import resource
+import struct
+import subprocess
+import time
+import zlib
 from datetime import datetime
-from collections import namedtuple, defaultdict
+from distutils.spawn import find_executable
+from collections import namedtuple, defaultdict, OrderedDict
+from contextlib import contextmanager
+from itertools import chain, islice, izip
 from string import Template
 from fractions import Fraction
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 config = {
     "REPORT_SIZE": 1000,
     "REPORT_DIR": "./reports",
     "LOG_DIR": "./log",
     "LEVEL_PARSE": 50,
+    "WORKERS": 1,
+    "EXACT_STAT": 0,
+    "REPORT_PERCENTILES": 0,
+    "PARSER": "regex",
+    "NORMALIZE_URLS": 0,
+    "NORMALIZE_CACHE": 10000,
+    "PROCESS_ALL": 0,
+    "CHECKPOINT_LINES": 0,
+    "SAVE_AGGREGATES": 1,
+    "DECOMPRESS_EXTERNAL": 0,
+    "USE_MMAP": 0,
+    "FOLLOW_FILE": None,
+    "FOLLOW_INTERVAL": 60,
+    "FOLLOW_FORMAT": "html",
+    "SAVE_METRICS": 1,
+    "PROFILE": 0,
     "LOGGING_LEVEL": logging.DEBUG,
     "LOGGING_TO_FILE": None
 }
@@ -33,10 +81,181 @@ Log = namedtuple('log', 'file_for_analyze date ex')
 Req = namedtuple('req', 'url time')
 
 
+class UrlStat(object):
+    """
+    Constant-size summary of the request times of one url: count, sum, max and
+    a log-bucketed quantile sketch (DDSketch-like). Bucket i holds the times in
+    (GAMMA ** (i - 1), GAMMA ** i], so any quantile is known with relative error
+    ALPHA. Two summaries are merged by adding their buckets.
+    It mimics the list interface used by parse_log: append(time) and extend(other).
+    """
+    ALPHA = 0.01
+    GAMMA = (1 + ALPHA) / (1 - ALPHA)
+    LOG_GAMMA = math.log(GAMMA)
+    MIN_TIME = 1e-6  # smaller times are counted in the zero bucket
+    MAX_BUCKETS = 2048
+    __slots__ = ('count', 'time_sum', 'time_max', 'zeros', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.time_sum = 0
+        self.time_max = 0
+        self.zeros = 0
+        self.buckets = {}
+
+    def __getstate__(self):
+        return self.count, self.time_sum, self.time_max, self.zeros, self.buckets
+
+    def __setstate__(self, state):
+        self.count, self.time_sum, self.time_max, self.zeros, self.buckets = state
+
+    def __len__(self):
+        return self.count
+
+    def __eq__(self, other):
+        return isinstance(other, UrlStat) and self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def append(self, time):
+        self.count += 1
+        self.time_sum += time
+        if time > self.time_max:
+            self.time_max = time
+        if time < self.MIN_TIME:
+            self.zeros += 1
+            return
+        index = int(math.ceil(math.log(time) / self.LOG_GAMMA))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        if len(self.buckets) > self.MAX_BUCKETS:
+            self._collapse()
+
+    def extend(self, other):
+        if not isinstance(other, UrlStat):
+            for time in other:
+                self.append(time)
+            return
+        self.count += other.count
+        self.time_sum += other.time_sum
+        self.time_max = max(self.time_max, other.time_max)
+        self.zeros += other.zeros
+        for index, num in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + num
+        while len(self.buckets) > self.MAX_BUCKETS:
+            self._collapse()
+
+    def _collapse(self):  # fold the lowest bucket into the next one, the high quantiles stay accurate
+        lowest, second = sorted(self.buckets)[:2]
+        self.buckets[second] += self.buckets.pop(lowest)
+
+    def quantile(self, q):  # same rank as the exact lower median for q = 0.5
+        if not self.count:
+            return 0
+        rank = int(q * (self.count - 1))
+        if rank == self.count - 1:  # the largest time is known exactly
+            return self.time_max
+        if rank < self.zeros:
+            return 0
+        seen = self.zeros
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                value = 2 * self.GAMMA ** index / (self.GAMMA + 1)
+                return min(value, self.time_max)
+        return self.time_max
+
+
+def new_data(exact=False):
+    return defaultdict(list if exact else UrlStat)
+
+
+def to_url_stat(times):
+    if isinstance(times, UrlStat):
+        return times
+    stat = UrlStat()
+    stat.extend(times)
+    return stat
+
+
+# report-YYYY.MM.DD.agg: zlib compressed
+#   header: magic, version, good_strings, all_time, number of urls
+#   for every url: url length, url (utf-8), count, time_sum, time_max, zeros, number of buckets, (index, count) * n
+AGG_MAGIC = b'LAGG'
+AGG_VERSION = 1
+AGG_HEADER = struct.Struct('<4sBQdI')
+AGG_URL = struct.Struct('<H')
+AGG_STAT = struct.Struct('<QddQH')
+AGG_BUCKET = struct.Struct('<hI')
+
+
+def pack_url(url):
+    url = url.encode('utf-8') if isinstance(url, unicode) else url
+    return AGG_URL.pack(len(url)) + url
+
+
+def unpack_url(buf, offset):  # -> url, offset after it
+    url_length, = AGG_URL.unpack_from(buf, offset)
+    offset += AGG_URL.size
+    return buf[offset:offset + url_length].decode('utf-8'), offset + url_length
+
+
+def pack_url_stat(url, stat):  # the buckets are packed in one call, as AGG_BUCKET * n
+    return b''.join((pack_url(url), AGG_STAT.pack(stat.count, stat.time_sum, stat.time_max, stat.zeros,
+                                                  len(stat.buckets)),
+                     struct.pack('<' + 'hI' * len(stat.buckets), *chain.from_iterable(stat.buckets.iteritems()))))
+
+
+def unpack_url_stat(buf, offset):  # -> url, UrlStat, offset after them
+    url, offset = unpack_url(buf, offset)
+    stat = UrlStat()
+    stat.count, stat.time_sum, stat.time_max, stat.zeros, num_buckets = AGG_STAT.unpack_from(buf, offset)
+    offset += AGG_STAT.size
+    buckets = iter(struct.unpack_from('<' + 'hI' * num_buckets, buf, offset))
+    stat.buckets = dict(izip(buckets, buckets))
+    return url, stat, offset + AGG_BUCKET.size * num_buckets
+
+
+def save_aggregates(path, data, good_strings, all_time):
+    compressor = zlib.compressobj()
+    with open(path + '.tmp', 'wb') as agg_file:
+        agg_file.write(compressor.compress(AGG_HEADER.pack(AGG_MAGIC, AGG_VERSION, good_strings, all_time, len(data))))
+        for url, times in data.iteritems():
+            agg_file.write(compressor.compress(pack_url_stat(url, to_url_stat(times))))
+        agg_file.write(compressor.flush())
+    os.rename(path + '.tmp', path)
+
+
+def load_aggregates(path, data=None):  # -> data, good_strings, all_time; merges into data when it is given
+    data = new_data() if data is None else data
+    with open(path, 'rb') as agg_file:
+        buf = zlib.decompress(agg_file.read())
+    magic, version, good_strings, all_time, num_urls = AGG_HEADER.unpack_from(buf)
+    if magic != AGG_MAGIC or version != AGG_VERSION:
+        raise ValueError('{} is not an aggregates file'.format(path))
+    offset = AGG_HEADER.size
+    for _ in xrange(num_urls):
+        url, stat, offset = unpack_url_stat(buf, offset)
+        data[url].extend(stat)
+    return data, good_strings, all_time
+
+
 def create_parser():
     default = "{}/config_log_analyzer".format(os.path.dirname(os.path.abspath(__file__)))
     parser_ = argparse.ArgumentParser()
     parser_.add_argument('-c', '--config', default=default)
+    parser_.add_argument('-b', '--benchmark', action='store_true',
+                         help='print lines/sec of every parser on the last log and exit')
+    parser_.add_argument('-r', '--rollup', nargs=2, metavar=('FROM', 'TO'),
+                         help='merge the saved daily aggregates from FROM to TO (YYYY.MM.DD) into one report')
+    parser_.add_argument('-f', '--follow', action='store_true',
+                         help='tail the current log and keep live reports for the last 5/15/60 minutes')
+    parser_.add_argument('--ingest', action='store_true',
+                         help='build the columnar index report_dir/index-YYYY.MM.DD of the last log (numpy)')
+    parser_.add_argument('--query', metavar='YYYY.MM.DD', help='print a table from the columnar index of the day')
+    parser_.add_argument('--group-by', choices=sorted(INDEX_GROUPS), default='url')
+    parser_.add_argument('--sort', choices=INDEX_SORTS, default='time_sum')
+    parser_.add_argument('--status', type=int, help='only the requests with this status')
     return parser_
 
 
@@ -58,15 +277,12 @@ def parse_config(default_config, path):
     return default_config
 
 
-def find_log(dir_log_nginx):
-    maximum = None
-    file_for_analyze = None
-    date = 0
-    ex = None
+def find_logs(dir_log_nginx):  # -> all the logs in dir_log_nginx sorted by date
+    logs = []
     if not os.path.exists(dir_log_nginx):
         raise Exception('{} no such directory!'.format(dir_log_nginx))
     for file_ in os.listdir(dir_log_nginx):
-        f = re.match(r'nginx-access-ui.log-(?P<cur_date>\d{8})(\.(?P<cur_ex>gz)|$)', file_)
+        f = re.match(r'nginx-access-ui.log-(?P<cur_date>\d{8})(\.(?P<cur_ex>gz|bz2|xz|zst)|$)', file_)
         if not f or not os.path.isfile(os.path.join(dir_log_nginx, file_)):
             continue
         try:
@@ -74,11 +290,130 @@ def find_log(dir_log_nginx):
         except ValueError:
             continue
             # raise ValueError('Invalid date in file_log -> {}'.format(file_))
-        maximum = (max(maximum, cur_date) if maximum is not None else cur_date)
-        if cur_date == maximum:
-            file_for_analyze = file_
-            date, ex = cur_date, cur_ex
-    return Log(file_for_analyze, date, ex) if file_for_analyze else None
+        logs.append(Log(file_, cur_date, cur_ex))
+    logs.sort(key=lambda log: log.date)
+    return logs
+
+
+def find_log(dir_log_nginx):
+    logs = find_logs(dir_log_nginx)
+    return logs[-1] if logs else None
+
+
+# ex -> factory of a decompressor object with decompress(data) and unused_data, None if the codec is not available
+DECOMPRESSORS = {
+    'gz': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    'bz2': bz2.BZ2Decompressor,
+    'xz': lzma.LZMADecompressor if lzma is not None else None,
+    'zst': (lambda: zstandard.ZstdDecompressor().decompressobj()) if zstandard is not None else None,
+}
+# ex -> external programs writing the decompressed log to stdout, the first one found in PATH is used
+EXTERNAL_DECOMPRESSORS = {
+    'gz': (['pigz', '-dc'], ['gzip', '-dc']),
+    'bz2': (['pbzip2', '-dc'], ['bzip2', '-dc']),
+    'xz': (['xz', '-dc'], ),
+    'zst': (['zstd', '-dcq'], ),
+}
+BLOCK_SIZE = 1 << 20
+
+
+def external_command(ex):
+    for command in EXTERNAL_DECOMPRESSORS.get(ex, ()):
+        if find_executable(command[0]):
+            return command
+    return None
+
+
+class LogFile(object):
+    """
+    Reads a plain or compressed log in BLOCK_SIZE blocks and iterates over its
+    lines (with the trailing newline, like a file object). Compressed data is
+    decompressed in process or, with external=True or when the python module
+    of the codec is missing, piped from pigz/zstd -d and the like found in PATH.
+    seek() may only skip forward, that is enough to resume from a checkpoint.
+    """
+
+    def __init__(self, path_file, ex=None, external=False):
+        self.path_file = path_file
+        self.ex = ex
+        self.skip = 0
+        self.process = None
+        in_process = DECOMPRESSORS.get(ex) is not None
+        command = external_command(ex) if ex is not None and (external or not in_process) else None
+        if command is not None:
+            self.process = subprocess.Popen(command + [path_file], stdout=subprocess.PIPE, bufsize=BLOCK_SIZE)
+            self.raw = self.process.stdout
+            self.decompressor = None
+        else:
+            if ex is not None and not in_process:
+                raise Exception('No decompressor for .{0} files, {1} can not be read'.format(ex, path_file))
+            self.raw = open(path_file, 'rb')
+            self.decompressor = DECOMPRESSORS[ex] if ex is not None else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.raw.close()
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+
+    def seek(self, position):
+        if self.decompressor is None and self.process is None:
+            self.raw.seek(position)
+        else:
+            self.skip = position
+
+    def blocks(self):  # -> decompressed blocks of the log
+        decompressor = self.decompressor() if self.decompressor is not None else None
+        while True:
+            block = self.raw.read(BLOCK_SIZE)
+            if not block:
+                break
+            if decompressor is None:
+                yield block
+                continue
+            while block:  # concatenated streams (pigz, pbzip2) start a new decompressor on unused_data
+                try:
+                    data = decompressor.decompress(block)
+                except EOFError:  # bz2 after the end of a stream
+                    decompressor = self.decompressor()
+                    continue
+                if data:
+                    yield data
+                block = getattr(decompressor, 'unused_data', b'')
+                if block:
+                    decompressor = self.decompressor()
+        if self.process is not None and self.process.wait() != 0:
+            raise Exception('{0} failed on {1}'.format(' '.join(external_command(self.ex)), self.path_file))
+
+    def skipped_blocks(self):
+        skip = self.skip
+        for block in self.blocks():
+            if skip >= len(block):
+                skip -= len(block)
+                continue
+            yield block[skip:] if skip else block
+            skip = 0
+
+    def __iter__(self):
+        tail = b''
+        for block in self.skipped_blocks():
+            lines = (tail + block).splitlines(True) if tail else block.splitlines(True)
+            tail = lines.pop() if not lines[-1].endswith(b'\n') else b''
+            for line in lines:
+                yield line
+        if tail:
+            yield tail
+
+
+def open_log(path_file, ex=None, external=False):
+    return LogFile(path_file, ex, external)
 
 
 def parse_string(file_from):
@@ -98,69 +433,686 @@ def parse_string(file_from):
             yield None
 
 
-def parse_log(path_file_for_analyze, ex):
-    file_open = open if ex is None else gzip.open
-    data = defaultdict(list)
+# ui_short with only $request url and $request_time captured, the rest is skipped
+LINE_PATTERN = re.compile(
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3} '  # $remote_addr
+    r'[^"]*'                                # $remote_user $http_x_real_ip [$time_local]
+    r'"\S+ (?P<url>/\S*)[^"]*" '            # "$request"
+    r'.*'                                   # $status ... "$http_X_RB_USER"
+    r' (?P<time>\d+\.\d+)\s*$'              # $request_time
+)
+
+
+def parse_string_regex(file_from):
+    match = LINE_PATTERN.match
+    for line in file_from:
+        m = match(line)
+        if m is None:
+            yield None
+        else:
+            yield Req(m.group('url').decode('utf-8'), float(m.group('time')))
+
+
+def parse_string_scan(file_from):  # finds the fields with str.find, no regex and no split of the line
+    for line in file_from:
+        url_start = line.find('"') + 1
+        if not url_start:
+            yield None
+            continue
+        url_start = line.find(' ', url_start) + 1
+        url_end = line.find(' ', url_start)
+        if not url_start or url_end < 0 or line[url_start] != '/':
+            yield None
+            continue
+        try:
+            yield Req(line[url_start:url_end].decode('utf-8'), float(line[line.rfind(' ') + 1:]))
+        except ValueError:
+            yield None
+
+
+PARSERS = {
+    'split': parse_string,
+    'regex': parse_string_regex,
+    'scan': parse_string_scan,
+}
+
+
+# (pattern, template) applied in order by UrlNormalizer
+URL_RULES = [
+    (r'\?.*$', ''),                                 # query string
+    (r'/[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}(?=/|$)', '/{uuid}'),
+    (r'/\d+(?=/|$)', '/{id}'),                      # numeric id
+    (r'/[0-9a-fA-F]{16,}(?=/|$)', '/{hash}'),        # md5, sha1 and the like
+]
+
+
+class DistinctCounter(object):
+    """
+    HyperLogLog estimate of the number of distinct strings in 2 ** P one-byte
+    registers (standard error ~1.6% for P = 12). Counters are merged by taking
+    the maximum of every register.
+    """
+    P = 12
+    __slots__ = ('registers',)
+
+    def __init__(self):
+        self.registers = bytearray(1 << self.P)
+
+    def __getstate__(self):
+        return self.registers
+
+    def __setstate__(self, state):
+        self.registers = state
+
+    def add(self, value):
+        x = int(hashlib.md5(value.encode('utf-8') if isinstance(value, unicode) else value).hexdigest()[:16], 16)
+        index, rest = x >> (64 - self.P), x & ((1 << (64 - self.P)) - 1)
+        rank = 64 - self.P - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def __len__(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(b'\0')
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)  # linear counting for small cardinalities
+        return int(round(estimate))
+
+
+class UrlNormalizer(object):
+    """
+    Collapses ids, hashes and query strings of urls into templates like
+    /api/v2/banner/{id}. The rules are compiled once, the cache_size most
+    recently used urls are memoized (0 - no memo). raw_urls (estimate) and templates count
+    the distinct urls seen before and after normalization.
+    """
+
+    def __init__(self, rules=None, cache_size=10000):
+        self.rules = list(URL_RULES if rules is None else rules)
+        self.cache_size = cache_size
+        self.compiled = [(re.compile(pattern), template) for pattern, template in self.rules]
+        self.cache = OrderedDict()
+        self.raw_urls = DistinctCounter()
+        self.templates = set()
+
+    def __getstate__(self):  # compiled rules and the memo are rebuilt in the worker process
+        return self.rules, self.cache_size, self.raw_urls, self.templates
+
+    def __setstate__(self, state):
+        rules, cache_size, raw_urls, templates = state
+        self.__init__(rules, cache_size)
+        self.raw_urls, self.templates = raw_urls, templates
+
+    def __call__(self, url):
+        template = self.cache.pop(url, None)
+        if template is not None:
+            self.cache[url] = template  # the most recently used is the last to be dropped
+            return template
+        template = url
+        for pattern, replacement in self.compiled:
+            template = pattern.sub(replacement, template)
+        self.raw_urls.add(url)  # a url already in the memo was already counted
+        self.templates.add(template)
+        if self.cache_size:
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+            self.cache[url] = template
+        return template
+
+    def merge(self, other):
+        self.raw_urls.merge(other.raw_urls)
+        self.templates |= other.templates
+
+
+def aggregate(log_file, data=None, exact=False, parser='regex', normalizer=None):
+    data = new_data(exact) if data is None else data
     all_time = 0
     all_strings = 0
     good_strings = 0
-    with file_open(path_file_for_analyze, 'r') as log_file:
-        for string_log in parse_string(log_file):
-            all_strings += 1
-            if string_log is not None:
-                good_strings += 1
-                all_time += string_log.time
-                key = string_log.url
-                data[key].append(string_log.time)
+    for string_log in PARSERS[parser](log_file):
+        all_strings += 1
+        if string_log is not None:
+            good_strings += 1
+            all_time += string_log.time
+            key = string_log.url if normalizer is None else normalizer(string_log.url)
+            data[key].append(string_log.time)
+    return data, good_strings, all_strings, all_time
+
+
+MMAP_WINDOW = 16 << 20  # aggregate_mmap maps this much of the log at a time, mapped pages count in RSS
+
+
+def aggregate_mmap(path_file, start=0, end=None, data=None, exact=False, normalizer=None):
+    # aggregate for a plain log without line objects: the fields are found by offsets in the mapped file and read
+    # through buffer views of it, the bytes are not copied; a url is copied and decoded once, when it is first seen,
+    # the keys are unicode as with the other parsers
+    data = new_data(exact) if data is None else data
+    keys = {}  # buffer of the url bytes -> url
+    all_time = 0
+    all_strings = 0
+    good_strings = 0
+    window = MMAP_WINDOW
+    with open(path_file, 'rb') as log_file:
+        size = os.fstat(log_file.fileno()).st_size
+        end = size if end is None else min(end, size)
+        position = start
+        while position < end:
+            offset = position - position % mmap.ALLOCATIONGRANULARITY
+            length = min(window, size - offset)
+            buf = mmap.mmap(log_file.fileno(), length, access=mmap.ACCESS_READ, offset=offset)
+            find, rfind = buf.find, buf.rfind
+            line_start, limit = position - offset, end - offset
+            try:
+                while line_start < limit:
+                    line_end = find(b'\n', line_start)
+                    if line_end < 0:
+                        if offset + length < size:  # the line goes on in the next window
+                            break
+                        line_end = length
+                    url_start = find(b'"', line_start, line_end) + 1
+                    if url_start:
+                        url_start = find(b' ', url_start, line_end) + 1
+                    url_end = find(b' ', url_start, line_end) if url_start else -1
+                    request_time = None
+                    if url_end > 0 and buf[url_start] == b'/':
+                        try:
+                            request_time = float(buf[rfind(b' ', line_start, line_end) + 1:line_end])
+                        except ValueError:
+                            pass
+                    all_strings += 1
+                    if request_time is not None:
+                        good_strings += 1
+                        all_time += request_time
+                        url = keys.get(buffer(buf, url_start, url_end - url_start))
+                        if url is None:
+                            raw_url = buf[url_start:url_end]
+                            url = keys[buffer(raw_url)] = raw_url.decode('utf-8')
+                        data[url if normalizer is None else normalizer(url)].append(request_time)
+                    line_start = line_end + 1
+            finally:
+                buf.close()
+            window = MMAP_WINDOW if offset + line_start > position else window * 2  # a line longer than window
+            position = offset + line_start
+    return data, good_strings, all_strings, all_time
+
+
+def split_chunks(path_file, num_chunks):  # -> [(start, end), ...], every start is the beginning of a line
+    size = os.path.getsize(path_file)
+    bounds = [0]
+    with open(path_file, 'rb') as log_file:
+        for i in range(1, num_chunks):
+            log_file.seek(max(size * i // num_chunks, bounds[-1]))
+            log_file.readline()
+            bounds.append(min(log_file.tell(), size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def read_chunk(log_file, end):
+    position = log_file.tell()
+    while position < end:
+        line = log_file.readline()
+        if not line:
+            break
+        position += len(line)
+        yield line
+
+
+def parse_chunk(args):  # args -> (path_file, start, end, exact, parser, normalizer, use_mmap), runs in a worker
+    path_file, start, end, exact, parser, normalizer, use_mmap = args
+    if use_mmap:
+        return aggregate_mmap(path_file, start, end, exact=exact, normalizer=normalizer), normalizer
+    with open(path_file, 'rb') as log_file:
+        log_file.seek(start)
+        return aggregate(read_chunk(log_file, end), exact=exact, parser=parser, normalizer=normalizer), normalizer
+
+
+def merge_parts(parts, exact=False):
+    data = new_data(exact)
+    all_time = 0
+    all_strings = 0
+    good_strings = 0
+    for part_data, part_good, part_all, part_time in parts:
+        for key in part_data:
+            data[key].extend(part_data[key])
+        good_strings += part_good
+        all_strings += part_all
+        all_time += part_time
+    return data, good_strings, all_strings, all_time
+
+
+def parse_log(path_file_for_analyze, ex, workers=1, exact=False, parser='regex', normalizer=None, external=False,
+              use_mmap=False):
+    # exact -> keep all times, normalizer -> UrlNormalizer to apply to every url,
+    # external -> decompress with pigz/zstd -d/... subprocess if there is one,
+    # use_mmap -> scan a plain log with aggregate_mmap instead of parser
+    # -> data, good_strings, all_time, share of good strings, all_strings
+    if workers > 1 and ex is None:
+        chunks = [(path_file_for_analyze, start, end, exact, parser, normalizer, use_mmap) for start, end in
+                  split_chunks(path_file_for_analyze, workers * 4)]
+        pool = multiprocessing.Pool(workers)
+        try:
+            parts = pool.map(parse_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+        data, good_strings, all_strings, all_time = merge_parts([part for part, _ in parts], exact)
+        if normalizer is not None:
+            for _, part_normalizer in parts:
+                normalizer.merge(part_normalizer)
+    elif use_mmap and ex is None:
+        data, good_strings, all_strings, all_time = aggregate_mmap(path_file_for_analyze, exact=exact,
+                                                                   normalizer=normalizer)
+    else:
+        with open_log(path_file_for_analyze, ex, external) as log_file:
+            data, good_strings, all_strings, all_time = aggregate(log_file, exact=exact, parser=parser,
+                                                                  normalizer=normalizer)
     persent = 0
     if all_strings > 0:
         persent = Fraction(good_strings, all_strings)
-    return data, good_strings, all_time, persent
-
-
-def count_stat(data,  num_req, all_time, report_size=5):  # data ->{url: [list_of_times]},
-    data_to_render_ = []                                  # report_size -> config["REPORT_SIZE"]
-    for key in data:
-        time_sum = round(sum(data[key]), 3)
-        data[key] = (time_sum, data[key])
-    sorted_data = sorted(data.items(), key=lambda x: x[1], reverse=True)
-    i = 0
-    ceiling = min(report_size, len(sorted_data))
-    while i < ceiling:
-        time_sum = sorted_data[i][1][0]
-        list_of_times = sorted_data[i][1][1]
-        list_of_times.sort()
-        count = len(list_of_times)
+    return data, good_strings, all_time, persent, all_strings
+
+
+class LineReader(object):
+    """Iterates over the lines of log_file and keeps the byte offset of the next line in position."""
+
+    def __init__(self, log_file, position=0):
+        self.log_file = log_file
+        self.position = position
+
+    def __iter__(self):
+        for line in self.log_file:
+            self.position += len(line)
+            yield line
+
+
+# checkpoint-YYYY.MM.DD.ckpt: zlib compressed, the urls are stored as in the .agg file
+#   header: magic, version, key length, position, good_strings, all_strings, all_time, number of urls,
+#           number of normalizer templates (0xFFFFFFFF - no normalizer), key (json)
+#   for every url: url, count, time_sum, time_max, zeros, number of buckets, (index, count) * n
+#                  or with exact: url, number of times, times (doubles)
+#   normalizer: registers of raw_urls, then (url length, template) for every template
+CHECKPOINT_MAGIC = b'LCKP'
+CHECKPOINT_VERSION = 1
+CHECKPOINT_HEADER = struct.Struct('<4sBHQQQdII')
+CHECKPOINT_TIMES = struct.Struct('<I')
+NO_NORMALIZER = 0xFFFFFFFF
+
+
+def load_checkpoint(checkpoint_path, key, normalizer=None):
+    # -> state or None; the saved normalizer state is merged into normalizer
+    if not os.path.exists(checkpoint_path):
+        return None
+    key = json.dumps(key)
+    try:
+        with open(checkpoint_path, 'rb') as checkpoint:
+            buf = zlib.decompress(checkpoint.read())
+        (magic, version, key_length, position, good_strings, all_strings, all_time, num_urls,
+         num_templates) = CHECKPOINT_HEADER.unpack_from(buf)
+        if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION:
+            raise ValueError('not a checkpoint file')
+        offset = CHECKPOINT_HEADER.size + key_length
+        if buf[CHECKPOINT_HEADER.size:offset] != key:
+            return None
+        exact = json.loads(key)[1]
+        data = new_data(exact)
+        for _ in xrange(num_urls):
+            if exact:
+                url, offset = unpack_url(buf, offset)
+                num_times, = CHECKPOINT_TIMES.unpack_from(buf, offset)
+                offset += CHECKPOINT_TIMES.size
+                times = array.array('d', buf[offset:offset + 8 * num_times])
+                offset += 8 * num_times
+                data[url] = times.tolist()
+            else:
+                url, data[url], offset = unpack_url_stat(buf, offset)
+        if num_templates != NO_NORMALIZER:
+            raw_urls = DistinctCounter()
+            raw_urls.registers = bytearray(buf[offset:offset + len(raw_urls.registers)])
+            offset += len(raw_urls.registers)
+            templates = set()
+            for _ in xrange(num_templates):
+                template, offset = unpack_url(buf, offset)
+                templates.add(template)
+    except (zlib.error, struct.error, ValueError):
+        logging.exception('Could not load checkpoint {}, starting from the beginning'.format(checkpoint_path))
+        return None
+    if normalizer is not None and num_templates != NO_NORMALIZER:
+        normalizer.raw_urls.merge(raw_urls)
+        normalizer.templates |= templates
+    return dict(key=json.loads(key), position=position, data=data, good_strings=good_strings,
+                all_strings=all_strings, all_time=all_time)
+
+
+def save_checkpoint(checkpoint_path, state, normalizer=None):
+    # write + rename, a crash never leaves a half written checkpoint
+    key = json.dumps(state['key'])
+    exact = state['key'][1]
+    compressor = zlib.compressobj(1)  # the checkpoint lives until the report is written, speed over size
+    with open(checkpoint_path + '.tmp', 'wb') as checkpoint:
+        checkpoint.write(compressor.compress(CHECKPOINT_HEADER.pack(
+            CHECKPOINT_MAGIC, CHECKPOINT_VERSION, len(key), state['position'], state['good_strings'],
+            state['all_strings'], state['all_time'], len(state['data']),
+            NO_NORMALIZER if normalizer is None else len(normalizer.templates)) + key))
+        for url, times in state['data'].iteritems():
+            if exact:
+                record = pack_url(url) + CHECKPOINT_TIMES.pack(len(times)) + array.array('d', times).tostring()
+            else:
+                record = pack_url_stat(url, times)
+            checkpoint.write(compressor.compress(record))
+        if normalizer is not None:
+            checkpoint.write(compressor.compress(bytes(normalizer.raw_urls.registers)))
+            for template in normalizer.templates:
+                checkpoint.write(compressor.compress(pack_url(template)))
+        checkpoint.write(compressor.flush())
+    os.rename(checkpoint_path + '.tmp', checkpoint_path)
+
+
+def parse_log_checkpointed(path_file_for_analyze, ex, checkpoint_path, checkpoint_lines, exact=False, parser='regex',
+                           normalizer=None, external=False):
+    # same as parse_log in one process, the partial result and the byte offset are saved every checkpoint_lines
+    # lines, a restarted run continues from the last checkpoint of the same log; a checkpoint is written anew
+    # every time, so the next one comes no sooner than after as many lines as it holds records
+    # (times with exact, urls otherwise) - the time spent on checkpoints stays linear in the log size
+    key = [os.path.basename(path_file_for_analyze), exact, parser, normalizer is not None]
+    state = load_checkpoint(checkpoint_path, key, normalizer)
+    if state is None:
+        state = dict(key=key, position=0, data=new_data(exact), good_strings=0, all_strings=0, all_time=0)
+    else:
+        logging.info('resume {0} from byte {1}'.format(path_file_for_analyze, state['position']))
+    with open_log(path_file_for_analyze, ex, external) as log_file:
+        log_file.seek(state['position'])
+        reader = LineReader(log_file, state['position'])
+        lines = iter(reader)
+        while True:
+            records = state['good_strings'] if exact else len(state['data'])
+            _, good_strings, all_strings, all_time = aggregate(islice(lines, max(checkpoint_lines, records)),
+                                                               data=state['data'], exact=exact, parser=parser,
+                                                               normalizer=normalizer)
+            if not all_strings:
+                break
+            state['good_strings'] += good_strings
+            state['all_strings'] += all_strings
+            state['all_time'] += all_time
+            state['position'] = reader.position
+            save_checkpoint(checkpoint_path, state, normalizer)
+    persent = 0
+    if state['all_strings'] > 0:
+        persent = Fraction(state['good_strings'], state['all_strings'])
+    return state['data'], state['good_strings'], state['all_time'], persent, state['all_strings']
+
+
+def benchmark_parsers(path_file_for_analyze, ex):  # -> [(parser, lines, good_strings, seconds), ...]
+    results = []
+    for name in sorted(PARSERS):
+        with open_log(path_file_for_analyze, ex) as log_file:
+            lines = good_strings = 0
+            start = time.time()
+            for string_log in PARSERS[name](log_file):
+                lines += 1
+                good_strings += string_log is not None
+            results.append((name, lines, good_strings, time.time() - start))
+    return results
+
+
+def total_time(times):  # times -> list of times or UrlStat
+    return times.time_sum if isinstance(times, UrlStat) else sum(times)
+
+
+def describe(times, percentiles=()):  # -> count, time_max, time_med, {percentile: time}
+    if isinstance(times, UrlStat):
+        return (times.count, times.time_max, round(times.quantile(0.5), 3),
+                dict((p, round(times.quantile(p / 100.0), 3)) for p in percentiles))
+    times.sort()
+    count = len(times)
+    if count % 2 == 1:
+        time_med = times[count / 2]
+    else:
+        time_med = times[count / 2 - 1]
+    return count, times[-1], time_med, dict((p, times[int(p / 100.0 * (count - 1))]) for p in percentiles)
+
+
+def select_top(data, report_size, select='heap'):  # -> [(url, times), ...] with the largest time_sum
+    if select == 'heap':
+        return heapq.nlargest(report_size, data.iteritems(), key=lambda item: total_time(item[1]))
+    return sorted(data.items(), key=lambda item: total_time(item[1]), reverse=True)[:report_size]
+
+
+def count_stat(data,  num_req, all_time, report_size=5, percentiles=(), select='heap'):
+    # data -> {url: [list_of_times] | UrlStat}, report_size -> config["REPORT_SIZE"]
+    data_to_render_ = []
+    for url, times in select_top(data, report_size, select):  # only these report_size urls are finalized
+        time_sum = round(total_time(times), 3)
+        count, time_max, time_med, time_percentiles = describe(times, percentiles)
         count_perc = round(count / (num_req * 1.0) * 100, 3)
         time_perc = round(time_sum / (all_time * 1.0) * 100, 3)
         time_avg = round(time_sum / (count * 1.0), 3)
-        if count % 2 == 1:
-            time_med = list_of_times[count / 2]
-        else:
-            time_med = list_of_times[count / 2 - 1]
-        data_to_render_.append({
-            'url': sorted_data[i][0],
+        row = {
+            'url': url,
             'count': count,
             'count_perc': count_perc,
             'time_avg': time_avg,
-            'time_max': list_of_times[-1],
+            'time_max': time_max,
             'time_med': time_med,
             'time_perc': time_perc,
             'time_sum': time_sum
-        })
-        i += 1
+        }
+        for p in percentiles:
+            row['time_p{}'.format(p)] = time_percentiles[p]
+        data_to_render_.append(row)
     return data_to_render_
 
 
-def render_report(data_to_render_, report_path):
-    table_json = json.dumps(data_to_render_, indent=4)
-    with open('report.html', 'r') as report:
-        report = report.read().decode('utf-8')
-        report_to_file = Template(report)
-    report_to_file = report_to_file.safe_substitute(table_json=table_json)
-    with open(report_path, 'w') as report_date:
-        report_to_file = report_to_file.encode('utf-8')
-        report_date.write(report_to_file)
+TEMPLATES = {}  # path -> (prefix, suffix): the report template around $table_json, read once per run
+
+
+def load_template(template_path):
+    if template_path not in TEMPLATES:
+        with open(template_path, 'r') as report:
+            report = report.read()
+        for m in Template.pattern.finditer(report):
+            if 'table_json' in (m.group('named'), m.group('braced')):
+                prefix, suffix = report[:m.start()], report[m.end():]
+                break
+        else:
+            raise Exception('No $table_json in the report template {}'.format(template_path))
+        TEMPLATES[template_path] = Template(prefix).safe_substitute(), Template(suffix).safe_substitute()
+    return TEMPLATES[template_path]
+
+
+def render_report(data_to_render_, report_path, template_path='report.html'):
+    # rows are written to the report one by one, the table is never held in memory as one string
+    prefix, suffix = load_template(template_path)
+    with open(report_path + '.tmp', 'w') as report_date:
+        report_date.write(prefix)
+        report_date.write('[')
+        separator = '\n'
+        for row in data_to_render_:
+            report_date.write(separator)
+            report_date.write(json.dumps(row))
+            separator = ',\n'
+        report_date.write('\n]')
+        report_date.write(suffix)
+    os.rename(report_path + '.tmp', report_path)
+
+
+FOLLOW_WINDOWS = (5, 15, 60)  # minutes, every window gets its own live report
+FOLLOW_BUCKET = 60  # seconds in one bucket of RollingWindow
+FOLLOW_POLL = 0.5  # seconds to sleep when the followed log has no new lines
+
+
+class LogTail(object):
+    """
+    Reads the lines appended to a log that is still written. path_resolver()
+    returns the path to follow: when it changes (a new day's log), the inode of
+    the path changes (the log was rotated) or the file shrinks (truncated), the
+    rest of the old file is read and the new one is followed from its start.
+    """
+
+    def __init__(self, path_resolver, from_start=False):
+        self.path_resolver = path_resolver
+        self.log_file = None
+        self.tail = b''
+        self.open(from_start)
+
+    def open(self, from_start=True, path_file=None):
+        if self.log_file is not None:
+            self.log_file.close()
+        self.path_file = self.path_resolver() if path_file is None else path_file
+        self.log_file = open(self.path_file, 'rb')
+        self.inode = os.fstat(self.log_file.fileno()).st_ino
+        self.tail = b''
+        if not from_start:
+            self.log_file.seek(0, os.SEEK_END)
+
+    def close(self):
+        self.log_file.close()
+
+    def rotated(self):  # -> the path to follow if the log was rotated, None to go on with the old file
+        try:
+            path_file = self.path_resolver()
+            stat = os.stat(path_file)
+        except Exception:  # moved away and the new one is not created yet: OSError, or find_log found no log
+            return None
+        if path_file != self.path_file or stat.st_ino != self.inode or stat.st_size < self.log_file.tell():
+            return path_file
+        return None
+
+    def read_lines(self):  # -> complete lines written since the last call
+        block = self.log_file.read(BLOCK_SIZE)
+        if not block:
+            path_file = self.rotated()
+            if path_file is not None:
+                logging.info('{} is rotated, reopen'.format(self.path_file))
+                lines = [self.tail] if self.tail else []  # the old file is read to its end, its last line is done
+                self.open(path_file=path_file)
+                return lines
+            return []
+        lines = (self.tail + block).splitlines(True)
+        self.tail = lines.pop() if not lines[-1].endswith(b'\n') else b''
+        return lines
+
+
+class RollingWindow(object):
+    """
+    Aggregates of the last span seconds kept in a ring of bucket_seconds
+    buckets. A bucket is reset when the ring comes back to it, so expiring old
+    data is O(1); snapshot() merges the buckets of the asked window.
+    """
+
+    def __init__(self, span, bucket_seconds=FOLLOW_BUCKET):
+        self.bucket_seconds = bucket_seconds
+        self.ids = [None] * int(math.ceil(float(span) / bucket_seconds))
+        self.buckets = [None] * len(self.ids)  # [data, good_strings, all_strings, all_time]
+
+    def bucket(self, now):
+        bucket_id = int(now // self.bucket_seconds)
+        slot = bucket_id % len(self.ids)
+        if self.ids[slot] != bucket_id:
+            self.ids[slot] = bucket_id
+            self.buckets[slot] = [new_data(), 0, 0, 0]
+        return self.buckets[slot]
+
+    def add(self, lines, now, parser='regex', normalizer=None):
+        bucket = self.bucket(now)
+        _, good_strings, all_strings, all_time = aggregate(lines, data=bucket[0], parser=parser,
+                                                           normalizer=normalizer)
+        bucket[1] += good_strings
+        bucket[2] += all_strings
+        bucket[3] += all_time
+
+    def snapshot(self, seconds, now):  # -> data, good_strings, all_strings, all_time of the last seconds
+        last = int(now // self.bucket_seconds)
+        first = last - int(math.ceil(float(seconds) / self.bucket_seconds)) + 1
+        return merge_parts(bucket for bucket_id, bucket in zip(self.ids, self.buckets)
+                           if bucket_id is not None and first <= bucket_id <= last)
+
+
+def write_live_reports(window, conf, now):
+    for minutes in FOLLOW_WINDOWS:
+        data, good_strings, all_strings, all_time = window.snapshot(minutes * 60, now)
+        data_to_render = count_stat(data, good_strings, all_time, report_size=conf["REPORT_SIZE"]) \
+            if good_strings else []
+        report_path = os.path.join(conf['REPORT_DIR'], 'report-live-{0}m.{1}'.format(minutes, conf["FOLLOW_FORMAT"]))
+        if conf["FOLLOW_FORMAT"] == 'json':
+            with open(report_path + '.tmp', 'w') as snapshot:
+                json.dump(dict(window_minutes=minutes, generated=int(now), all_strings=all_strings,
+                               good_strings=good_strings, table=data_to_render), snapshot)
+            os.rename(report_path + '.tmp', report_path)
+        else:
+            render_report(data_to_render, report_path)
+    logging.debug("follow: live reports written")
+
+
+def follow(conf, stop=lambda: False):  # runs until stop() returns True
+    if conf["FOLLOW_FILE"]:
+        path_resolver = lambda: conf["FOLLOW_FILE"]
+    else:
+        def path_resolver():  # the newest uncompressed log of LOG_DIR
+            file_log = find_log(conf["LOG_DIR"])
+            if file_log is None or file_log.ex is not None:
+                raise Exception('No uncompressed log to follow in {}'.format(conf["LOG_DIR"]))
+            return os.path.join(conf["LOG_DIR"], file_log.file_for_analyze)
+    if not os.path.exists(conf['REPORT_DIR']):
+        os.makedirs(conf['REPORT_DIR'])
+    normalizer = UrlNormalizer(cache_size=conf["NORMALIZE_CACHE"]) if conf["NORMALIZE_URLS"] else None
+    window = RollingWindow(max(FOLLOW_WINDOWS) * 60)
+    tail = LogTail(path_resolver)
+    logging.info('follow: {}'.format(tail.path_file))
+    next_report = time.time() + conf["FOLLOW_INTERVAL"]
+    try:
+        while not stop():
+            lines = tail.read_lines()
+            now = time.time()
+            if lines:
+                window.add(lines, now, parser=conf["PARSER"], normalizer=normalizer)
+            if now >= next_report:
+                write_live_reports(window, conf, now)
+                next_report = now + conf["FOLLOW_INTERVAL"]
+            if not lines:
+                time.sleep(FOLLOW_POLL)
+    except KeyboardInterrupt:
+        logging.info('follow: stopped')
+    finally:
+        tail.close()
+
+
+class Metrics(object):
+    """
+    Wall time, CPU time (of the script and of its finished worker processes), peak RSS and
+    lines/sec, bytes/sec of the pipeline stages of one report.
+    """
+
+    def __init__(self, stages=None):
+        self.stages = OrderedDict(stages or ())
+
+    @contextmanager
+    def stage(self, name):  # with metrics.stage('parse_log') as counters: ...; counters['lines'] = N
+        counters = OrderedDict()
+        times_before, wall_before = os.times(), time.time()
+        yield counters
+        wall = time.time() - wall_before
+        times_after = os.times()
+        stat = OrderedDict([
+            ('wall_time', round(wall, 6)),
+            ('cpu_time', round(sum(times_after[:4]) - sum(times_before[:4]), 6)),
+            ('peak_rss_kb', max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))
+        ])
+        for counter, value in counters.items():
+            stat[counter] = value
+            if counter in ('lines', 'bytes'):
+                stat[counter + '_per_sec'] = round(value / wall, 1) if wall else None
+        self.stages[name] = stat
+
+    def save(self, path):
+        with open(path + '.tmp', 'w') as metrics_file:
+            json.dump(self.stages, metrics_file, indent=4)
+        os.rename(path + '.tmp', path)
 
 
 def check_report(path, conf):
@@ -172,34 +1124,233 @@ def check_report(path, conf):
     return False
 
 
-def main(conf):
-    logging.basicConfig(format='[%(asctime)s] %(levelname).1s %(message)s', level=conf["LOGGING_LEVEL"],
-                        filename=conf["LOGGING_TO_FILE"])
-
-    file_log = find_log(conf["LOG_DIR"])
-    if file_log is None:
-        logging.error('File_for_analyze is not found.')
-        return
-    logging.debug("find_log: {} OK".format(file_log.file_for_analyze))
-
-    report_path = os.path.join(conf['REPORT_DIR'], 'report-{}.html'.format(file_log.date.strftime('%Y.%m.%d')))
+def process_log(file_log, conf, metrics=None):  # metrics -> Metrics with the stages done before, e.g. find_log
+    date = file_log.date.strftime('%Y.%m.%d')
+    report_path = os.path.join(conf['REPORT_DIR'], 'report-{}.html'.format(date))
     if check_report(report_path, conf):
         logging.info('the file:{} already processed'.format(file_log.file_for_analyze))
         return
+    metrics = Metrics(metrics.stages if metrics is not None else None)
 
     path_file_for_analyze = os.path.join(conf["LOG_DIR"], file_log.file_for_analyze)
-    raw_data, good_strings, all_time, persent = parse_log(path_file_for_analyze, file_log.ex)
+    normalizer = UrlNormalizer(cache_size=conf["NORMALIZE_CACHE"]) if conf["NORMALIZE_URLS"] else None
+    checkpoint_path = os.path.join(conf['REPORT_DIR'], 'checkpoint-{}.ckpt'.format(date))
+    with metrics.stage('parse_log') as counters:
+        if conf["CHECKPOINT_LINES"] > 0:
+            raw_data, good_strings, all_time, persent, all_strings = parse_log_checkpointed(
+                path_file_for_analyze, file_log.ex, checkpoint_path, conf["CHECKPOINT_LINES"],
+                exact=bool(conf["EXACT_STAT"]), parser=conf["PARSER"], normalizer=normalizer,
+                external=bool(conf["DECOMPRESS_EXTERNAL"]))
+        else:
+            raw_data, good_strings, all_time, persent, all_strings = parse_log(
+                path_file_for_analyze, file_log.ex, workers=conf["WORKERS"], exact=bool(conf["EXACT_STAT"]),
+                parser=conf["PARSER"], normalizer=normalizer, external=bool(conf["DECOMPRESS_EXTERNAL"]),
+                use_mmap=bool(conf["USE_MMAP"]))
+        counters['lines'] = all_strings
+        counters['bytes'] = os.path.getsize(path_file_for_analyze)  # as stored, compressed or not
+        counters['good_lines'] = good_strings
     if persent <= Fraction(conf["LEVEL_PARSE"], 100):
             logging.error('Could not parse more {0}% in {1}. Try to check log format.'.
                           format(conf["LEVEL_PARSE"], path_file_for_analyze))
             return
     logging.debug("parse_log: OK")
+    if normalizer is not None:
+        logging.info("normalize: ~{0} distinct urls collapsed into {1} templates".format(
+            len(normalizer.raw_urls), len(normalizer.templates)))
 
-    data_to_render = count_stat(raw_data, good_strings, all_time, report_size=conf["REPORT_SIZE"])
+    percentiles = (95, 99) if conf["REPORT_PERCENTILES"] else ()
+    with metrics.stage('count_stat') as counters:
+        data_to_render = count_stat(raw_data, good_strings, all_time, report_size=conf["REPORT_SIZE"],
+                                    percentiles=percentiles)
+        counters['urls'] = len(raw_data)
     logging.debug("count_stat: OK")
 
+    with metrics.stage('render_report') as counters:
+        render_report(data_to_render, report_path)
+        counters['lines'] = len(data_to_render)
+        counters['bytes'] = os.path.getsize(report_path)
+    if conf["SAVE_AGGREGATES"]:
+        save_aggregates(os.path.join(conf['REPORT_DIR'], 'report-{}.agg'.format(date)), raw_data, good_strings,
+                        all_time)
+    if conf["SAVE_METRICS"]:
+        metrics.save(os.path.join(conf['REPORT_DIR'], 'report-{}.metrics.json'.format(date)))
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    logging.info("render_report: OK. Report file: {}".format(report_path))
+
+
+def rollup(conf, date_from, date_to):  # dates -> 'YYYY.MM.DD', the range includes both ends
+    data, good_strings, all_time, days = new_data(), 0, 0, []
+    if not os.path.exists(conf['REPORT_DIR']):
+        raise Exception('{} no such directory!'.format(conf['REPORT_DIR']))
+    for file_ in sorted(os.listdir(conf['REPORT_DIR'])):
+        f = re.match(r'report-(?P<date>\d{4}\.\d{2}\.\d{2})\.agg$', file_)
+        if not f or not date_from <= f.group('date') <= date_to:
+            continue
+        _, day_good_strings, day_time = load_aggregates(os.path.join(conf['REPORT_DIR'], file_), data)
+        good_strings += day_good_strings
+        all_time += day_time
+        days.append(f.group('date'))
+    if not days:
+        logging.error('No aggregates from {0} to {1} in {2}.'.format(date_from, date_to, conf['REPORT_DIR']))
+        return None
+    logging.debug("rollup: {0} days {1}".format(len(days), ', '.join(days)))
+    percentiles = (95, 99) if conf["REPORT_PERCENTILES"] else ()
+    data_to_render = count_stat(data, good_strings, all_time, report_size=conf["REPORT_SIZE"],
+                                percentiles=percentiles)
+    report_path = os.path.join(conf['REPORT_DIR'], 'report-{0}-{1}.html'.format(date_from, date_to))
     render_report(data_to_render, report_path)
     logging.info("render_report: OK. Report file: {}".format(report_path))
+    return report_path
+
+
+# ui_short with every field needed by the columnar index
+FULL_LINE_PATTERN = re.compile(
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3} +\S+ +\S+ '     # $remote_addr $remote_user $http_x_real_ip
+    r'\[(?P<time_local>[^\]]+)\] '                          # [$time_local]
+    r'"\S+ (?P<url>/\S*)[^"]*" '                             # "$request"
+    r'(?P<status>\d{3}) \d+ "[^"]*" '                         # $status $body_bytes_sent "$http_referer"
+    r'"(?P<agent>[^"]*)" '                                   # "$http_user_agent"
+    r'.*'                                                    # "$http_x_forwarded_for" ... "$http_X_RB_USER"
+    r' (?P<time>\d+\.\d+)\s*$'                               # $request_time
+)
+# group_by -> (column, dictionary of the column or None when the column holds the values themselves)
+INDEX_GROUPS = {
+    'url': ('url_id', 'urls'),
+    'status': ('status', None),
+    'agent': ('agent_id', 'agents'),
+}
+INDEX_SORTS = ('time_sum', 'count', 'time_avg', 'time_max', 'time_med')
+
+
+def parse_time_local(time_local):  # '29/Jun/2017:03:50:22 +0300' -> unix time
+    local = calendar.timegm(datetime.strptime(time_local[:20], '%d/%b/%Y:%H:%M:%S').timetuple())
+    offset = int(time_local[22:24]) * 3600 + int(time_local[24:26]) * 60
+    return local - offset if time_local[21] == '+' else local + offset
+
+
+def check_numpy():
+    if np is None:
+        raise Exception('numpy is required for the columnar index: pip install numpy')
+
+
+def ingest_log(path_file_for_analyze, ex, index_dir, external=False):
+    # turns a log into index_dir/<column>.npy arrays + the url and user agent dictionaries, -> meta
+    check_numpy()
+    columns = dict(url_id=array.array('i'), request_time=array.array('f'), status=array.array('h'),
+                   timestamp=array.array('l'), agent_id=array.array('i'))
+    dictionaries = dict(urls={}, agents={})
+    last_time_local, last_timestamp = None, None
+    all_strings = 0
+    match = FULL_LINE_PATTERN.match
+    with open_log(path_file_for_analyze, ex, external) as log_file:
+        for line in log_file:
+            all_strings += 1
+            m = match(line)
+            if m is None:
+                continue
+            time_local = m.group('time_local')
+            if time_local != last_time_local:  # lines come in order, strptime once a second is enough
+                last_time_local, last_timestamp = time_local, parse_time_local(time_local)
+            columns['url_id'].append(dictionaries['urls'].setdefault(m.group('url'), len(dictionaries['urls'])))
+            columns['agent_id'].append(dictionaries['agents'].setdefault(m.group('agent'),
+                                                                         len(dictionaries['agents'])))
+            columns['request_time'].append(float(m.group('time')))
+            columns['status'].append(int(m.group('status')))
+            columns['timestamp'].append(last_timestamp)
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    for name, column in columns.items():
+        np.save(os.path.join(index_dir, name + '.npy'), np.frombuffer(column, dtype=np.dtype(column.typecode))
+                if column else np.array([], dtype=np.dtype(column.typecode)))
+    for name, dictionary in dictionaries.items():
+        values = [None] * len(dictionary)
+        for value, i in dictionary.iteritems():
+            values[i] = value.decode('utf-8', 'replace')
+        with open(os.path.join(index_dir, name + '.json'), 'w') as dictionary_file:
+            json.dump(values, dictionary_file)
+    meta = dict(log=os.path.basename(path_file_for_analyze), all_strings=all_strings,
+                good_strings=len(columns['request_time']))
+    with open(os.path.join(index_dir, 'meta.json'), 'w') as meta_file:
+        json.dump(meta, meta_file)
+    return meta
+
+
+def load_index(index_dir):  # the arrays are memory-mapped, not read
+    check_numpy()
+    index = {}
+    for name in ('url_id', 'request_time', 'status', 'timestamp', 'agent_id'):
+        index[name] = np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r')
+    for name in ('urls', 'agents', 'meta'):
+        with open(os.path.join(index_dir, name + '.json'), 'r') as json_file:
+            index[name] = json.load(json_file)
+    return index
+
+
+def query_index(index, group_by='url', report_size=1000, sort='time_sum', status=None, since=None, until=None):
+    # count_stat over the index grouped by url, status or user agent, optionally only for one status and for
+    # timestamps in [since, until); all the work is done by numpy on whole columns
+    column, dictionary = INDEX_GROUPS[group_by]
+    keys, times = index[column], index['request_time']
+    mask = np.ones(len(times), dtype=bool)
+    if status is not None:
+        mask &= index['status'] == status
+    if since is not None:
+        mask &= index['timestamp'] >= since
+    if until is not None:
+        mask &= index['timestamp'] < until
+    keys, times = keys[mask], times[mask].astype(np.float64)
+    if not len(times):
+        return []
+    order = np.lexsort((times, keys))  # by key, then by time inside every key
+    keys, times = keys[order], times[order]
+    groups, starts, counts = np.unique(keys, return_index=True, return_counts=True)
+    stats = dict(count=counts, time_sum=np.add.reduceat(times, starts), time_max=times[starts + counts - 1],
+                 time_med=times[starts + (counts - 1) // 2])
+    stats['time_avg'] = stats['time_sum'] / counts
+    top = np.argsort(-stats[sort], kind='mergesort')[:report_size]
+    num_req, all_time = len(times), times.sum()
+    data_to_render_ = []
+    for i in top:
+        key = index[dictionary][groups[i]] if dictionary else int(groups[i])
+        data_to_render_.append({
+            'url' if group_by == 'url' else group_by: key,
+            'count': int(counts[i]),
+            'count_perc': round(counts[i] / (num_req * 1.0) * 100, 3),
+            'time_avg': round(stats['time_avg'][i], 3),
+            'time_max': round(stats['time_max'][i], 3),
+            'time_med': round(stats['time_med'][i], 3),
+            'time_perc': round(stats['time_sum'][i] / all_time * 100, 3) if all_time else 0,
+            'time_sum': round(stats['time_sum'][i], 3)
+        })
+    return data_to_render_
+
+
+def main(conf):
+    conf = dict(config, **conf)  # options missing in conf fall back to defaults
+    logging.basicConfig(format='[%(asctime)s] %(levelname).1s %(message)s', level=conf["LOGGING_LEVEL"],
+                        filename=conf["LOGGING_TO_FILE"])
+
+    metrics = Metrics()
+    with metrics.stage('find_log') as counters:
+        if conf["PROCESS_ALL"]:  # every log of LOG_DIR from the oldest one, reported days are skipped
+            logs = find_logs(conf["LOG_DIR"])
+        else:
+            file_log = find_log(conf["LOG_DIR"])
+            logs = [file_log] if file_log is not None else []
+        counters['logs'] = len(logs)
+    if not logs:
+        logging.error('File_for_analyze is not found.')
+        return
+    for file_log in logs:
+        logging.debug("find_log: {} OK".format(file_log.file_for_analyze))
+        if conf["PROFILE"]:  # only the main process is profiled, workers > 1 are not seen
+            profiler = cProfile.Profile()
+            profiler.runcall(process_log, file_log, conf, metrics)
+            profiler.dump_stats(os.path.join(conf['REPORT_DIR'], 'report-{}.prof'.format(
+                file_log.date.strftime('%Y.%m.%d'))))
+        else:
+            process_log(file_log, conf, metrics)
 
 
 if __name__ == "__main__":
@@ -209,7 +1360,39 @@ if __name__ == "__main__":
         config = parse_config(config, namespace.config)
     except Exception:
         raise Exception("Bad config!")
+    if namespace.benchmark:
+        file_log = find_log(config["LOG_DIR"])
+        if file_log is None:
+            raise SystemExit('File_for_analyze is not found.')
+        for name, lines, good, seconds in benchmark_parsers(os.path.join(config["LOG_DIR"], file_log.file_for_analyze),
+                                                           file_log.ex):
+            print('{0:>6}: {1} lines ({2} parsed) in {3:.3f}s, {4:.0f} lines/sec'.format(
+                name, lines, good, seconds, lines / seconds if seconds else 0))
+        raise SystemExit()
+    if namespace.ingest:
+        file_log = find_log(config["LOG_DIR"])
+        if file_log is None:
+            raise SystemExit('File_for_analyze is not found.')
+        index_dir = os.path.join(config['REPORT_DIR'], 'index-{}'.format(file_log.date.strftime('%Y.%m.%d')))
+        meta = ingest_log(os.path.join(config["LOG_DIR"], file_log.file_for_analyze), file_log.ex, index_dir,
+                          external=bool(config["DECOMPRESS_EXTERNAL"]))
+        print('{0}: {1} of {2} lines indexed'.format(index_dir, meta['good_strings'], meta['all_strings']))
+        raise SystemExit()
+    if namespace.query:
+        table = query_index(load_index(os.path.join(config['REPORT_DIR'], 'index-{}'.format(namespace.query))),
+                            group_by=namespace.group_by, report_size=config["REPORT_SIZE"], sort=namespace.sort,
+                            status=namespace.status)
+        print(json.dumps(table, indent=4))
+        raise SystemExit()
     try:
-        main(config)
+        if namespace.rollup or namespace.follow:
+            logging.basicConfig(format='[%(asctime)s] %(levelname).1s %(message)s', level=config["LOGGING_LEVEL"],
+                                filename=config["LOGGING_TO_FILE"])
+        if namespace.rollup:
+            rollup(config, *namespace.rollup)
+        elif namespace.follow:
+            follow(config)
+        else:
+            main(config)
     except Exception:
         logging.exception('Unexpected error!')
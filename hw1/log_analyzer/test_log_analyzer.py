@@ -8,10 +8,16 @@ Created on Wed Oct 31 14:07:25 2018
 
 import unittest
 import logging
+import json
+import gzip
+import bz2
 import os
 import shutil
 from collections import namedtuple
-from log_analyzer import parse_config, find_log, parse_log, count_stat, main
+import log_analyzer
+from log_analyzer import parse_config, find_log, find_logs, parse_log, parse_log_checkpointed, count_stat, main, \
+    UrlStat, PARSERS, UrlNormalizer, save_aggregates, load_aggregates, rollup, open_log, render_report, \
+    RollingWindow, LogTail, ingest_log, load_index, query_index, parse_time_local, np
 from datetime import datetime
 from fractions import Fraction
 
@@ -51,8 +57,8 @@ class MyListTest(unittest.TestCase):
     def test_find_log_bz2(self):
         res = find_log('./test/test_logs_nginx/test_bz2')
         Log = namedtuple('Log', 'file_for_analyze date ex')
-        self.assertEquals(res, Log('nginx-access-ui.log-20150413',
-                                   datetime.strptime('20150413', '%Y%m%d'), None))
+        self.assertEquals(res, Log('nginx-access-ui.log-20200413.bz2',
+                                   datetime.strptime('20200413', '%Y%m%d'), 'bz2'))
 
     def test_find_log_gz(self):
         res = find_log('./test/test_logs_nginx/test_gz')
@@ -64,17 +70,355 @@ class MyListTest(unittest.TestCase):
         res = find_log('./test/test_logs_nginx/test_no_file')
         self.assertEquals(res, None)
 
+    def test_find_logs(self):
+        res = find_logs('./test/test_logs_nginx')
+        self.assertEquals([log.file_for_analyze for log in res],
+                          ['nginx-access-ui.log-20000413.gz', 'nginx-access-ui.log-20100413',
+                           'nginx-access-ui.log-20150413', 'nginx-access-ui.log-20200413.gz'])
+
+    def test_parse_log_checkpointed(self):
+        os.makedirs('./test/checkpoints')
+        log_path = './test/checkpoints/nginx-access-ui.log-20170630'
+        checkpoint_path = './test/checkpoints/checkpoint-2017.06.30.ckpt'
+        with open('./test/nginx-access-ui.log-20170630', 'r') as f:
+            lines = f.readlines()
+        try:
+            with open(log_path, 'w') as f:  # the first run only sees a part of the log and "crashes"
+                f.writelines(lines[:8])
+            parse_log_checkpointed(log_path, None, checkpoint_path, 4, exact=True)
+            self.assertTrue(os.path.exists(checkpoint_path))
+            with open(log_path, 'w') as f:  # already parsed lines are spoiled: they must not be read again
+                f.writelines(['x' * (len(line) - 1) + '\n' for line in lines[:8]] + lines[8:])
+            res = parse_log_checkpointed(log_path, None, checkpoint_path, 4, exact=True)
+        finally:
+            shutil.rmtree('./test/checkpoints')
+        parse = parse_log('./test/nginx-access-ui.log-20170630', None, exact=True)
+        self.assertEquals(res[0], parse[0])
+        self.assertEquals(res[1], parse[1])
+        self.assertEquals(res[3:], parse[3:])
+
+    def test_parse_log_checkpointed_normalizer(self):
+        os.makedirs('./test/checkpoints')
+        log_path = './test/checkpoints/nginx-access-ui.log-20170630'
+        checkpoint_path = './test/checkpoints/checkpoint-2017.06.30.ckpt'
+        with open('./test/nginx-access-ui.log-20170630', 'r') as f:
+            lines = f.readlines()
+        normalizer = UrlNormalizer()
+        try:
+            with open(checkpoint_path, 'wb') as f:  # not a checkpoint: ignored, the log is parsed from the start
+                f.write(b'\x80\x02}q\x00.')
+            with open(log_path, 'w') as f:
+                f.writelines(lines[:8])
+            parse_log_checkpointed(log_path, None, checkpoint_path, 4, normalizer=UrlNormalizer())
+            with open(log_path, 'w') as f:
+                f.writelines(lines)
+            res = parse_log_checkpointed(log_path, None, checkpoint_path, 4, normalizer=normalizer)
+        finally:
+            shutil.rmtree('./test/checkpoints')
+        parse_normalizer = UrlNormalizer()
+        parse = parse_log('./test/nginx-access-ui.log-20170630', None, normalizer=parse_normalizer)
+        self.assertEquals(res, parse)
+        self.assertEquals(normalizer.templates, parse_normalizer.templates)
+        self.assertEquals(normalizer.raw_urls.registers, parse_normalizer.raw_urls.registers)
+
+    def test_open_log(self):
+        with open('./test/nginx-access-ui.log-20170630', 'r') as f:
+            lines = f.readlines()
+        os.makedirs('./test/codecs')
+        block_size, log_analyzer.BLOCK_SIZE = log_analyzer.BLOCK_SIZE, 100  # lines cross the blocks
+        try:
+            for ex, file_open in (('gz', gzip.open), ('bz2', bz2.BZ2File)):
+                path = './test/codecs/nginx-access-ui.log-20170630.' + ex
+                for _ in range(2):  # two concatenated streams, as pigz and pbzip2 write them
+                    with file_open('./test/codecs/stream', 'wb') as stream:
+                        stream.writelines(lines)
+                    with open('./test/codecs/stream', 'rb') as stream, open(path, 'ab') as f:
+                        f.write(stream.read())
+                with open_log(path, ex) as f:
+                    self.assertEquals(list(f), lines * 2)
+                with open_log(path, ex) as f:
+                    f.seek(len(lines[0]) + len(lines[1]))
+                    self.assertEquals(list(f), lines[2:] + lines)
+        finally:
+            log_analyzer.BLOCK_SIZE = block_size
+            shutil.rmtree('./test/codecs')
+
     def test_parse_log_empty_file(self):
         res = parse_log('./test/test_configs/empty_file', None)
-        self.assertEquals(res, ({}, 0, 0, 0))
+        self.assertEquals(res, ({}, 0, 0, 0, 0))
+        with open('./test/bad.log', 'wb') as bad:
+            bad.write('bad_string\n' * 3)
+        try:
+            self.assertEquals(parse_log('./test/bad.log', None), ({}, 0, 0, 0, 3))
+        finally:
+            os.remove('./test/bad.log')
 
     def test_parse_log_gz_file(self):
-        res = parse_log('./test/test_logs_nginx/nginx-access-ui.log-20200413.gz', 'gz')
+        res = parse_log('./test/test_logs_nginx/nginx-access-ui.log-20200413.gz', 'gz', exact=True)
         parse = ({'/api/v2/banner/25019354': [0.390],
                   '/api/1/photogenic_banners/list/?server_name=WIN7RB4': [0.133],
-                  '/api/v2/banner/16852664': [0.199]}, 3, 0.722, Fraction(3, 35))
+                  '/api/v2/banner/16852664': [0.199]}, 3, 0.722, Fraction(3, 35), 35)
         self.assertEquals(res, parse)
 
+    def test_parse_log_workers(self):
+        path = './test/nginx-access-ui.log-20170630'
+        data, good_strings, all_time, persent, all_strings = parse_log(path, None, exact=True)
+        res = parse_log(path, None, workers=3, exact=True)
+        self.assertEquals(res[0], data)
+        self.assertEquals(res[1], good_strings)
+        self.assertAlmostEqual(res[2], all_time)
+        self.assertEquals(res[3:], (persent, all_strings))
+
+    def test_parsers(self):
+        res = {}
+        for name in PARSERS:
+            with open('./test/nginx-access-ui.log-20170630', 'r') as f:
+                res[name] = list(PARSERS[name](f))
+            res[name] += list(PARSERS[name](['bad_string\n', '1.1.1.1 - - [x] "GET /a HTTP/1.1" 200 1 "-" "-" -\n']))
+        self.assertEquals(res['regex'], res['split'])
+        self.assertEquals(res['scan'], res['split'])
+        self.assertEquals(res['split'][-2:], [None, None])
+
+    def test_parse_log_mmap(self):
+        path = './test/nginx-access-ui.log-20170630'
+        parse = parse_log(path, None, exact=True)
+        self.assertEquals(parse_log(path, None, exact=True, use_mmap=True), parse)
+        res = parse_log(path, None, exact=True, use_mmap=True, workers=2)
+        self.assertEquals((res[0], res[1], res[3:]), (parse[0], parse[1], parse[3:]))
+        self.assertAlmostEqual(res[2], parse[2])
+        self.assertEquals(parse_log('./test/test_configs/empty_file', None, use_mmap=True), ({}, 0, 0, 0, 0))
+        with open('./test/test_logs_nginx/nginx-access-ui.log-20200413.gz', 'rb') as f, \
+                open('./test/mmap.log', 'wb') as plain:
+            plain.write(gzip.GzipFile(fileobj=f).read())
+        try:
+            res = parse_log('./test/mmap.log', None, exact=True, use_mmap=True)
+        finally:
+            os.remove('./test/mmap.log')
+        self.assertEquals(res, parse_log('./test/test_logs_nginx/nginx-access-ui.log-20200413.gz', 'gz', exact=True))
+
+    def test_parse_log_mmap_keys(self):  # same unicode keys as the other parsers, a non-ascii url is one row
+        line = '1.1.1.1 -  - [x] "GET /\xd0\xb0/{0} HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 0.{0}\n'
+        with open('./test/mmap.log', 'wb') as plain:
+            plain.writelines(line.format(i % 3) for i in range(10))
+        try:
+            res = parse_log('./test/mmap.log', None, exact=True, use_mmap=True)
+            regex = parse_log('./test/mmap.log', None, exact=True)
+        finally:
+            os.remove('./test/mmap.log')
+        self.assertEquals(res, regex)
+        self.assertEquals(sorted(res[0]), [u'/\u0430/0', u'/\u0430/1', u'/\u0430/2'])
+        self.assertTrue(all(isinstance(url, unicode) for url in res[0]))
+
+    def test_parse_log_sketch(self):
+        path = './test/nginx-access-ui.log-20170630'
+        exact = count_stat(*parse_log(path, None, exact=True)[:3], report_size=20)
+        sketch = count_stat(*parse_log(path, None)[:3], report_size=20)
+        self.assertEquals([sorted(row) for row in sketch], [sorted(row) for row in exact])
+        for row_sketch, row_exact in zip(sketch, exact):
+            for key in ('url', 'count', 'time_sum', 'time_max'):
+                self.assertEquals(row_sketch[key], row_exact[key])
+            self.assertAlmostEqual(row_sketch['time_med'], row_exact['time_med'], delta=row_exact['time_med'] * 0.02)
+
+    def test_url_stat_merge(self):
+        times = [0.1 * i for i in range(1, 201)]
+        whole, left, right = UrlStat(), UrlStat(), UrlStat()
+        whole.extend(times)
+        left.extend(times[:50])
+        right.extend(times[50:])
+        left.extend(right)
+        self.assertEquals(left.buckets, whole.buckets)
+        self.assertEquals(left.count, 200)
+        self.assertAlmostEqual(left.time_sum, sum(times))
+        self.assertAlmostEqual(left.quantile(0.5), times[99], delta=times[99] * 0.02)
+        self.assertAlmostEqual(left.quantile(0.99), times[197], delta=times[197] * 0.02)
+
+    def test_count_stat_select(self):
+        data, good_strings, all_time, _, _ = parse_log('./test/nginx-access-ui.log-20170630', None)
+        heap = count_stat(data, good_strings, all_time, report_size=4)
+        full_sort = count_stat(data, good_strings, all_time, report_size=4, select='sort')
+        self.assertEquals(heap, full_sort)
+        self.assertEquals(len(heap), 4)
+
+    def test_normalizer(self):
+        normalizer = UrlNormalizer(cache_size=2)
+        for url, template in (('/api/v2/banner/25019354', '/api/v2/banner/{id}'),
+                              ('/api/v2/banner/16852664', '/api/v2/banner/{id}'),
+                              ('/api/v2/group/7786679/statistic/sites/?date_type=day',
+                               '/api/v2/group/{id}/statistic/sites/'),
+                              ('/static/d41d8cd98f00b204e9800998ecf8427e/app.js', '/static/{hash}/app.js'),
+                              ('/api/v2/banner/25019354', '/api/v2/banner/{id}')):
+            self.assertEquals(normalizer(url), template)
+        self.assertEquals(len(normalizer.cache), 2)
+        self.assertEquals(len(normalizer.raw_urls), 4)
+        self.assertEquals(len(normalizer.templates), 3)
+
+    def test_normalizer_cache(self):
+        normalizer = UrlNormalizer(cache_size=2)
+        for url in ('/a/1', '/b/2', '/a/1', '/c/3'):  # the hit makes /a/1 the most recently used
+            normalizer(url)
+        self.assertEquals(list(normalizer.cache), ['/a/1', '/c/3'])
+        off = UrlNormalizer(cache_size=0)
+        self.assertEquals([off('/api/v2/banner/1'), off('/api/v2/banner/1')], ['/api/v2/banner/{id}'] * 2)
+        self.assertEquals(len(off.cache), 0)
+
+    def test_parse_log_normalize(self):
+        path = './test/nginx-access-ui.log-20170630'
+        normalizer = UrlNormalizer()
+        data, good_strings, _, _, _ = parse_log(path, None, normalizer=normalizer)
+        self.assertEquals(sum(len(times) for times in data.values()), good_strings)
+        self.assertEquals(len(data), len(normalizer.templates))
+        self.assertEquals(data['/api/v2/banner/{id}'].count, 4)
+        self.assertEquals(len(normalizer.raw_urls), len(parse_log(path, None)[0]))
+        parallel = UrlNormalizer()
+        self.assertEquals(sorted(parse_log(path, None, workers=2, normalizer=parallel)[0]), sorted(data))
+        self.assertEquals(parallel.templates, normalizer.templates)
+        self.assertEquals(len(parallel.raw_urls), len(normalizer.raw_urls))
+
+    def test_rollup_aggregates(self):
+        data, good_strings, all_time, _, _ = parse_log('./test/nginx-access-ui.log-20170630', None)
+        os.makedirs('./test/reports')
+        try:
+            save_aggregates('./test/reports/report-2017.06.30.agg', data, good_strings, all_time)
+            shutil.copy('./test/reports/report-2017.06.30.agg', './test/reports/report-2017.07.01.agg')
+            res = load_aggregates('./test/reports/report-2017.06.30.agg')
+            two_days = load_aggregates('./test/reports/report-2017.07.01.agg', load_aggregates(
+                './test/reports/report-2017.06.30.agg')[0])[0]
+            config = dict(REPORT_SIZE=1000, REPORT_DIR="./test/reports", REPORT_PERCENTILES=0)
+            report_path = rollup(config, '2017.06.30', '2017.07.01')
+            self.assertEquals(report_path, './test/reports/report-2017.06.30-2017.07.01.html')
+            self.assertTrue(os.path.exists(report_path))
+            self.assertEquals(rollup(config, '2017.07.02', '2017.07.31'), None)
+        finally:
+            shutil.rmtree('./test/reports')
+        self.assertEquals(res, (data, good_strings, all_time))
+        for url in data:
+            self.assertEquals(two_days[url].count, data[url].count * 2)
+            self.assertEquals(two_days[url].buckets, dict((i, n * 2) for i, n in data[url].buckets.items()))
+
+    def test_render_report(self):
+        data_to_render = count_stat(*parse_log('./test/nginx-access-ui.log-20170630', None)[:3], report_size=100)
+        with open('./report.html', 'r') as f:
+            prefix, suffix = f.read().split('$table_json')
+        render_report(iter(data_to_render), './test/report-test.html')
+        with open('./test/report-test.html', 'r') as f:
+            report = f.read()
+        os.remove('./test/report-test.html')
+        self.assertTrue(report.startswith(prefix))
+        self.assertTrue(report.endswith(suffix))
+        self.assertEquals(json.loads(report[len(prefix):-len(suffix)]), data_to_render)
+
+    def test_rolling_window(self):
+        with open('./test/nginx-access-ui.log-20170630', 'r') as f:
+            lines = f.readlines()
+        window = RollingWindow(600, bucket_seconds=60)
+        window.add(lines[:4], now=0)
+        window.add(lines[4:], now=300)
+        self.assertEquals(window.snapshot(600, now=300)[1:3], (11, 11))
+        self.assertEquals(window.snapshot(60, now=300)[1:3], (7, 7))
+        self.assertEquals(window.snapshot(600, now=599)[1:3], (11, 11))
+        self.assertEquals(window.snapshot(600, now=600)[1:3], (7, 7))  # the bucket of 0 is out of the window
+        window.add(lines[:1], now=600)  # and its slot is reused
+        self.assertEquals(window.snapshot(600, now=600)[1:3], (8, 8))
+        self.assertEquals(len([i for i in window.ids if i is not None]), 2)
+
+    def test_tail_rotation(self):
+        path = './test/tail.log'
+        with open('./test/nginx-access-ui.log-20170630', 'r') as f:
+            lines = f.readlines()
+        with open(path, 'w') as f:
+            f.writelines(lines[:2])
+        tail = LogTail(lambda: path)
+        try:
+            self.assertEquals(tail.read_lines(), [])
+            with open(path, 'a') as f:
+                f.writelines(lines[2:4])
+                f.write(lines[4][:10])
+                f.flush()
+                self.assertEquals(tail.read_lines(), lines[2:4])
+                f.write(lines[4][10:])
+            self.assertEquals(tail.read_lines(), lines[4:5])
+            os.rename(path, path + '.1')
+            with open(path, 'w') as f:
+                f.writelines(lines[5:7])
+            self.assertEquals(tail.read_lines(), [])  # rotation is noticed, the new log is followed from its start
+            self.assertEquals(tail.read_lines(), lines[5:7])
+        finally:
+            tail.close()
+            os.remove(path)
+            os.remove(path + '.1')
+
+    def test_tail_rotation_unterminated_line(self):
+        path = './test/tail.log'
+        with open('./test/nginx-access-ui.log-20170630', 'r') as f:
+            lines = f.readlines()
+        with open(path, 'w') as f:
+            f.writelines(lines[:2])
+        tail = LogTail(lambda: path)
+        try:
+            with open(path, 'a') as f:
+                f.write(lines[2])
+                f.write(lines[3].rstrip('\n'))  # the writer stopped before the newline
+            self.assertEquals(tail.read_lines(), lines[2:3])
+            self.assertEquals(tail.read_lines(), [])
+            os.rename(path, path + '.1')
+            with open(path, 'w') as f:
+                f.writelines(lines[4:6])
+            self.assertEquals(tail.read_lines(), [lines[3].rstrip('\n')])
+            self.assertEquals(tail.read_lines(), lines[4:6])
+        finally:
+            tail.close()
+            os.remove(path)
+            os.remove(path + '.1')
+
+    def test_tail_resolver_error(self):
+        path = './test/tail.log'
+        with open('./test/nginx-access-ui.log-20170630', 'r') as f:
+            lines = f.readlines()
+        with open(path, 'w') as f:
+            f.writelines(lines[:2])
+        missing = []
+
+        def resolver():  # as find_log in the middle of logrotate
+            if missing:
+                raise Exception('No uncompressed log to follow')
+            return path
+        tail = LogTail(resolver)
+        try:
+            missing.append(True)
+            self.assertEquals(tail.read_lines(), [])
+            with open(path, 'a') as f:
+                f.writelines(lines[2:4])
+            self.assertEquals(tail.read_lines(), lines[2:4])  # the old file is still followed
+            self.assertEquals(tail.read_lines(), [])
+            missing.pop()
+            self.assertEquals(tail.read_lines(), [])
+            self.assertEquals(tail.path_file, path)
+        finally:
+            tail.close()
+            os.remove(path)
+
+    def test_parse_time_local(self):
+        self.assertEquals(parse_time_local('29/Jun/2017:03:50:22 +0300'), 1498697422)
+        self.assertEquals(parse_time_local('29/Jun/2017:00:50:22 -0000'), 1498697422)
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test_columnar_index(self):
+        path = './test/nginx-access-ui.log-20170630'
+        try:
+            meta = ingest_log(path, None, './test/index')
+            index = load_index('./test/index')
+            by_url = query_index(index)
+            by_status = query_index(index, group_by='status')
+            by_agent = query_index(index, group_by='agent', sort='count', report_size=1)
+            nothing = query_index(index, status=404)
+        finally:
+            shutil.rmtree('./test/index')
+        self.assertEquals(meta, dict(log='nginx-access-ui.log-20170630', all_strings=11, good_strings=11))
+        self.assertEquals(by_url, count_stat(*parse_log(path, None, exact=True)[:3], report_size=1000))
+        self.assertEquals([(row['status'], row['count']) for row in by_status], [(200, 11)])
+        self.assertEquals(by_agent[0]['agent'], 'Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5')
+        self.assertEquals(nothing, [])
+
     def test_count_stat(self):
         arguments = namedtuple('arguments', 'data num_req all_time')
         data = {}
@@ -125,6 +469,27 @@ Try to check log format.\n')
         self.assertEquals(res3, True)
         self.assertEquals(res4, 'the file:nginx-access-ui.log-20170630 already processed\n')
 
+    def test_metrics_file(self):
+        config = dict(REPORT_SIZE=1000, REPORT_DIR="./test/reports", LOG_DIR="./test", LEVEL_PARSE=50, PROFILE=1,
+                      LOGGING_LEVEL=logging.INFO, LOGGING_TO_FILE='./test/log_analyzer.log')
+        try:
+            main(config)
+            with open('./test/reports/report-2017.06.30.metrics.json') as metrics_file:
+                metrics = json.load(metrics_file)
+            profiled = os.path.exists('./test/reports/report-2017.06.30.prof')
+        finally:
+            shutil.rmtree('./test/reports')
+            if os.path.exists('./test/log_analyzer.log'):
+                os.remove('./test/log_analyzer.log')
+        self.assertEquals(set(metrics), {'find_log', 'parse_log', 'count_stat', 'render_report'})
+        self.assertEquals(metrics['find_log']['logs'], 1)
+        self.assertEquals((metrics['parse_log']['lines'], metrics['parse_log']['good_lines']), (11, 11))
+        self.assertEquals(metrics['parse_log']['bytes'], os.path.getsize('./test/nginx-access-ui.log-20170630'))
+        self.assertEquals(metrics['render_report']['lines'], 11)
+        for stage in metrics.values():
+            self.assertTrue(stage['wall_time'] >= 0 and stage['cpu_time'] >= 0 and stage['peak_rss_kb'] > 0)
+        self.assertTrue(profiled)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from StringIO import StringIO
+
+import deco
+from deco import lru_memo, CacheInfo, shared_memo, DiskStore, MISSING, n_ary, tree_n_ary
+from deco import timed, profile, profile_report, profile_reset, PROFILES
+
+MODULE = __name__ + '.'  # profiled functions are registered as module.name
+
+
+def recursive_n_ary(fun):  # n_ary as it was before the loop
+    def wrapper(x, *args):
+        return x if not args else fun(x, wrapper(*args))
+    return wrapper
+
+
+def sub(x, y):  # neither commutative nor associative, the order of the calls matters
+    return x - y
+
+
+def concat(x, y):  # associative, not commutative
+    return x + y
+
+
+class LruMemoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.calls = []
+
+    def square(self, maxsize=2, ttl=None):
+        @lru_memo(maxsize=maxsize, ttl=ttl, timer=lambda: self.now)
+        def square(x, power=2):
+            self.calls.append(x)
+            return x ** power
+        return square
+
+    def test_eviction_order(self):
+        square = self.square()
+        square(1)
+        square(2)
+        square(1)  # 2 is the least recently used now
+        square(3)
+        self.calls[:] = []
+        self.assertEqual([square(1), square(3), square(2)], [1, 9, 4])
+        self.assertEqual(self.calls, [2])
+        self.assertEqual(square.cache_info(), CacheInfo(hits=3, misses=4, evictions=2, expired=0, maxsize=2,
+                                                        currsize=2))
+
+    def test_kwargs_keys(self):
+        square = self.square(maxsize=None)
+        self.assertEqual([square(2), square(2, 3), square(2, power=3), square(x=2, power=3)], [4, 8, 8, 8])
+        self.assertEqual(square(power=3, x=2), 8)
+        self.assertEqual(square.cache_info().hits, 1)
+        self.assertEqual(square.cache_info().currsize, 4)
+
+    def test_ttl(self):
+        square = self.square(ttl=10)
+        square(2)
+        self.now += 9
+        square(2)
+        self.now += 1
+        square(2)
+        self.assertEqual(self.calls, [2, 2])
+        info = square.cache_info()
+        self.assertEqual((info.hits, info.misses, info.expired, info.currsize), (1, 2, 1, 1))
+
+    def test_cache_clear(self):
+        square = self.square()
+        square(1)
+        square(1)
+        square.cache_clear()
+        self.assertEqual(square.cache_info(), CacheInfo(hits=0, misses=0, evictions=0, expired=0, maxsize=2,
+                                                        currsize=0))
+        square(1)
+        self.assertEqual(self.calls, [1, 1])
+
+    def test_bad_maxsize(self):
+        self.assertRaises(ValueError, lru_memo, maxsize=0)
+
+
+class SharedMemoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def slow_square(self, store=None, **kwargs):
+        @shared_memo(store, **kwargs)
+        def slow_square(x):
+            self.calls.append(x)
+            with open(os.path.join(self.path, 'calls'), 'a') as calls_file:  # seen by other processes
+                calls_file.write('{0}\n'.format(x))
+            time.sleep(0.2)
+            return x * x
+        return slow_square
+
+    def run_all(self, workers):
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def test_single_flight_threads(self):
+        square, results = self.slow_square(), []
+        self.run_all([threading.Thread(target=lambda: results.append(square(3))) for _ in range(2)])
+        self.assertEqual(results, [9, 9])
+        self.assertEqual(self.calls, [3])
+        info = square.cache_info()
+        self.assertEqual((info['misses'], info['waits'], info['currsize']), (1, 1, 1))
+
+    def test_single_flight_processes(self):
+        store_path = os.path.join(self.path, 'store')
+        square = self.slow_square(DiskStore(store_path))
+        results = multiprocessing.Queue()
+        self.run_all([multiprocessing.Process(target=lambda: results.put(square(3))) for _ in range(2)])
+        self.assertEqual([results.get(), results.get()], [9, 9])
+        with open(os.path.join(self.path, 'calls')) as calls_file:
+            self.assertEqual(calls_file.read(), '3\n')
+        self.assertEqual(len(os.listdir(store_path)), 1)  # the value, the lock file is removed
+
+    def test_error_shared(self):
+        @shared_memo()
+        def fail():
+            time.sleep(0.2)
+            raise ValueError(len(errors))
+        errors = []
+
+        def call():
+            try:
+                fail()
+            except ValueError as e:
+                errors.append(e.args)
+        self.run_all([threading.Thread(target=call) for _ in range(2)])
+        self.assertEqual(errors, [(0,), (0,)])
+        self.assertEqual(fail.cache_info()['currsize'], 0)
+
+    def test_ttl(self):
+        square = self.slow_square(ttl=0.3)
+        square(2)
+        square(2)
+        time.sleep(0.3)
+        square(2)
+        self.assertEqual(self.calls, [2, 2])
+        info = square.cache_info()
+        self.assertEqual((info['hits'], info['misses'], info['expired'], info['currsize']), (1, 2, 1, 1))
+
+    def test_maxsize(self):
+        @shared_memo(maxsize=2)
+        def square(x):
+            self.calls.append(x)
+            return x * x
+        square(1)
+        square(2)
+        square(1)  # 2 is the least recently used now
+        square(3)
+        self.calls[:] = []
+        self.assertEqual([square(1), square(3), square(2)], [1, 9, 4])
+        self.assertEqual(self.calls, [2])
+        self.assertEqual(square.cache_info()['evictions'], 2)
+        self.assertRaises(ValueError, shared_memo, maxsize=0)
+
+
+class DiskStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = DiskStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get_set(self):
+        self.assertTrue(self.store.get('a') is MISSING)
+        self.store.set('a', [1, 2])
+        self.store.set('b', 2, ttl=-1)
+        self.assertEqual(self.store.get('a'), [1, 2])
+        self.assertTrue(self.store.get('b') is MISSING)
+
+    def test_lock_processes(self):
+        locked, release = multiprocessing.Event(), multiprocessing.Event()
+
+        def hold():
+            with self.store.lock('a'):
+                locked.set()
+                release.wait()
+        owner = multiprocessing.Process(target=hold)
+        owner.start()
+        locked.wait()
+        self.assertTrue(self.store.acquire('a', blocking=False) is None)
+        release.set()
+        start = time.time()
+        with self.store.lock('a'):
+            self.assertTrue(time.time() - start < 5)
+        owner.join()
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_lock_removed_by_owner(self):  # a waiter that opened the old lock file must not lock it
+        lock_file = self.store.acquire('a')
+        waiting = open(os.path.join(self.path, 'a.lock'), 'a')
+        self.store.release('a', lock_file)
+        new_lock_file = self.store.acquire('a', blocking=False)
+        self.assertFalse(new_lock_file is None)
+        self.assertNotEqual(os.fstat(new_lock_file.fileno()).st_ino, os.fstat(waiting.fileno()).st_ino)
+        waiting.close()
+        self.store.release('a', new_lock_file)
+
+    def test_purge(self):
+        self.store.set('fresh', 1, ttl=60)
+        self.store.set('forever', 2)
+        self.store.set('expired', 3, ttl=-1)
+        self.store.set('locked', 4, ttl=-1)
+        lock_file = self.store.acquire('locked')
+        open(os.path.join(self.path, 'killed.lock'), 'a').close()
+        for name, age in [('old.1.tmp', 2 * DiskStore.tmp_age), ('new.1.tmp', 0)]:
+            open(os.path.join(self.path, name), 'a').close()
+            os.utime(os.path.join(self.path, name), (time.time() - age, time.time() - age))
+        self.store.purge()
+        self.store.release('locked', lock_file)
+        self.assertEqual(sorted(os.listdir(self.path)), ['forever', 'fresh', 'locked', 'new.1.tmp'])
+
+    def test_purge_every(self):
+        store = DiskStore(self.path, purge_every=2)
+        store.set('a', 1, ttl=-1)
+        store.set('b', 2)
+        self.assertEqual(os.listdir(self.path), ['b'])
+
+
+class NAryTest(unittest.TestCase):
+
+    def test_n_ary(self):
+        for args in [(5,), (5, 3), (5, 3, 2), tuple(xrange(100))]:
+            self.assertEqual(n_ary(sub)(*args), recursive_n_ary(sub)(*args))
+
+    def test_n_ary_deep(self):
+        args = tuple(xrange(sys.getrecursionlimit() * 100))
+        self.assertRaises(RuntimeError, recursive_n_ary(sub), *args)
+        self.assertEqual(n_ary(sub)(*args), sum(x if i % 2 == 0 else -x for i, x in enumerate(args)))
+
+    def test_tree_n_ary(self):
+        for args in [('a',), ('a', 'b'), ('a', 'b', 'c'), tuple('abcdefghijk')]:
+            self.assertEqual(tree_n_ary()(concat)(*args), recursive_n_ary(concat)(*args))
+
+    def test_tree_n_ary_deep(self):
+        args = tuple(str(i) for i in xrange(sys.getrecursionlimit() * 100))
+        self.assertRaises(RuntimeError, recursive_n_ary(concat), *args)
+        self.assertEqual(tree_n_ary()(concat)(*args), ''.join(args))
+
+    def test_tree_n_ary_processes(self):
+        pooled = tree_n_ary(processes=2, chunk_size=7)(concat)
+        for args in [('a',), tuple('abcdefg'), tuple('abcdefghijklmnopqrstuvwxyz')]:
+            self.assertEqual(pooled(*args), ''.join(args))
+
+
+class ProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.names = set(PROFILES)
+        self.default_timer, deco.default_timer = deco.default_timer, lambda: self.now
+
+    def tearDown(self):
+        deco.default_timer = self.default_timer
+        deco.PROFILING = True
+        for name in set(PROFILES) - self.names:
+            del PROFILES[name]
+
+    def spend(self, seconds):
+        self.now += seconds
+
+    def test_timed(self):
+        @timed
+        def work(seconds):
+            self.spend(seconds)
+        work(0.5)
+        work(1.5)
+        stat = PROFILES[MODULE + 'work']
+        self.assertEqual((stat.calls, stat.total, stat.self_time), (2, 2.0, None))
+        self.assertEqual(stat.percentile(50), 2.0 ** 19 / 1e6)  # 0.5 s is in [2**18, 2**19) us
+        self.assertEqual(stat.percentile(100), 2.0 ** 21 / 1e6)
+
+    def test_profile_self_time(self):
+        @profile
+        def inner():
+            self.spend(2)
+
+        @profile
+        def outer(depth):
+            self.spend(1)
+            if depth:
+                outer(depth - 1)
+            inner()
+        outer(1)
+        inner_stat, outer_stat = PROFILES[MODULE + 'inner'], PROFILES[MODULE + 'outer']
+        self.assertEqual((inner_stat.calls, inner_stat.total, inner_stat.self_time), (2, 4.0, 4.0))
+        self.assertEqual((outer_stat.calls, outer_stat.total, outer_stat.self_time), (2, 6.0, 2.0))
+
+    def test_profile_error(self):
+        @profile
+        def fail():
+            self.spend(1)
+            raise ValueError
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(PROFILES[MODULE + 'fail'].total, 1.0)
+
+    def test_profile_threads(self):
+        deco.default_timer = self.default_timer
+        entered, release = threading.Semaphore(0), threading.Event()
+
+        @profile
+        def wait():
+            entered.release()
+            release.wait()
+        threads = [threading.Thread(target=wait) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        entered.acquire()
+        entered.acquire()
+        start = self.default_timer()
+        deco.time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        stat = PROFILES[MODULE + 'wait']
+        # a slot per thread that called it, the counters are their sums
+        self.assertEqual(len([slot for slot in stat.slots if any(slot[deco.HISTOGRAM:])]), 2)
+        self.assertEqual(stat.calls, 2)
+        self.assertTrue(stat.total >= 2 * 0.1, stat.total)  # both calls, each thread has its own depth
+        self.assertTrue(stat.total <= 2 * (self.default_timer() - start) + 0.01, stat.total)
+
+    def test_profile_report(self):
+        @timed
+        def rare():
+            self.spend(3)
+
+        @profile
+        def often():
+            self.spend(1)
+        rare()
+        often()
+        often()
+        out = StringIO()
+        profile_report(sort='calls', out=out)
+        lines = [line for line in out.getvalue().splitlines() if line.startswith(('function', MODULE))]
+        self.assertEqual([line.split()[0] for line in lines], ['function', MODULE + 'often', MODULE + 'rare'])
+        self.assertEqual(lines[1].split()[1:4], ['2', '2.000000', '2.000000'])
+        self.assertEqual(lines[2].split()[1:4], ['1', '3.000000', '-'])
+
+        profile_reset()
+        stat = PROFILES[MODULE + 'often']
+        self.assertEqual((stat.calls, stat.total, stat.self_time), (0, 0.0, 0.0))
+        often()
+        self.assertEqual((stat.calls, stat.total), (1, 1.0))
+
+    def test_same_name(self):
+        @timed
+        def twin():
+            pass
+
+        @timed
+        def twin():
+            pass
+        self.assertTrue(MODULE + 'twin' in PROFILES and MODULE + 'twin#2' in PROFILES)
+
+    def test_disabled(self):
+        deco.PROFILING = False
+
+        def work():
+            pass
+        self.assertTrue(timed(work) is work)
+        self.assertTrue(profile(work) is work)
+        self.assertFalse(set(PROFILES) - self.names)
+
+
+if __name__ == '__main__':
+    unittest.main()
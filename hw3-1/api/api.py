@@ -4,14 +4,20 @@
 import abc
 import json
 import datetime
+import errno
 import logging
 import hashlib
 import uuid
 import re
 import os
+import redis
 import scoring
+import signal
 import argparse
+import threading
 import configparser
+import Queue
+from collections import OrderedDict
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from store import Storage
 
@@ -48,7 +54,15 @@ config = {
     "STORE_URL": 'localhost',
     "NUMBER_DB": 0,
     "TIMEOUT": 2,
+    "SERVER_MODE": "threading",
+    "WORKERS": 8,
+    "CACHE_SIZE": 10000,
+    "CACHE_TTL": 600,
+    "POOL_SIZE": 16,
+    "BREAKER_THRESHOLD": 3,
+    "PROBE_INTERVAL": 1,
 }
+SERVER_MODES = ('single', 'threading', 'prefork', 'async')
 
 
 def parse_config(default_config, path):
@@ -76,10 +90,13 @@ class ValidationError(Exception):
 class Field(object):
     __metaclass__ = abc.ABCMeta
     empty_values = ('', [], {})
+    creation_counter = 0  # the fields of a Request are checked in the order they are defined
 
     def __init__(self, nullable=False, required=False):
         self.required = required
         self.nullable = nullable
+        self.creation_counter = Field.creation_counter
+        Field.creation_counter += 1
 
     @abc.abstractmethod
     def check(self, value):
@@ -122,26 +139,31 @@ class EmailField(CharField):
 
 class PhoneField(Field):
     max_length = 11
+    pattern = re.compile(r'7\d{%d}\Z' % (max_length - 1))
 
     def check(self, value):
         value = super(PhoneField, self).check(value)
         if value is not None:
             value = str(value)
-            if not (isinstance(value, (int, str, unicode)) and
-                    (value == '' or (re.match(r'\d{11}$', str(value)) and
-                                     len(str(value)) == PhoneField.max_length and str(value)[0] == '7'))):
+            if value != '' and not PhoneField.pattern.match(value):
                 raise ValidationError('{} is invalid!'.format(self.__class__.__name__))
         return value
 
 
 class DateField(Field):
+    # what strptime(value, '%d.%m.%Y') accepts, without building its regex and taking its lock on every call
+    pattern = re.compile(r'(3[01]|[12]\d|0[1-9]|[1-9]| [1-9])\.(1[0-2]|0[1-9]|[1-9])\.(\d{4})\Z')
 
     def check(self, value):
         value = super(DateField, self).check(value)
         if isinstance(value, (str, unicode)) or value is None:
             if value is not None and len(value) > 0:
+                match = DateField.pattern.match(value)
                 try:
-                    value = datetime.datetime.strptime(value, '%d.%m.%Y')
+                    if match is None:
+                        raise ValueError
+                    day, month, year = match.groups()
+                    value = datetime.datetime(int(year), int(month), int(day))
                 except ValueError:
                     raise ValidationError('{} is invalid!'.format(self.__class__.__name__))
         else:
@@ -178,22 +200,48 @@ class ClientIDsField(Field):
         return value
 
 
+class RequestsField(Field):
+
+    def check(self, value):
+        value = super(RequestsField, self).check(value)
+        if value is not None and not (isinstance(value, list) and all(isinstance(i, dict) for i in value)):
+            raise ValidationError('{} is invalid!'.format(self.__class__.__name__))
+        return value
+
+
+class RequestMeta(abc.ABCMeta):
+    # collects the Field attributes of a Request class once, when the class is defined: they move from the class
+    # namespace to fields (the inherited ones first, a field redefined in a subclass keeps its place), their names
+    # become __slots__, checks - the plan of is_valid
+    def __new__(mcs, name, bases, attrs):
+        own = [(key, attrs.pop(key)) for key, value in attrs.items() if isinstance(value, Field)]
+        own.sort(key=lambda item: item[1].creation_counter)
+        inherited = set(key for base in bases for key, _ in getattr(base, 'fields', ()))
+        attrs['__slots__'] = tuple(attrs.get('__slots__', ())) + tuple(key for key, _ in own if key not in inherited)
+        cls = super(RequestMeta, mcs).__new__(mcs, name, bases, attrs)
+        fields = OrderedDict()
+        for base in reversed(cls.__mro__[1:]):  # every base has the fields of its own bases already
+            fields.update(getattr(base, 'fields', ()))
+        fields.update(own)
+        cls.fields = tuple(fields.items())
+        cls.checks = tuple((key, field.check) for key, field in cls.fields)
+        return cls
+
+
 class Request(object):
-    __metaclass__ = abc.ABCMeta
+    __metaclass__ = RequestMeta
+    __slots__ = ('invalid_fields', 'error_message')
 
-    def __init__(self, **kwargs):
-        for key in kwargs:
-            self.__setattr__(key, kwargs[key])
+    def __init__(self, **kwargs):  # the arguments which are not fields of the request are dropped
+        for key, _ in self.fields:
+            setattr(self, key, kwargs.get(key))
         self.invalid_fields = []
         self.error_message = None
 
     def is_valid(self):
-        for key, cls in self.__class__.__dict__.items():
-            if not isinstance(cls, Field):
-                continue
-            value = getattr(self, key) if key in self.__dict__ else None
+        for key, check in self.checks:
             try:
-                self.__setattr__(key, cls.check(value))
+                setattr(self, key, check(getattr(self, key)))
             except ValidationError:
                 self.invalid_fields.append(key)
         if self.invalid_fields:
@@ -225,6 +273,10 @@ class OnlineScoreRequest(Request):
         return False
 
 
+class BatchRequest(Request):
+    requests = RequestsField(required=True, nullable=False)
+
+
 class MethodRequest(Request):
     account = CharField(required=False, nullable=True)
     login = CharField(required=True, nullable=True)
@@ -253,8 +305,7 @@ def clients_interests(req, context, storage):
     if not method.is_valid():
         return method.error_message, INVALID_REQUEST
     context['nclients'] = len(method.client_ids)
-    for i in method.client_ids:
-        response[i] = scoring.get_interests(storage, i)
+    response = dict(zip(method.client_ids, scoring.get_interests_many(storage, method.client_ids)))
     return response, code
 
 
@@ -263,16 +314,87 @@ def online_score(req, context, storage):
     method = OnlineScoreRequest(**req.arguments)
     if not method.is_valid():
         return method.error_message, INVALID_REQUEST
-    context['has'] = req.arguments.keys()
-    arguments = {}
-    for i in req.arguments.keys():
-        arguments[i] = getattr(method, i)
-    response['score'] = 42 if req.is_admin else scoring.get_score(storage, **arguments)
+    arguments = score_arguments(method, req.arguments)
+    context['has'] = arguments.keys()
+    if req.is_admin:
+        response['score'] = 42
+    else:
+        response['score'] = scoring.get_score(storage, **arguments)
+        context['cache'] = storage.local.stats()
     return response, code
 
 
+def score_arguments(request, arguments):
+    # -> get_score kwargs: the fields of OnlineScoreRequest given in arguments, the other keys are dropped
+    return dict((key, getattr(request, key)) for key, _ in request.fields if key in arguments)
+
+
+def parse_batch(requests):
+    # -> responses with the errors of invalid requests filled in, [(number of the request, get_score kwargs)],
+    # [(number of the request, client_ids)]
+    responses = [None] * len(requests)
+    scores, interests = [], []
+    for i, item in enumerate(requests):
+        arguments = item.get('arguments')
+        if item.get('method') not in ('online_score', 'clients_interests'):
+            responses[i] = {'code': INVALID_REQUEST, 'error': 'No such method {}!'.format(item.get('method'))}
+            continue
+        if not isinstance(arguments, dict):
+            responses[i] = {'code': INVALID_REQUEST, 'error': 'arguments should be an object!'}
+            continue
+        if item['method'] == 'online_score':
+            request = OnlineScoreRequest(**arguments)
+        else:
+            request = ClientsInterestsRequest(**arguments)
+        if not request.is_valid():
+            responses[i] = {'code': INVALID_REQUEST, 'error': request.error_message}
+            continue
+        if item['method'] == 'online_score':
+            scores.append((i, score_arguments(request, arguments)))
+        else:
+            interests.append((i, request.client_ids))
+    return responses, scores, interests
+
+
+def fill_batch(responses, scores, score_values, interests, interest_values, context):
+    # interest_values -> interests of all the client_ids of interests in a row, None if the store failed
+    for (i, _), score in zip(scores, score_values):
+        responses[i] = {'code': OK, 'response': {'score': score}}
+    values = iter(interest_values or ())
+    for i, cids in interests:
+        if interest_values is None:
+            responses[i] = {'code': INTERNAL_ERROR, 'error': ERRORS[INTERNAL_ERROR]}
+        else:
+            responses[i] = {'code': OK, 'response': dict((cid, next(values)) for cid in cids)}
+    context['nrequests'] = len(responses)
+    context['nerrors'] = sum(1 for response in responses if response['code'] != OK)
+    return {'responses': responses}, OK
+
+
+def batch(req, context, storage):
+    # every request of req.arguments['requests'] -> {"method": ..., "arguments": {...}}, the auth of req is used
+    # for all of them; -> {"responses": [{"code": ..., "response" or "error": ...}, ...]} in the order of requests
+    method = BatchRequest(**req.arguments)
+    if not method.is_valid():
+        return method.error_message, INVALID_REQUEST
+    responses, scores, interests = parse_batch(method.requests)
+    score_values, interest_values = [], []
+    if scores:
+        if req.is_admin:
+            score_values = [42] * len(scores)
+        else:
+            score_values = scoring.get_scores(storage, [kw for _, kw in scores])
+            context['cache'] = storage.local.stats()
+    if interests:
+        try:
+            interest_values = scoring.get_interests_many(storage, [cid for _, cids in interests for cid in cids])
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+            interest_values = None
+    return fill_batch(responses, scores, score_values, interests, interest_values, context)
+
+
 def method_handler(request, ctx, store):
-    methods = dict(clients_interests=clients_interests, online_score=online_score)
+    methods = dict(clients_interests=clients_interests, online_score=online_score, batch=batch)
     request = MethodRequest(**request['body'])
     if not request.is_valid():
         return request.error_message, INVALID_REQUEST
@@ -284,6 +406,16 @@ def method_handler(request, ctx, store):
         return 'No such method {}!'.format(request.method), INVALID_REQUEST
 
 
+REQUEST_ID_HEADERS = ('x-request-id', 'http_x_request_id')  # the second one is the name read before
+
+
+def request_id(headers):  # headers -> mimetools.Message or a dict with lowercase names
+    for name in REQUEST_ID_HEADERS:
+        if headers.get(name):
+            return headers.get(name)
+    return uuid.uuid4().hex
+
+
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
         "method": method_handler
@@ -291,7 +423,7 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
     store = None
 
     def get_request_id(self, headers):
-        return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
+        return request_id(headers)
 
     def do_POST(self):
         response, code = {}, OK
@@ -329,6 +461,115 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
         return
 
 
+class ThreadPoolHTTPServer(HTTPServer):
+    """
+    Requests are handled by a fixed number of threads, accepted connections
+    wait for a free thread in a bounded queue.
+    """
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, workers=8):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.request_queue = Queue.Queue(workers * 16)
+        for _ in range(workers):
+            worker = threading.Thread(target=self.process_requests)
+            worker.daemon = self.daemon_threads
+            worker.start()
+
+    def process_requests(self):
+        while True:
+            request, client_address = self.request_queue.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.request_queue.put((request, client_address))
+
+
+def create_storage(conf):
+    return Storage(host=conf['STORE_URL'], port=conf['STORE_PORT'], db=conf['NUMBER_DB'], timeout=conf['TIMEOUT'],
+                   cache_size=conf['CACHE_SIZE'], cache_ttl=conf['CACHE_TTL'], pool_size=conf['POOL_SIZE'],
+                   breaker_threshold=conf['BREAKER_THRESHOLD'], probe_interval=conf['PROBE_INTERVAL'])
+
+
+def reap(pids):  # waits for every child of pids, the ones already reaped are skipped
+    for pid in pids:
+        while True:
+            try:
+                os.waitpid(pid, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+            break
+
+
+def fork_workers(serve, workers):
+    # serve() runs in workers child processes, e.g. on a listening socket created before fork: every child accepts
+    # on it, the kernel spreads connections; on SIGTERM or ^C the children are stopped and reaped
+    children = []
+
+    def stop(signum=None, frame=None):
+        raise SystemExit()
+
+    try:
+        for _ in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                try:
+                    serve()
+                except KeyboardInterrupt:
+                    pass
+                finally:
+                    os._exit(0)
+            children.append(pid)
+        signal.signal(signal.SIGTERM, stop)
+        logging.info("Started {} worker processes".format(len(children)))
+        reap(children)
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)  # the children are being stopped already
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        reap(children)
+
+
+def serve_prefork(server, conf):  # the caller closes the socket of server
+    def serve():
+        MainHTTPHandler.store = create_storage(conf)  # no redis connections inherited from the parent
+        server.serve_forever()
+    fork_workers(serve, conf['WORKERS'])
+
+
+def run_server(conf):
+    if conf['SERVER_MODE'] not in SERVER_MODES:
+        raise Exception('server_mode should be one of {}!'.format(', '.join(SERVER_MODES)))
+    if conf['SERVER_MODE'] == 'async':
+        import async_server  # it imports api itself
+        return async_server.serve(conf)
+    if conf['SERVER_MODE'] == 'threading':
+        server = ThreadPoolHTTPServer(("localhost", conf['PORT']), MainHTTPHandler, workers=conf['WORKERS'])
+    else:
+        server = HTTPServer(("localhost", conf['PORT']), MainHTTPHandler)
+    logging.info("Starting server at {0}, mode {1}".format(conf['PORT'], conf['SERVER_MODE']))
+    try:
+        if conf['SERVER_MODE'] == 'prefork':
+            serve_prefork(server, conf)  # every child creates its own storage
+        else:
+            MainHTTPHandler.store = create_storage(conf)
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
 if __name__ == "__main__":
     parser_config = argparse.ArgumentParser()
     parser_config.add_argument('-c', '--config',
@@ -340,12 +581,4 @@ if __name__ == "__main__":
         raise Exception("Bad config!")
     logging.basicConfig(filename=config['LOGGING_TO_FILE'], level=config['LOGGING_LEVEL'],
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    MainHTTPHandler.store = Storage(host=config['STORE_URL'], port=config['STORE_PORT'], db=config['NUMBER_DB'],
-                                    timeout=config['TIMEOUT'])
-    server = HTTPServer(("localhost", config['PORT']), MainHTTPHandler)
-    logging.info("Starting server at %s" % config['PORT'])
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    server.server_close()
+    run_server(config)
@@ -0,0 +1,650 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Scoring API on an event loop (epoll): the same /method contract as api.MainHTTPHandler, sockets are non-blocking,
+# redis is spoken to over a non-blocking pipelined connection. With workers > 1 every one of workers processes
+# runs its own loop on one listening socket.
+# python async_server.py -c config_api, or server_mode = async in config_api.
+
+import argparse
+import errno
+import heapq
+import json
+import logging
+import os
+import random
+import select
+import socket
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler
+from collections import deque
+
+import redis
+
+import api
+import scoring
+from store import LocalCache
+
+READ, WRITE = 1, 4  # the same as select.EPOLLIN, select.EPOLLOUT
+ERROR = 8 | 16  # select.EPOLLERR | select.EPOLLHUP
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS)
+INCOMPLETE = object()  # parse_reply: the reply is not read till the end yet
+
+
+class EventLoop(object):
+    """
+    Calls handle_read/handle_write of the object registered for a file
+    descriptor when it is ready, and the callbacks of call_later when
+    their time comes. epoll where there is one, select elsewhere.
+    """
+
+    def __init__(self):
+        self.handlers = {}  # fd -> [object, events]
+        self.timers = []  # heap of (time, number, callback)
+        self.timer_number = 0
+        self.epoll = select.epoll() if hasattr(select, 'epoll') else None
+        self.running = False
+
+    def register(self, fd, handler, events=READ):
+        self.handlers[fd] = [handler, events]
+        if self.epoll is not None:
+            self.epoll.register(fd, events)
+
+    def modify(self, fd, events):
+        if fd in self.handlers and self.handlers[fd][1] != events:
+            self.handlers[fd][1] = events
+            if self.epoll is not None:
+                self.epoll.modify(fd, events)
+
+    def unregister(self, fd):
+        if self.handlers.pop(fd, None) is not None and self.epoll is not None:
+            self.epoll.unregister(fd)
+
+    def call_later(self, delay, callback):
+        self.timer_number += 1
+        heapq.heappush(self.timers, (time.time() + delay, self.timer_number, callback))
+
+    def poll(self, timeout):  # -> [(fd, events)]
+        if self.epoll is not None:
+            try:
+                return self.epoll.poll(timeout)
+            except IOError as e:
+                if e.errno == errno.EINTR:
+                    return []
+                raise
+        readers = [fd for fd, (_, events) in self.handlers.items() if events & READ]
+        writers = [fd for fd, (_, events) in self.handlers.items() if events & WRITE]
+        try:
+            readable, writable, _ = select.select(readers, writers, [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        events = dict((fd, READ) for fd in readable)
+        for fd in writable:
+            events[fd] = events.get(fd, 0) | WRITE
+        return events.items()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            timeout = max(0, min(self.timers[0][0] - time.time(), 1)) if self.timers else 1
+            for fd, events in self.poll(timeout):
+                if fd in self.handlers and events & (READ | ERROR):
+                    self.call(self.handlers[fd][0].handle_read)
+                if fd in self.handlers and events & (WRITE | ERROR):
+                    self.call(self.handlers[fd][0].handle_write)
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                self.call(heapq.heappop(self.timers)[2])
+
+    @staticmethod
+    def call(callback):  # an error of one connection must not stop the others
+        try:
+            callback()
+        except Exception as e:
+            logging.exception("Unexpected error: %s" % e)
+
+    def stop(self):
+        self.running = False
+
+
+def encode_command(args):  # -> RESP array of bulk strings
+    parts = ['*{}\r\n'.format(len(args))]
+    for arg in args:
+        arg = arg.encode('utf-8') if isinstance(arg, unicode) else str(arg)
+        parts.append('${0}\r\n{1}\r\n'.format(len(arg), arg))
+    return ''.join(parts)
+
+
+def parse_reply(data, pos=0):  # -> (reply, position after it) or INCOMPLETE, an error reply -> ResponseError
+    end = data.find('\r\n', pos)
+    if end < 0:
+        return INCOMPLETE
+    kind, line, pos = data[pos], data[pos + 1:end], end + 2
+    if kind == '+':
+        return line, pos
+    if kind == '-':
+        return redis.exceptions.ResponseError(line), pos
+    if kind == ':':
+        return int(line), pos
+    if kind == '$':
+        length = int(line)
+        if length < 0:
+            return None, pos
+        if len(data) < pos + length + 2:
+            return INCOMPLETE
+        return data[pos:pos + length], pos + length + 2
+    if kind == '*':
+        count = int(line)
+        if count < 0:
+            return None, pos
+        items = []
+        for _ in range(count):
+            reply = parse_reply(data, pos)
+            if reply is INCOMPLETE:
+                return INCOMPLETE
+            item, pos = reply
+            items.append(item)
+        return items, pos
+    raise redis.exceptions.InvalidResponse('Protocol error: {!r}'.format(data[pos - len(line) - 3:end]))
+
+
+class RedisConnection(object):
+    """
+    Non-blocking connection to redis: commands are written without waiting
+    for the replies to the previous ones (pipelining), every reply goes to
+    the callback of its command: callback(reply, error). When the connection
+    breaks or a reply is late for timeout seconds all the waiting callbacks
+    get the error. A new connection is not tried for a random time between
+    half and all of backoff_base * 2 ** (failures in a row), at most
+    backoff_cap seconds; until then commands fail at once. The loop is not
+    stopped by time.sleep as in store.reconnect.
+    """
+    backoff_base = 0.05
+    backoff_cap = 1
+
+    def __init__(self, loop, host='localhost', port=6379, db=0, timeout=2):
+        self.loop = loop
+        self.host, self.port, self.db, self.timeout = host, port, db, timeout
+        self.sock = None
+        self.connecting = False
+        self.out = ''
+        self.buffer = ''
+        self.pending = deque()  # callbacks of the commands sent, in order
+        self.retry_at = 0
+        self.failures = 0
+        self.last_reply = 0
+        self.checking = False
+
+    def command(self, callback, *args):
+        if self.sock is None:
+            if time.time() < self.retry_at:
+                callback(None, redis.exceptions.ConnectionError(
+                    'Error connecting to {0}:{1}, retry later.'.format(self.host, self.port)))
+                return
+            try:
+                self.connect()
+            except socket.error as e:
+                self.fail(redis.exceptions.ConnectionError('Error {0} connecting to {1}:{2}.'.format(
+                    e.errno, self.host, self.port)))
+                callback(None, redis.exceptions.ConnectionError(str(e)))
+                return
+        if not self.pending:
+            self.last_reply = time.time()
+        self.out += encode_command(args)
+        self.pending.append(callback)
+        self.loop.modify(self.sock.fileno(), READ | WRITE)
+        if not self.checking:
+            self.checking = True
+            self.loop.call_later(self.timeout, self.check_timeout)
+
+    def connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        code = sock.connect_ex((self.host, self.port))
+        if code not in (0,) + WOULD_BLOCK:
+            sock.close()
+            raise socket.error(code, os.strerror(code))
+        self.sock, self.connecting = sock, True
+        self.loop.register(sock.fileno(), self, READ | WRITE)
+        if self.db:
+            self.out += encode_command(('SELECT', self.db))
+            self.pending.append(lambda reply, error: None)
+
+    def check_timeout(self):
+        self.checking = False
+        if not self.pending:
+            return
+        if time.time() - self.last_reply >= self.timeout:
+            self.fail(redis.exceptions.TimeoutError('Timeout reading from {0}:{1}'.format(self.host, self.port)))
+        else:
+            self.checking = True
+            self.loop.call_later(self.timeout, self.check_timeout)
+
+    def fail(self, error):
+        if self.sock is not None:
+            self.loop.unregister(self.sock.fileno())
+            self.sock.close()
+        self.sock, self.connecting, self.out, self.buffer = None, False, '', ''
+        delay = min(self.backoff_cap, self.backoff_base * 2 ** min(self.failures, 32))
+        self.retry_at = time.time() + random.uniform(delay / 2.0, delay)
+        self.failures += 1
+        pending, self.pending = self.pending, deque()
+        for callback in pending:
+            callback(None, error)
+
+    def handle_write(self):
+        if self.connecting:
+            code = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if code:
+                self.fail(redis.exceptions.ConnectionError('Error {0} connecting to {1}:{2}. {3}.'.format(
+                    code, self.host, self.port, os.strerror(code))))
+                return
+            self.connecting = False
+        try:
+            sent = self.sock.send(self.out)
+        except socket.error as e:
+            if e.errno not in WOULD_BLOCK:
+                self.fail(redis.exceptions.ConnectionError(str(e)))
+            return
+        self.out = self.out[sent:]
+        if not self.out:
+            self.loop.modify(self.sock.fileno(), READ)
+
+    def handle_read(self):
+        try:
+            data = self.sock.recv(1 << 16)
+        except socket.error as e:
+            if e.errno not in WOULD_BLOCK:
+                self.fail(redis.exceptions.ConnectionError(str(e)))
+            return
+        if not data:
+            self.fail(redis.exceptions.ConnectionError('Connection closed by server.'))
+            return
+        self.buffer += data
+        self.last_reply = time.time()
+        pos = 0
+        while self.pending:
+            reply = parse_reply(self.buffer, pos)
+            if reply is INCOMPLETE:
+                break
+            reply, pos = reply
+            self.failures = 0
+            callback = self.pending.popleft()
+            if isinstance(reply, redis.exceptions.ResponseError):
+                callback(None, reply)
+            else:
+                callback(reply, None)
+        self.buffer = self.buffer[pos:]
+
+
+class AsyncStorage(object):
+    """store.Storage for the event loop: the value goes to the callback instead of being returned."""
+    mget_chunk = 1000
+
+    def __init__(self, loop, host='localhost', port=6379, db=0, timeout=2, cache_size=10000, cache_ttl=600):
+        self.host, self.port, self.db = host, port, db
+        self.connection = RedisConnection(loop, host, port, db, timeout)
+        self.local = LocalCache(cache_size, cache_ttl)
+
+    def get_many(self, keys, callback):  # callback(values in the order of keys, error)
+        chunks = [keys[i:i + self.mget_chunk] for i in xrange(0, len(keys), self.mget_chunk)]
+        if not chunks:
+            callback([], None)
+            return
+        replies = [None] * len(chunks)
+        state = {'left': len(chunks), 'error': None}
+
+        def on_reply(i, reply, error):
+            replies[i] = reply
+            state['error'] = state['error'] or error
+            state['left'] -= 1
+            if not state['left']:
+                if state['error'] is not None:
+                    callback(None, state['error'])
+                else:
+                    callback([value for chunk in replies for value in chunk], None)
+        for i, chunk in enumerate(chunks):
+            self.connection.command(lambda reply, error, i=i: on_reply(i, reply, error), 'MGET', *chunk)
+
+    def cache_get(self, key, callback):  # callback(value), the local tier first, None if redis failed
+        value = self.local.get(key)
+        if value is not None:
+            return callback(value)
+        reply = {}
+        self.connection.command(lambda value_, error: reply.update(value=value_ if error is None else None), 'GET', key)
+
+        def on_ttl(ttl, error):  # the replies come in order: GET has been answered
+            self.local.fetched(key, reply['value'], ttl if error is None else None)
+            callback(reply['value'])
+        self.connection.command(on_ttl, 'TTL', key)
+
+    def cache_get_many(self, keys, callback):  # callback(values), only the local misses go to redis
+        values = [self.local.get(key) for key in keys]
+        missed = [key for key, value in zip(keys, values) if value is None]
+        if not missed:
+            return callback(values)
+        reply = {}
+        self.get_many(missed, lambda values_, error: reply.update(values=values_ or [None] * len(missed)))
+        ttls = []
+
+        def on_ttl(ttl, error):
+            ttls.append(ttl if error is None else None)
+            if len(ttls) < len(missed):
+                return
+            remote = dict(zip(missed, zip(reply['values'], ttls)))
+            for key_, (value_, ttl_) in remote.items():
+                self.local.fetched(key_, value_, ttl_)
+            callback([value if value is not None else remote[key][0] for key, value in zip(keys, values)])
+        for key in missed:
+            self.connection.command(on_ttl, 'TTL', key)
+
+    def cache_set(self, key, score, time_store):
+        self.local.put(key, score, time_store)
+        self.connection.command(lambda reply, error: None, 'SET', key, score, 'EX', time_store)
+
+    def cache_set_many(self, mapping, time_store):
+        for key, score in mapping.items():
+            self.cache_set(key, score, time_store)
+
+
+# api.method_handler and the methods for AsyncStorage: done(response, code) is called once the store answered
+
+def online_score(req, context, storage, done):
+    method = api.OnlineScoreRequest(**req.arguments)
+    if not method.is_valid():
+        return done(method.error_message, api.INVALID_REQUEST)
+    arguments = api.score_arguments(method, req.arguments)
+    context['has'] = arguments.keys()
+    if req.is_admin:
+        return done({'score': 42}, api.OK)
+
+    def on_score(score):
+        context['cache'] = storage.local.stats()
+        done({'score': score}, api.OK)
+    scoring.get_score_async(storage, on_score, **arguments)
+
+
+def clients_interests(req, context, storage, done):
+    method = api.ClientsInterestsRequest(**req.arguments)
+    if not method.is_valid():
+        return done(method.error_message, api.INVALID_REQUEST)
+    context['nclients'] = len(method.client_ids)
+
+    def on_interests(interests, error):
+        if error is not None:
+            return done({}, api.INTERNAL_ERROR)
+        done(dict(zip(method.client_ids, interests)), api.OK)
+    scoring.get_interests_async(storage, method.client_ids, on_interests)
+
+
+def batch(req, context, storage, done):
+    method = api.BatchRequest(**req.arguments)
+    if not method.is_valid():
+        return done(method.error_message, api.INVALID_REQUEST)
+    responses, scores, interests = api.parse_batch(method.requests)
+    values = {'scores': [], 'interests': []}
+    waiting = set()
+
+    def finish(name, value):
+        values[name] = value
+        waiting.discard(name)
+        if not waiting:
+            done(*api.fill_batch(responses, scores, values['scores'], interests, values['interests'], context))
+    if scores and not req.is_admin:
+        waiting.add('scores')
+    if interests:
+        waiting.add('interests')
+    if scores and req.is_admin:
+        values['scores'] = [42] * len(scores)
+    if not waiting:
+        return done(*api.fill_batch(responses, scores, values['scores'], interests, values['interests'], context))
+    if 'scores' in waiting:
+        def on_scores(scores_):
+            context['cache'] = storage.local.stats()
+            finish('scores', scores_)
+        scoring.get_scores_async(storage, [kw for _, kw in scores], on_scores)
+    if 'interests' in waiting:
+        scoring.get_interests_async(storage, [cid for _, cids in interests for cid in cids],
+                                    lambda interests_, error: finish('interests', interests_))
+
+
+def method_handler(request, ctx, store, done):
+    methods = dict(clients_interests=clients_interests, online_score=online_score, batch=batch)
+    request = api.MethodRequest(**request['body'])
+    if not request.is_valid():
+        return done(request.error_message, api.INVALID_REQUEST)
+    if not api.check_auth(request):
+        return done('Forbidden', api.FORBIDDEN)
+    if request.method not in methods:
+        return done('No such method {}!'.format(request.method), api.INVALID_REQUEST)
+    methods[request.method](request, ctx, store, done)
+
+
+class HTTPConnection(object):
+    """
+    One client: reads a request, answers it as api.MainHTTPHandler does,
+    closes the connection. The client has timeout seconds to send the
+    request and timeout seconds more to read the answer, the time the
+    store takes is not counted: a client which sends nothing or half a
+    request does not keep its socket forever.
+    """
+    max_head = 1 << 16
+    max_body = 1 << 20
+    timeout = 10
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.buffer = ''
+        self.out = ''
+        self.answered = False
+        self.deadline = time.time() + self.timeout
+        server.loop.call_later(self.timeout, self.check_deadline)
+
+    def check_deadline(self):
+        if self.sock is None or (self.answered and not self.out):  # closed or waiting for the store
+            return
+        left = self.deadline - time.time()
+        if left > 0:
+            self.server.loop.call_later(left, self.check_deadline)
+            return
+        logging.info('Connection timed out after {} seconds'.format(self.timeout))
+        self.close()
+
+    def handle_read(self):
+        try:
+            data = self.sock.recv(1 << 16)
+        except socket.error as e:
+            if e.errno not in WOULD_BLOCK:
+                self.close()
+            return
+        if not data:
+            self.close()
+            return
+        if self.answered:
+            return
+        self.buffer += data
+        head_end = self.buffer.find('\r\n\r\n')
+        if head_end < 0:
+            if len(self.buffer) > self.max_head:
+                self.respond(api.BAD_REQUEST, {"error": api.ERRORS[api.BAD_REQUEST], "code": api.BAD_REQUEST})
+            return
+        lines = self.buffer[:head_end].split('\r\n')
+        request_line = lines[0].split()
+        headers = dict((name.strip().lower(), value.strip())
+                       for name, _, value in (line.partition(':') for line in lines[1:]))
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            length = -1
+        if len(request_line) != 3 or not 0 <= length <= self.max_body:
+            self.respond(api.BAD_REQUEST, {"error": api.ERRORS[api.BAD_REQUEST], "code": api.BAD_REQUEST})
+            return
+        if len(self.buffer) < head_end + 4 + length:
+            return
+        self.answered = True
+        if request_line[0] != 'POST':
+            self.respond(501, {"error": "Unsupported method ({!r})".format(request_line[0]), "code": 501})
+            return
+        self.server.handle_request(self, request_line[1], headers, self.buffer[head_end + 4:head_end + 4 + length])
+
+    def respond(self, code, body):
+        self.answered = True
+        payload = json.dumps(body)
+        self.out = ('HTTP/1.0 {0} {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\n'
+                    'Connection: close\r\n\r\n{3}').format(
+            code, BaseHTTPRequestHandler.responses.get(code, ('',))[0], len(payload), payload)
+        if self.sock is not None:
+            self.server.loop.modify(self.sock.fileno(), READ | WRITE)
+            self.deadline = time.time() + self.timeout
+            self.server.loop.call_later(self.timeout, self.check_deadline)
+
+    def handle_write(self):
+        if not self.out:
+            return
+        try:
+            sent = self.sock.send(self.out)
+        except socket.error as e:
+            if e.errno not in WOULD_BLOCK:
+                self.close()
+            return
+        self.out = self.out[sent:]
+        if not self.out:
+            self.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.server.loop.unregister(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+
+
+def listen(server_address, backlog=1024):  # -> non-blocking listening socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(server_address)
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class AsyncHTTPServer(object):
+    router = {
+        "method": method_handler
+    }
+    accept_pause = 0.1  # seconds the listening socket is not polled when the process is out of descriptors
+
+    def __init__(self, loop, server_address, store, backlog=1024, sock=None):  # sock -> a listening socket to use
+        self.loop = loop
+        self.store = store
+        self.sock = listen(server_address, backlog) if sock is None else sock
+        self.server_address = self.sock.getsockname()
+        loop.register(self.sock.fileno(), self)
+
+    def handle_read(self):
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except socket.error as e:
+                if e.errno in (errno.EMFILE, errno.ENFILE):
+                    # the pending connection stays in the backlog and the level-triggered listener would fire
+                    # again at once: stop polling it until some connections are closed
+                    logging.error('Out of file descriptors, accepting is paused for {} s'.format(self.accept_pause))
+                    self.loop.unregister(self.sock.fileno())
+                    self.loop.call_later(self.accept_pause, self.resume_accept)
+                    return
+                if e.errno in WOULD_BLOCK or e.errno == errno.ECONNABORTED:
+                    return
+                raise
+            sock.setblocking(False)
+            self.loop.register(sock.fileno(), HTTPConnection(self, sock))
+
+    def resume_accept(self):
+        if self.sock is not None:
+            self.loop.register(self.sock.fileno(), self)
+
+    def handle_write(self):
+        pass
+
+    def handle_request(self, connection, path, headers, data_string):  # MainHTTPHandler.do_POST
+        context = {"request_id": api.request_id(headers)}
+
+        def done(response, code):
+            if code not in api.ERRORS:
+                r = {"response": response, "code": code}
+            else:
+                r = {"error": response or api.ERRORS.get(code, "Unknown Error"), "code": code}
+            context.update(r)
+            logging.info(context)
+            connection.respond(code, r)
+
+        try:
+            request = json.loads(data_string)
+        except ValueError:
+            logging.exception("Could not read data!")
+            return done({}, api.BAD_REQUEST)
+        if not request:
+            return done({}, api.OK)
+        route = path.strip("/")
+        logging.info("%s: %s %s" % (path, data_string, context["request_id"]))
+        if route not in self.router:
+            return done({}, api.NOT_FOUND)
+        answered = []
+
+        def done_once(response, code):  # an error raised after done must not answer twice
+            if not answered:
+                answered.append(code)
+                done(response, code)
+        try:
+            self.router[route]({"body": request, "headers": headers}, context, self.store, done_once)
+        except Exception as e:
+            logging.exception("Unexpected error: %s" % e)
+            done_once({}, api.INTERNAL_ERROR)
+
+    def close(self):
+        self.loop.unregister(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+
+
+def serve(conf):
+    # workers > 1 -> an event loop in every one of workers child processes on the socket created before fork,
+    # as in prefork; otherwise the loop runs in this process
+    sock = listen(("localhost", conf['PORT']))
+
+    def serve_loop():
+        loop = EventLoop()
+        store = AsyncStorage(loop, host=conf['STORE_URL'], port=conf['STORE_PORT'], db=conf['NUMBER_DB'],
+                             timeout=conf['TIMEOUT'], cache_size=conf['CACHE_SIZE'], cache_ttl=conf['CACHE_TTL'])
+        server = AsyncHTTPServer(loop, None, store, sock=sock)
+        try:
+            loop.run()
+        finally:
+            server.close()
+
+    logging.info("Starting async server at {0}, {1} workers".format(conf['PORT'], conf['WORKERS']))
+    try:
+        if conf['WORKERS'] > 1:
+            api.fork_workers(serve_loop, conf['WORKERS'])
+        else:
+            serve_loop()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+
+
+if __name__ == "__main__":
+    parser_config = argparse.ArgumentParser()
+    parser_config.add_argument('-c', '--config',
+                               default="{}/config_api".format(os.path.dirname(os.path.abspath(__file__))))
+    path_config = parser_config.parse_args()
+    try:
+        config = api.parse_config(api.config, path_config.config)
+    except Exception:
+        raise Exception("Bad config!")
+    logging.basicConfig(filename=config['LOGGING_TO_FILE'], level=config['LOGGING_LEVEL'],
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    serve(config)
@@ -14,6 +14,13 @@ def create_config(path):
     config.set('Config_api', 'STORE_URL', 'localhost')
     config.set('Config_api', 'NUMBER_DB', '0')
     config.set('Config_api', 'TIMEOUT', '2')
+    config.set('Config_api', 'SERVER_MODE', 'threading')
+    config.set('Config_api', 'WORKERS', '8')
+    config.set('Config_api', 'CACHE_SIZE', '10000')
+    config.set('Config_api', 'CACHE_TTL', '600')
+    config.set('Config_api', 'POOL_SIZE', '16')
+    config.set('Config_api', 'BREAKER_THRESHOLD', '3')
+    config.set('Config_api', 'PROBE_INTERVAL', '1')
 
     with open(path, 'w') as config_file:
         config.write(config_file)
@@ -6,7 +6,7 @@ import redis
 import logging
 
 
-def get_score(store, phone=None, email=None, birthday=None, gender=None, first_name=None, last_name=None):
+def score_key(phone=None, email=None, birthday=None, gender=None, first_name=None, last_name=None):
     key_parts = [
         first_name.encode('utf-8') if first_name is not None else "",
         last_name.encode('utf-8') if last_name is not None else "",
@@ -15,13 +15,11 @@ def get_score(store, phone=None, email=None, birthday=None, gender=None, first_n
         str(gender) if gender is not None else "",
         email.encode('utf-8') if email is not None else "",
     ]
-    key = "uid:" + hashlib.md5("".join(key_parts)).hexdigest()
-    # try get from cache,
-    # fallback to heavy calculation in case of cache miss
-    value = store.cache_get(key)
-    score = float(value) if value else 0
-    if score:
-        return score
+    return "uid:" + hashlib.md5("".join(key_parts)).hexdigest()
+
+
+def compute_score(phone=None, email=None, birthday=None, gender=None, first_name=None, last_name=None):
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -30,11 +28,44 @@ def get_score(store, phone=None, email=None, birthday=None, gender=None, first_n
         score += 1.5
     if first_name and last_name:
         score += 0.5
+    return score
+
+
+def get_score(store, phone=None, email=None, birthday=None, gender=None, first_name=None, last_name=None):
+    key = score_key(phone, email, birthday, gender, first_name, last_name)
+    # try get from cache,
+    # fallback to heavy calculation in case of cache miss
+    value = store.cache_get(key)
+    score = float(value) if value else 0
+    if score:
+        return score
+    score = compute_score(phone, email, birthday, gender, first_name, last_name)
     # cache for 60 minutes
     store.cache_set(key, score, 60 * 60)
     return score
 
 
+def scores_from_cache(keys, values, arguments):
+    # -> scores, {key: score} computed for the cache misses
+    scores, computed = [], {}
+    for key, value, kwargs in zip(keys, values or [None] * len(keys), arguments):
+        score = float(value) if value else 0
+        if not score:
+            score = computed[key] = compute_score(**kwargs)
+        scores.append(score)
+    return scores, computed
+
+
+def get_scores(store, arguments):
+    # arguments -> list of get_score kwargs, one round trip for all the cache lookups
+    # and one for storing the scores computed
+    keys = [score_key(**kwargs) for kwargs in arguments]
+    scores, computed = scores_from_cache(keys, store.cache_get_many(keys), arguments)
+    if computed:
+        store.cache_set_many(computed, 60 * 60)
+    return scores
+
+
 def get_interests(store, cid):
     try:
         r = store.get("i:%s" % cid)
@@ -43,3 +74,51 @@ def get_interests(store, cid):
             store.host, store.port, store.db))
         raise e
     return json.loads(r) if r else []
+
+
+def get_interests_many(store, cids):  # -> list of interests in the order of cids, one round trip
+    try:
+        values = store.get_many(["i:%s" % cid for cid in cids])
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+        logging.error('Connection to redis is failed! Address: host {0}, port {1}, db {2}'.format(
+            store.host, store.port, store.db))
+        raise e
+    return [json.loads(r) if r else [] for r in values]
+
+
+# The same for async_server.AsyncStorage: the result goes to callback once redis answered,
+# errors of the cache are not errors, as with Storage.cache_get.
+
+def get_score_async(store, callback, phone=None, email=None, birthday=None, gender=None, first_name=None,
+                    last_name=None):  # callback(score)
+    key = score_key(phone, email, birthday, gender, first_name, last_name)
+
+    def on_value(value):
+        score = float(value) if value else 0
+        if not score:
+            score = compute_score(phone, email, birthday, gender, first_name, last_name)
+            store.cache_set(key, score, 60 * 60)
+        callback(score)
+    store.cache_get(key, on_value)
+
+
+def get_scores_async(store, arguments, callback):  # callback(scores)
+    keys = [score_key(**kwargs) for kwargs in arguments]
+
+    def on_values(values):
+        scores, computed = scores_from_cache(keys, values, arguments)
+        if computed:
+            store.cache_set_many(computed, 60 * 60)
+        callback(scores)
+    store.cache_get_many(keys, on_values)
+
+
+def get_interests_async(store, cids, callback):  # callback(interests in the order of cids, error)
+    def on_values(values, error):
+        if error is not None:
+            logging.error('Connection to redis is failed! Address: host {0}, port {1}, db {2}'.format(
+                store.host, store.port, store.db))
+            callback(None, error)
+            return
+        callback([json.loads(r) if r else [] for r in values], None)
+    store.get_many(["i:%s" % cid for cid in cids], on_values)
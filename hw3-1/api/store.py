@@ -3,20 +3,33 @@
 
 import redis
 import logging
+import random
+import threading
 import time
 import functools
+from collections import OrderedDict
 
 
 def reconnect(num_attempts):
+    # between the attempts sleeps a random time up to backoff_base * 2 ** attempt, at most backoff_cap;
+    # fails at once while the circuit breaker of the storage is open
     def deco(fun):
         @functools.wraps(fun)
         def wrapper(self, *args, **kwargs):
             for i in range(num_attempts):
+                if self.breaker.opened:
+                    raise redis.exceptions.ConnectionError('Redis at {0}:{1} is unhealthy, the circuit breaker is '
+                                                           'open.'.format(self.host, self.port))
                 try:
                     logging.debug('Function: {}'.format(fun.__name__))
-                    return fun(self, *args, **kwargs)
+                    res = fun(self, *args, **kwargs)
                 except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
-                    time.sleep(0.3)
+                    if i + 1 < num_attempts:
+                        time.sleep(random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** i)))
+                else:
+                    self.breaker.success()
+                    return res
+            self.breaker.failure()
             raise e
         return wrapper
     return deco
@@ -31,23 +44,130 @@ def cache(fun):
     return wrapper
 
 
+class CircuitBreaker(object):
+    """
+    Opens after threshold calls to redis in a row have failed. While it is
+    open the calls fail at once, and a background thread calls probe every
+    interval seconds. The breaker closes again once the probe succeeds.
+    """
+
+    def __init__(self, probe, threshold=3, interval=1):
+        self.probe = probe
+        self.threshold = threshold
+        self.interval = interval
+        self.failures = 0
+        self.opened = False
+        self.lock = threading.Lock()
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.opened or self.failures < self.threshold:
+                return
+            self.opened = True
+        logging.error('Redis is unhealthy, the circuit breaker is open')
+        thread = threading.Thread(target=self.watch)
+        thread.daemon = True
+        thread.start()
+
+    def watch(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.probe()
+            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+                continue
+            with self.lock:
+                self.failures = 0
+                self.opened = False
+            logging.info('Redis is healthy again, the circuit breaker is closed')
+            return
+
+
+class LocalCache(object):
+    """
+    The in-process tier in front of the redis cache: at most maxsize values,
+    the least recently used one is dropped first, a value lives no longer
+    than ttl seconds and no longer than it has left in redis. Counts hits
+    of both tiers: get -> local lookups, fetched -> redis lookups.
+    """
+
+    def __init__(self, maxsize=10000, ttl=600, timer=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.values = OrderedDict()  # key -> (value, expires at), the most recently used last
+        self.lock = threading.Lock()
+        self.hits = {'local': 0, 'redis': 0}
+        self.lookups = {'local': 0, 'redis': 0}
+
+    def get(self, key):  # -> value or None
+        with self.lock:
+            self.lookups['local'] += 1
+            item = self.values.pop(key, None)
+            if item is None or item[1] <= self.timer():
+                return None
+            self.values[key] = item
+            self.hits['local'] += 1
+            return item[0]
+
+    def put(self, key, value, ttl=None):  # ttl -> seconds left in redis, None if unknown
+        if not self.maxsize:
+            return
+        ttl = self.ttl if ttl is None or ttl < 0 else min(ttl, self.ttl)
+        with self.lock:
+            self.values.pop(key, None)
+            self.values[key] = (value, self.timer() + ttl)
+            while len(self.values) > self.maxsize:
+                self.values.popitem(last=False)
+
+    def fetched(self, key, value, ttl=None):  # the value for key came from redis, None is a miss
+        with self.lock:
+            self.lookups['redis'] += 1
+            self.hits['redis'] += value is not None
+        if value is not None:
+            self.put(key, value, ttl)
+
+    def stats(self):  # -> {tier: hit ratio since the start of the process}
+        with self.lock:
+            return dict((tier, round(float(self.hits[tier]) / self.lookups[tier], 3) if self.lookups[tier] else 0.0)
+                        for tier in self.lookups)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
 class Storage(object):
     num_reconnect = 5
+    backoff_base = 0.05  # seconds, see reconnect
+    backoff_cap = 1
+    mget_chunk = 1000  # keys per MGET, a huge list of ids does not become one huge command
 
-    def __init__(self, host='localhost', port=6379, db=0, timeout=2):
+    def __init__(self, host='localhost', port=6379, db=0, timeout=2, cache_size=10000, cache_ttl=600,
+                 pool_size=16, breaker_threshold=3, probe_interval=1):
         self.host = host
         self.port = port
         self.db = db
         self.timeout = timeout
         self.interests = ["cars", "pets", "travel", "hi-tech", "sport",
                           "music", "books", "tv", "cinema", "geek", "otus"]
-        self.storage = redis.Redis(
+        # the threads of the server share pool_size connections, a thread waits up to timeout for a free one
+        self.pool = redis.BlockingConnectionPool(
+            max_connections=pool_size,
+            timeout=self.timeout,
             host=self.host,
             port=self.port,
             db=self.db,
             socket_timeout=self.timeout,
             socket_connect_timeout=self.timeout
         )
+        self.storage = redis.Redis(connection_pool=self.pool)
+        self.local = LocalCache(cache_size, cache_ttl)
+        self.breaker = CircuitBreaker(self.storage.ping, breaker_threshold, probe_interval)
 
     @reconnect(num_reconnect)
     def get(self, key):
@@ -57,13 +177,74 @@ class Storage(object):
     def set(self, key, value):
         return self.storage.set(key, value)
 
+    def cache_get(self, key):  # the local tier first, then redis
+        val = self.local.get(key)
+        if val is None:
+            val, ttl = self.remote_cache_get(key) or (None, None)
+            self.local.fetched(key, val, ttl)
+        return val
+
+    def cache_set(self, key, score, time_store):  # the local tier works while redis is down
+        self.local.put(key, score, time_store)
+        self.remote_cache_set(key, score, time_store)
+
     @cache
     @reconnect(num_reconnect)
-    def cache_get(self, key):
-        val = self.storage.get(key)
-        return val if val is not None else None
+    def remote_cache_get(self, key):  # -> (value, seconds it has left), one round trip
+        pipeline = self.storage.pipeline(transaction=False)
+        pipeline.get(key)
+        pipeline.ttl(key)
+        return pipeline.execute()
 
     @cache
     @reconnect(num_reconnect)
-    def cache_set(self, key, score, time_store):
+    def remote_cache_set(self, key, score, time_store):
         self.storage.set(key, score, time_store)
+
+    def mget(self, keys):  # one round trip: a pipeline of MGETs of at most mget_chunk keys each
+        if not keys:
+            return []
+        pipeline = self.storage.pipeline(transaction=False)
+        for i in xrange(0, len(keys), self.mget_chunk):
+            pipeline.mget(keys[i:i + self.mget_chunk])
+        return [value for chunk in pipeline.execute() for value in chunk]
+
+    @reconnect(num_reconnect)
+    def get_many(self, keys):  # -> values in the order of keys
+        return self.mget(keys)
+
+    def cache_get_many(self, keys):  # -> values in the order of keys, only the local misses go to redis
+        values = [self.local.get(key) for key in keys]
+        missed = [key for key, val in zip(keys, values) if val is None]
+        if not missed:
+            return values
+        remote_values, ttls = self.remote_cache_get_many(missed) or ([None] * len(missed), [None] * len(missed))
+        remote = dict(zip(missed, zip(remote_values, ttls)))
+        for key, (val, ttl) in remote.items():
+            self.local.fetched(key, val, ttl)
+        return [val if val is not None else remote[key][0] for key, val in zip(keys, values)]
+
+    def cache_set_many(self, mapping, time_store):
+        for key, score in mapping.items():
+            self.local.put(key, score, time_store)
+        self.remote_cache_set_many(mapping, time_store)
+
+    @cache
+    @reconnect(num_reconnect)
+    def remote_cache_get_many(self, keys):  # -> (values, seconds they have left), one round trip
+        pipeline = self.storage.pipeline(transaction=False)
+        for i in xrange(0, len(keys), self.mget_chunk):
+            pipeline.mget(keys[i:i + self.mget_chunk])
+        for key in keys:
+            pipeline.ttl(key)
+        replies = pipeline.execute()
+        chunks = (len(keys) + self.mget_chunk - 1) // self.mget_chunk
+        return [value for chunk in replies[:chunks] for value in chunk], replies[chunks:]
+
+    @cache
+    @reconnect(num_reconnect)
+    def remote_cache_set_many(self, mapping, time_store):
+        pipeline = self.storage.pipeline(transaction=False)
+        for key, score in mapping.items():
+            pipeline.set(key, score, time_store)
+        pipeline.execute()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmarks of the scoring API.
+# python benchmark.py interests --redis localhost:6379:0 --ids 1 10 100 1000 10000 -> latency of clients_interests
+# against the number of client ids: a GET per id vs Storage.get_many, needs a running redis-server
+# python benchmark.py validation -> validations/sec of OnlineScoreRequest and MethodRequest, compiled plan
+# of RequestMeta vs the walk over the class __dict__ with strptime as it was
+
+import abc
+import argparse
+import datetime
+import hashlib
+import json
+import re
+import time
+
+from api import api, scoring
+from api.store import Storage
+
+
+def timed(fun, *args, **kwargs):
+    start = time.time()
+    res = fun(*args, **kwargs)
+    return res, time.time() - start
+
+
+def per_id(store, cids):  # clients_interests as it was: one round trip per id
+    return [scoring.get_interests(store, cid) for cid in cids]
+
+
+def bench_interests(args):
+    host, port, db = args.redis.split(':')
+    store = Storage(host=host, port=int(port), db=int(db))
+    cids = range(max(args.ids))
+    for cid in cids:
+        store.set('i:{}'.format(cid), json.dumps(['cars', 'pets', 'otus']))
+    try:
+        print('{0:>8} {1:>14} {2:>14} {3:>8}'.format('ids', 'GET per id, ms', 'get_many, ms', 'speedup'))
+        for num in args.ids:
+            seconds = {}
+            for name, fun in (('get', per_id), ('get_many', scoring.get_interests_many)):
+                best = None
+                for _ in range(args.repeat):
+                    res, elapsed = timed(fun, store, cids[:num])
+                    best = elapsed if best is None else min(best, elapsed)
+                assert len(res) == num
+                seconds[name] = best
+            print('{0:>8} {1:>14.3f} {2:>14.3f} {3:>7.1f}x'.format(
+                num, seconds['get'] * 1e3, seconds['get_many'] * 1e3, seconds['get'] / seconds['get_many']))
+    finally:
+        for i in range(0, len(cids), 1000):
+            store.storage.delete(*['i:{}'.format(cid) for cid in cids[i:i + 1000]])
+
+
+# the Request classes as they were before RequestMeta
+
+class LegacyPhoneField(api.Field):
+
+    def check(self, value):
+        value = super(LegacyPhoneField, self).check(value)
+        if value is not None:
+            value = str(value)
+            if not (isinstance(value, (int, str, unicode)) and
+                    (value == '' or (re.match(r'\d{11}$', str(value)) and
+                                     len(str(value)) == 11 and str(value)[0] == '7'))):
+                raise api.ValidationError('{} is invalid!'.format(self.__class__.__name__))
+        return value
+
+
+class LegacyBirthDayField(api.BirthDayField):
+
+    def check(self, value):
+        value = api.Field.check(self, value)
+        if value is not None and len(value) > 0:
+            try:
+                value = datetime.datetime.strptime(value, '%d.%m.%Y')
+            except ValueError:
+                raise api.ValidationError('{} is invalid!'.format(self.__class__.__name__))
+            if not 0 < (datetime.datetime.today() - value).days <= 365 * 70:
+                raise api.ValidationError('{} is invalid!'.format(self.__class__.__name__))
+        return value
+
+
+class LegacyRequest(object):
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, **kwargs):
+        for key in kwargs:
+            self.__setattr__(key, kwargs[key])
+        self.invalid_fields = []
+        self.error_message = None
+
+    def is_valid(self):
+        for key, cls in self.__class__.__dict__.items():
+            if not isinstance(cls, api.Field):
+                continue
+            value = getattr(self, key) if key in self.__dict__ else None
+            try:
+                self.__setattr__(key, cls.check(value))
+            except api.ValidationError:
+                self.invalid_fields.append(key)
+        return not self.invalid_fields
+
+
+class LegacyOnlineScoreRequest(LegacyRequest):
+    first_name = api.CharField(required=False, nullable=True)
+    last_name = api.CharField(required=False, nullable=True)
+    email = api.EmailField(required=False, nullable=True)
+    phone = LegacyPhoneField(required=False, nullable=True)
+    birthday = LegacyBirthDayField(required=False, nullable=True)
+    gender = api.GenderField(required=False, nullable=True)
+
+
+class LegacyMethodRequest(LegacyRequest):
+    account = api.CharField(required=False, nullable=True)
+    login = api.CharField(required=True, nullable=True)
+    token = api.CharField(required=True, nullable=True)
+    arguments = api.ArgumentsField(required=True, nullable=True)
+    method = api.CharField(required=True, nullable=True)
+
+
+SCORE_ARGUMENTS = {"phone": "79175002040", "email": "stupnikov@otus.ru", "first_name": u"Станислав",
+                   "last_name": u"Ступников", "birthday": "01.01.1990", "gender": 1}
+METHOD_BODY = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+               "token": hashlib.sha512("horns&hoofs" + "h&f" + api.SALT).hexdigest(), "arguments": SCORE_ARGUMENTS}
+
+
+def bench_validation(args):
+    print('{0:<18} {1:>16} {2:>16} {3:>8}'.format('request', 'as it was, 1/s', 'compiled, 1/s', 'speedup'))
+    for name, legacy, compiled, kwargs in (
+            ('OnlineScoreRequest', LegacyOnlineScoreRequest, api.OnlineScoreRequest, SCORE_ARGUMENTS),
+            ('MethodRequest', LegacyMethodRequest, api.MethodRequest, METHOD_BODY)):
+        rates = []
+        for cls in (legacy, compiled):
+            def validate():
+                for _ in xrange(args.calls):
+                    assert cls(**kwargs).is_valid()
+            best = min(timed(validate)[1] for _ in range(args.repeat))
+            rates.append(args.calls / best)
+        print('{0:<18} {1:>16.0f} {2:>16.0f} {3:>7.1f}x'.format(name, rates[0], rates[1], rates[1] / rates[0]))
+
+
+def create_parser():
+    parser_ = argparse.ArgumentParser()
+    commands = parser_.add_subparsers()
+    interests = commands.add_parser('interests', help='a GET per id vs Storage.get_many')
+    interests.add_argument('--redis', default='localhost:6379:0', help='host:port:db')
+    interests.add_argument('--ids', type=int, nargs='+', default=[1, 10, 100, 1000, 10000])
+    interests.add_argument('--repeat', type=int, default=5)
+    interests.set_defaults(run=bench_interests)
+    validation = commands.add_parser('validation', help='validations/sec of the Request classes')
+    validation.add_argument('--calls', type=int, default=100000)
+    validation.add_argument('--repeat', type=int, default=3)
+    validation.set_defaults(run=bench_validation)
+    return parser_
+
+
+if __name__ == '__main__':
+    namespace = create_parser().parse_args()
+    namespace.run(namespace)
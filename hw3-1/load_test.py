@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Load test of the scoring API server: requests/sec and latency percentiles for every server_mode.
+# For every mode api.py is started with a generated config, then --clients processes send requests for --seconds.
+# python load_test.py --redis localhost:6379:0 --modes single threading prefork --workers 8 --clients 32
+# --method online_score (default) and clients_interests go to redis, admin_score does not touch the store.
+
+import argparse
+import hashlib
+import httplib
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from api import api
+from api.create_config import create_config
+
+BODIES = {
+    'online_score': {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                     "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}},
+    'clients_interests': {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                          "arguments": {"client_ids": [1, 2, 3, 4]}},
+    'admin_score': {"account": "horns&hoofs", "login": "admin", "method": "online_score",
+                    "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}},
+}
+
+
+def request_body(method):
+    body = dict(BODIES[method])
+    if body['login'] == api.ADMIN_LOGIN:
+        body['token'] = hashlib.sha512(datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+    else:
+        body['token'] = hashlib.sha512(body['account'] + body['login'] + api.SALT).hexdigest()
+    return json.dumps(body)
+
+
+def client(port, body, seconds, queue):  # -> queue: latencies of the requests answered with 200, errors
+    latencies, errors = [], 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            connection = httplib.HTTPConnection('localhost', port, timeout=30)
+            connection.request('POST', '/method/', body, {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            ok = response.status == api.OK
+            response.read()
+            connection.close()
+        except Exception:
+            ok = False
+        if ok:
+            latencies.append(time.time() - start)
+        else:
+            errors += 1
+    queue.put((latencies, errors))
+
+
+def wait_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = httplib.HTTPConnection('localhost', port, timeout=1)
+            connection.request('GET', '/')
+            connection.getresponse().read()
+            return
+        except Exception:
+            time.sleep(0.1)
+    raise Exception('the server is not started on port {}'.format(port))
+
+
+def percentile(values, q):
+    return values[min(int(q / 100.0 * len(values)), len(values) - 1)] if values else 0
+
+
+def run_mode(mode, args):
+    config_path = os.path.join(tempfile.mkdtemp(), 'config_api')
+    create_config(config_path)
+    host, port, db = args.redis.split(':')
+    with open(config_path) as config_file:
+        text = config_file.read()
+    replaces = {
+        'server_mode = threading': 'server_mode = ' + mode,
+        'workers = 8': 'workers = {}'.format(args.workers),
+        'port = 8080': 'port = {}'.format(args.port),
+        'store_url = localhost': 'store_url = ' + host,
+        'store_port = 6379': 'store_port = ' + port,
+        'number_db = 0': 'number_db = ' + db,
+        'logging_to_file = api.log': 'logging_to_file = ' + os.devnull,
+        'logging_level = INFO': 'logging_level = ERROR',
+    }
+    for old, new in replaces.items():
+        text = text.replace(old, new)
+    with open(config_path, 'w') as config_file:
+        config_file.write(text)
+    with open(os.devnull, 'w') as devnull:  # BaseHTTPRequestHandler writes every request to stderr
+        server = subprocess.Popen([sys.executable, os.path.join('api', 'api.py'), '-c', config_path], stderr=devnull)
+    try:
+        wait_port(args.port)
+        queue = multiprocessing.Queue()
+        body = request_body(args.method)
+        clients = [multiprocessing.Process(target=client, args=(args.port, body, args.seconds, queue))
+                   for _ in range(args.clients)]
+        start = time.time()
+        for process in clients:
+            process.start()
+        results = [queue.get() for _ in clients]
+        elapsed = time.time() - start
+        for process in clients:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+        os.remove(config_path)
+        os.rmdir(os.path.dirname(config_path))
+    latencies = sorted(latency for latencies, _ in results for latency in latencies)
+    errors = sum(errors for _, errors in results)
+    print('{0:<10} {1:>10.0f} {2:>10.1f} {3:>10.1f} {4:>10.1f} {5:>8}'.format(
+        mode, len(latencies) / elapsed, percentile(latencies, 50) * 1e3, percentile(latencies, 99) * 1e3,
+        latencies[-1] * 1e3 if latencies else 0, errors))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--redis', default='localhost:6379:0', help='host:port:db')
+    parser.add_argument('--modes', nargs='+', choices=api.SERVER_MODES, default=list(api.SERVER_MODES))
+    parser.add_argument('--workers', type=int, default=8, help='threads or processes of the server')
+    parser.add_argument('--clients', type=int, default=32, help='client processes, one request at a time each')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--method', choices=sorted(BODIES), default='online_score')
+    parser.add_argument('--port', type=int, default=8090)
+    namespace = parser.parse_args()
+    print('{0:<10} {1:>10} {2:>10} {3:>10} {4:>10} {5:>8}'.format('mode', 'req/sec', 'p50, ms', 'p99, ms', 'max, ms',
+                                                                 'errors'))
+    for server_mode in namespace.modes:
+        run_mode(server_mode, namespace)
@@ -1,11 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import unittest
+import errno
 import hashlib
+import httplib
 import json
+import logging
 import os
+import signal
+import socket
+import threading
+import time
 
-from api import api
+from api import api, async_server
+from BaseHTTPServer import HTTPServer
 from datetime import datetime
 from tests.cases import cases
 
@@ -20,6 +28,34 @@ def parse_redis_host():
 STORE_HOST = parse_redis_host()
 
 
+def set_valid_auth(request):
+    if request.get("login") == api.ADMIN_LOGIN:
+        request["token"] = hashlib.sha512(datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+    else:
+        msg = request.get("account", "") + request.get("login", "") + api.SALT
+        request["token"] = hashlib.sha512(msg).hexdigest()
+
+
+class LoggedContexts(logging.Handler):  # the request contexts logged by the handlers
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.contexts = []
+
+    def emit(self, record):
+        if isinstance(record.msg, dict):
+            self.contexts.append(record.msg)
+
+    def __enter__(self):
+        self.root_level = logging.root.level
+        logging.root.setLevel(logging.INFO)
+        logging.root.addHandler(self)
+        return self.contexts
+
+    def __exit__(self, *exc_info):
+        logging.root.removeHandler(self)
+        logging.root.setLevel(self.root_level)
+
+
 class TestSuite(unittest.TestCase):
     keys_for_del = []
 
@@ -43,11 +79,7 @@ class TestSuite(unittest.TestCase):
         return api.method_handler({"body": request, "headers": self.headers}, self.context, self.store)
 
     def set_valid_auth(self, request):
-        if request.get("login") == api.ADMIN_LOGIN:
-            request["token"] = hashlib.sha512(datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
-        else:
-            msg = request.get("account", "") + request.get("login", "") + api.SALT
-            request["token"] = hashlib.sha512(msg).hexdigest()
+        set_valid_auth(request)
 
     def test_empty_request(self):
         _, code = self.get_response({})
@@ -138,6 +170,23 @@ class TestSuite(unittest.TestCase):
         self.assertTrue(isinstance(score, (int, float)) and score >= 0, arguments)
         self.assertEqual(sorted(self.context["has"]), sorted(arguments.keys()))
 
+    def test_ok_score_unknown_argument_request(self):  # dropped as in a batch
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru", "foo": 1}}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual((response, code), ({"score": 3.0}, api.OK))
+        self.assertEqual(sorted(self.context["has"]), ["email", "phone"])
+
+    def test_ok_score_cached_request(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        self.set_valid_auth(request)
+        responses = [self.get_response(request) for _ in range(2)]
+        self.assertEqual(responses[0], responses[1])
+        self.assertEqual(self.context["cache"]["local"], 0.5)  # the second one does not go to redis
+        self.assertEqual(set(self.context["cache"]), {"local", "redis"})
+
     @unittest.skipIf(not STORE_HOST, "REDIS_HOST_API is not in os.environ. You should define REDIS_HOST_API "
                                      "environment variable for functional test: test_ok_interests_request.")
     @cases([
@@ -155,6 +204,237 @@ class TestSuite(unittest.TestCase):
                             for v in response.values()))
         self.assertEqual(self.context.get("nclients"), len(arguments["client_ids"]))
 
+    @cases([
+        {},
+        {"requests": []},
+        {"requests": {"method": "online_score"}},
+        {"requests": [1, 2]},
+    ])
+    def test_invalid_batch_request(self, arguments):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "batch", "arguments": arguments}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.INVALID_REQUEST, code, arguments)
+        self.assertTrue(len(response))
+
+    def test_ok_batch_request(self):
+        requests = [
+            {"method": "online_score", "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}},
+            {"method": "online_score", "arguments": {"phone": "79175002040"}},
+            {"method": "clients_interests", "arguments": {"client_ids": [1, 2]}},
+            {"method": "no_such_method", "arguments": {}},
+            {"method": "online_score", "arguments": {"first_name": "a", "last_name": "b"}},
+            {"method": "online_score"},
+        ]
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "batch", "arguments": {"requests": requests}}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        codes = [item["code"] for item in response["responses"]]
+        self.assertEqual(codes, [api.OK, api.INVALID_REQUEST, api.OK if STORE_HOST else api.INTERNAL_ERROR,
+                                 api.INVALID_REQUEST, api.OK, api.INVALID_REQUEST])
+        self.assertEqual(response["responses"][0]["response"], {"score": 3.0})
+        self.assertEqual(response["responses"][4]["response"], {"score": 0.5})
+        self.assertTrue(all(item.get("error") for item in response["responses"] if item["code"] != api.OK))
+        self.assertEqual((self.context["nrequests"], self.context["nerrors"]), (6, 3 if STORE_HOST else 4))
+
+    def test_ok_batch_unknown_argument_request(self):
+        requests = [
+            {"method": "online_score", "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}},
+            {"method": "online_score", "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru", "foo": 1}},
+        ]
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "batch", "arguments": {"requests": requests}}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(response["responses"], [{"code": api.OK, "response": {"score": 3.0}}] * 2)
+
+    def test_ok_batch_admin_request(self):
+        requests = [{"method": "online_score", "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}]
+        request = {"account": "horns&hoofs", "login": "admin", "method": "batch", "arguments": {"requests": requests}}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(response["responses"], [{"code": api.OK, "response": {"score": 42}}])
+
+
+class TestAsyncServer(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = async_server.EventLoop()
+        if STORE_HOST:
+            store = async_server.AsyncStorage(self.loop, host=STORE_HOST['STORE_URL'],
+                                              port=int(STORE_HOST['STORE_PORT']), db=int(STORE_HOST['NUMBER_DB']))
+        else:
+            store = async_server.AsyncStorage(self.loop)
+        self.server = async_server.AsyncHTTPServer(self.loop, ('localhost', 0), store)
+        self.thread = threading.Thread(target=self.loop.run)
+        self.thread.start()
+
+    def tearDown(self):
+        self.loop.stop()
+        self.thread.join()
+        self.server.close()
+
+    def post(self, path, body, headers={}):
+        connection = httplib.HTTPConnection('localhost', self.server.server_address[1], timeout=10)
+        connection.request('POST', path, body, headers)
+        response = connection.getresponse()
+        result = response.status, json.loads(response.read())
+        connection.close()
+        return result
+
+    def test_ok_score_admin_request(self):
+        request = {"account": "horns&hoofs", "login": "admin", "method": "online_score",
+                   "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        set_valid_auth(request)
+        status, response = self.post('/method/', json.dumps(request))
+        self.assertEqual(api.OK, status)
+        self.assertEqual({"response": {"score": 42}, "code": api.OK}, response)
+
+    def test_ok_score_unknown_argument_request(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru", "foo": 1}}
+        set_valid_auth(request)
+        status, response = self.post('/method/', json.dumps(request))
+        self.assertEqual(api.OK, status)
+        self.assertEqual({"response": {"score": 3.0}, "code": api.OK}, response)
+
+    @cases([
+        ('/method/', '{"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": "", '
+                     '"arguments": {}}', api.FORBIDDEN),
+        ('/method/', '{"login": "h&f"', api.BAD_REQUEST),
+        ('/nothing/', '{"login": "h&f"}', api.NOT_FOUND),
+    ])
+    def test_error_request(self, path, body, code):
+        status, response = self.post(path, body)
+        self.assertEqual(code, status)
+        self.assertEqual(code, response["code"])
+        self.assertIn("error", response)
+
+    def test_request_id_header(self):
+        with LoggedContexts() as contexts:
+            status, response = self.post('/nothing/', '{"login": "h&f"}', {'X-Request-Id': 'req-42'})
+        self.assertEqual(api.NOT_FOUND, status)
+        self.assertEqual([context['request_id'] for context in contexts], ['req-42'])
+
+    def test_idle_connection_closed(self):
+        timeout, async_server.HTTPConnection.timeout = async_server.HTTPConnection.timeout, 0.2
+        try:
+            client = socket.create_connection(('localhost', self.server.server_address[1]), timeout=5)
+            client.sendall('POST /method/ HTTP/1.0\r\nContent-Length: 10\r\n')  # and nothing more
+            start = time.time()
+            self.assertEqual(client.recv(1024), '')
+            self.assertLess(time.time() - start, 2)
+            client.close()
+        finally:
+            async_server.HTTPConnection.timeout = timeout
+
+
+class TestAsyncServerAccept(unittest.TestCase):
+
+    class NoDescriptorsSocket(object):
+        def __init__(self, sock):
+            self.sock = sock
+
+        def fileno(self):
+            return self.sock.fileno()
+
+        def accept(self):
+            raise socket.error(errno.EMFILE, 'Too many open files')
+
+    def test_accept_paused_out_of_descriptors(self):
+        loop = async_server.EventLoop()
+        server = async_server.AsyncHTTPServer(loop, ('localhost', 0), async_server.AsyncStorage(loop))
+        listener = server.sock
+        fd = listener.fileno()
+        server.sock = self.NoDescriptorsSocket(listener)
+        server.handle_read()
+        self.assertNotIn(fd, loop.handlers)  # no busy loop on a listener which cannot accept
+        server.sock = listener
+        loop.call_later(server.accept_pause * 2, loop.stop)
+        loop.run()
+        self.assertIn(fd, loop.handlers)
+        server.close()
+
+
+class TestAsyncServe(unittest.TestCase):
+
+    def test_serve_forks_workers(self):
+        calls = []
+
+        def fork_workers(serve, workers):
+            calls.append(workers)
+            raise SystemExit()
+        fork_workers, api.fork_workers = api.fork_workers, fork_workers
+        try:
+            self.assertRaises(SystemExit, async_server.serve, dict(api.config, PORT=0, WORKERS=3))
+        finally:
+            api.fork_workers = fork_workers
+        self.assertEqual(calls, [3])
+
+
+class TestRequestId(unittest.TestCase):
+
+    def test_request_id_header(self):
+        server = HTTPServer(('localhost', 0), api.MainHTTPHandler)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        connection = httplib.HTTPConnection('localhost', server.server_address[1], timeout=10)
+        with LoggedContexts() as contexts:
+            connection.request('POST', '/nothing/', '{"login": "h&f"}', {'X-Request-Id': 'req-42'})
+            status = connection.getresponse().status
+            thread.join()
+        connection.close()
+        server.server_close()
+        self.assertEqual(api.NOT_FOUND, status)
+        self.assertEqual([context['request_id'] for context in contexts], ['req-42'])
+
+
+class TestPrefork(unittest.TestCase):
+
+    class SleepingServer(object):
+        def serve_forever(self):
+            time.sleep(60)
+
+    def test_sigterm_reaps_children(self):
+        handler = signal.getsignal(signal.SIGTERM)
+        children = []
+        fork = os.fork
+
+        def forked():
+            pid = fork()
+            if pid:
+                children.append(pid)
+            return pid
+        threading.Timer(0.3, os.kill, (os.getpid(), signal.SIGTERM)).start()
+        os.fork = forked
+        try:
+            self.assertRaises(SystemExit, api.serve_prefork, self.SleepingServer(), dict(api.config, WORKERS=2))
+        finally:
+            os.fork = fork
+            signal.signal(signal.SIGTERM, handler)
+        self.assertEqual(len(children), 2)
+        for pid in children:  # waited for already, no zombies left
+            with self.assertRaises(OSError) as error:
+                os.waitpid(pid, os.WNOHANG)
+            self.assertEqual(error.exception.errno, errno.ECHILD)
+
+    def test_run_server_closes_socket(self):
+        servers, storages = [], []
+
+        def serve_prefork(server, conf):
+            servers.append(server)
+            raise SystemExit()
+        saved = api.serve_prefork, api.create_storage
+        api.serve_prefork, api.create_storage = serve_prefork, storages.append
+        try:
+            self.assertRaises(SystemExit, api.run_server, dict(api.config, PORT=0, SERVER_MODE='prefork'))
+        finally:
+            api.serve_prefork, api.create_storage = saved
+        self.assertEqual(storages, [])  # only the children create storages
+        self.assertRaises(socket.error, servers[0].socket.getsockname)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,6 +1,8 @@
 import datetime
+import time
 import unittest
-from api import api
+from api import api, async_server
+from api.store import CircuitBreaker, LocalCache, Storage
 
 from datetime import datetime
 from tests.cases import cases
@@ -141,5 +143,150 @@ class TestClientIDsField(unittest.TestCase):
         self.assertEqual(res, value)
 
 
+class TestRequestsField(unittest.TestCase):
+
+    @cases([1, {1: 1}, 'a', 0, '', [], {}, [1], ['a'], [[]], [{}, 1]])
+    def test_bad_requests(self, value):
+        self.assertRaises(api.ValidationError, api.RequestsField().check, value)
+
+    @cases([[{}], [{"method": "online_score", "arguments": {}}, {"method": "clients_interests"}]])
+    def test_ok_requests(self, value):
+        res = api.RequestsField().check(value)
+        self.assertEqual(res, value)
+
+
+class TestRequestMeta(unittest.TestCase):
+
+    def test_fields(self):
+        self.assertEqual([key for key, _ in api.OnlineScoreRequest.fields],
+                         ['first_name', 'last_name', 'email', 'phone', 'birthday', 'gender'])
+        self.assertFalse(any(isinstance(value, api.Field) for value in vars(api.OnlineScoreRequest).values()))
+        request = api.MethodRequest(login='h&f', unknown=1)
+        self.assertFalse(hasattr(request, '__dict__'))
+        self.assertFalse(hasattr(request, 'unknown'))
+        self.assertEqual((request.login, request.token), ('h&f', None))
+
+    def test_inherited_fields(self):
+        class AdminRequest(api.MethodRequest):
+            level = api.GenderField(required=True)
+
+        request = AdminRequest(login='admin', token='', arguments={}, method='m', level=3)
+        self.assertFalse(request.is_valid())
+        self.assertEqual(request.invalid_fields, ['level'])
+        self.assertTrue(request.is_admin)
+
+    def test_three_level_fields(self):
+        class Base(api.Request):
+            d = api.DateField(nullable=True)
+
+        class Middle(Base):
+            x = api.CharField(nullable=True)
+
+        class Leaf(Middle):
+            y = api.CharField(nullable=True)
+            x = api.CharField(nullable=True, max_length=3)
+
+        self.assertEqual([key for key, _ in Leaf.fields], ['d', 'x', 'y'])
+        self.assertEqual(Leaf.fields[1][1].max_length, 3)
+        request = Leaf(d='01.01.2000', x='abc', y='b')
+        self.assertTrue(request.is_valid(), request.invalid_fields)
+        self.assertEqual(request.d, datetime(2000, 1, 1))
+        self.assertFalse(Leaf(x='abcd').is_valid())
+
+
+class TestLocalCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = LocalCache(maxsize=2, ttl=600, timer=lambda: self.now)
+
+    def test_lru(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.cache.put('c', 3)
+        self.assertEqual((self.cache.get('a'), self.cache.get('b'), self.cache.get('c')), (1, None, 3))
+
+    @cases([(None, 600), (-1, 600), (30, 30), (3600, 600)])
+    def test_ttl(self, ttl, lives):
+        self.cache.put('a', 1, ttl)
+        self.now += lives - 1
+        self.assertEqual(self.cache.get('a'), 1)
+        self.now += 1
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_stats(self):
+        self.assertEqual(self.cache.stats(), {'local': 0.0, 'redis': 0.0})
+        self.cache.get('a')
+        self.cache.fetched('a', '3.0', 100)
+        self.cache.get('a')
+        self.cache.get('b')
+        self.cache.fetched('b', None)
+        self.assertEqual(self.cache.stats(), {'local': 0.333, 'redis': 0.5})
+        self.assertIsNone(self.cache.get('b'))
+
+    def test_disabled(self):
+        cache = LocalCache(maxsize=0)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_open_and_close(self):
+        probes = []
+
+        def probe():
+            probes.append(1)
+            if len(probes) < 3:
+                raise api.redis.exceptions.ConnectionError()
+        breaker = CircuitBreaker(probe, threshold=2, interval=0.01)
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertFalse(breaker.opened)
+        breaker.failure()
+        self.assertTrue(breaker.opened)
+        for _ in range(100):
+            if not breaker.opened:
+                break
+            time.sleep(0.01)
+        self.assertFalse(breaker.opened)
+        self.assertEqual(len(probes), 3)
+
+    def test_storage_fails_fast(self):
+        store = Storage(port=1, timeout=1, breaker_threshold=1, probe_interval=60)  # nothing listens on port 1
+        self.assertRaises(api.redis.exceptions.ConnectionError, store.get, 'i:1')
+        self.assertTrue(store.breaker.opened)
+        start = time.time()
+        self.assertRaises(api.redis.exceptions.ConnectionError, store.get, 'i:1')
+        self.assertIsNone(store.cache_get('uid:1'))
+        store.cache_set('uid:1', 3.0, 60)
+        self.assertEqual(store.cache_get('uid:1'), 3.0)
+        self.assertLess(time.time() - start, 0.1)
+
+
+class TestRedisProtocol(unittest.TestCase):
+
+    def test_encode_command(self):
+        self.assertEqual(async_server.encode_command(('SET', 'i:1', 3.5, 'EX', 60)),
+                         '*5\r\n$3\r\nSET\r\n$3\r\ni:1\r\n$3\r\n3.5\r\n$2\r\nEX\r\n$2\r\n60\r\n')
+        self.assertEqual(async_server.encode_command((u'GET', u'\u044f')), '*2\r\n$3\r\nGET\r\n$2\r\n\xd1\x8f\r\n')
+
+    @cases([('+OK\r\n', 'OK'), (':12\r\n', 12), ('$3\r\nabc\r\n', 'abc'), ('$-1\r\n', None),
+            ('*3\r\n$1\r\na\r\n$-1\r\n:1\r\n', ['a', None, 1]), ('*0\r\n', [])])
+    def test_ok_reply(self, data, reply):
+        self.assertEqual(async_server.parse_reply(data + '+OK\r\n'), (reply, len(data)))
+
+    @cases(['', '+OK', '$3\r\nab', '$3\r\nabc', '*2\r\n$1\r\na\r\n'])
+    def test_incomplete_reply(self, data):
+        self.assertIs(async_server.parse_reply(data), async_server.INCOMPLETE)
+
+    def test_error_reply(self):
+        reply, pos = async_server.parse_reply('-ERR unknown command\r\n')
+        self.assertIsInstance(reply, api.redis.exceptions.ResponseError)
+        self.assertEqual(str(reply), 'ERR unknown command')
+
+
 if __name__ == "__main__":
     unittest.main()